@@ -0,0 +1,237 @@
+from unittest import TestCase, mock
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from block import Block
+from helper import double_sha256, p2pkh_script
+from network import NETWORK_MAGIC
+from tx import Tx, TxIn, TxOut
+
+
+# index record: block hash, blk file number, offset and length of the
+# block in that file
+BLOCK_RECORD = struct.Struct('<32sIQI')
+# each block in a blk file is preceded by the network magic and its length
+RECORD_HEADER = struct.Struct('<4sI')
+
+
+class BlockFiles:
+    '''Reads blocks from a directory of Bitcoin Core blk?????.dat files.
+
+    scan() walks the files once and appends a BLOCK_RECORD per block to
+    an index file, blocks.idx in index_path (path by default), so opening
+    the directory again only scans what was appended since. Blocks are
+    served as slices of a read-only mmap of their file, so reaching one
+    block doesn't read anything before it.'''
+
+    def __init__(self, path, index_path=None, magic=NETWORK_MAGIC):
+        self.path = path
+        self.index_path = index_path or path
+        self.magic = magic
+        self.offsets = {}
+        # how far each file has been scanned
+        self.scanned = {}
+        self.maps = {}
+        index_name = os.path.join(self.index_path, 'blocks.idx')
+        os.makedirs(self.index_path, exist_ok=True)
+        open(index_name, 'ab').close()
+        with open(index_name, 'rb') as f:
+            data = f.read()
+        # drop a record torn by a crash
+        usable = len(data) - len(data) % BLOCK_RECORD.size
+        for block_hash, file_number, offset, length in BLOCK_RECORD.iter_unpack(data[:usable]):
+            self._add(block_hash, file_number, offset, length)
+        self.index = open(index_name, 'r+b')
+        self.index.truncate(usable)
+        self.index.seek(usable)
+
+    def _add(self, block_hash, file_number, offset, length):
+        self.offsets[block_hash] = (file_number, offset, length)
+        self.scanned[file_number] = max(self.scanned.get(file_number, 0), offset + length)
+
+    def filename(self, file_number):
+        return os.path.join(self.path, 'blk{:05d}.dat'.format(file_number))
+
+    def file_numbers(self):
+        '''Returns the numbers of the blk files in the directory, in order'''
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.startswith('blk') and name.endswith('.dat') and name[3:-4].isdigit():
+                numbers.append(int(name[3:-4]))
+        return sorted(numbers)
+
+    def _view(self, file_number, end):
+        '''Returns a memoryview of the mmap of a file, mapped again if it grew'''
+        m = self.maps.get(file_number)
+        if m is None or len(m) < end:
+            with open(self.filename(file_number), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # blocks handed out may still reference the old map, it is
+            # unmapped once they are gone
+            self.maps[file_number] = m
+        return memoryview(m)
+
+    def scan(self):
+        '''Indexes blocks appended to the files since the last scan.
+        Returns the number of new blocks.'''
+        found = 0
+        for file_number in self.file_numbers():
+            offset = self.scanned.get(file_number, 0)
+            # map the whole file, including what was appended since
+            view = self._view(file_number, os.path.getsize(self.filename(file_number)))
+            while offset + RECORD_HEADER.size <= len(view):
+                magic, length = RECORD_HEADER.unpack_from(view, offset)
+                if magic != self.magic:
+                    # bitcoind preallocates files, the rest is zeros
+                    if magic == b'\x00\x00\x00\x00':
+                        break
+                    raise RuntimeError('bad magic at {} in {}'.format(offset, self.filename(file_number)))
+                start = offset + RECORD_HEADER.size
+                if start + length > len(view):
+                    # the block is still being written
+                    break
+                block_hash = double_sha256(view[start:start + 80])[::-1]
+                if block_hash not in self.offsets:
+                    self.index.write(BLOCK_RECORD.pack(block_hash, file_number, start, length))
+                    found += 1
+                self._add(block_hash, file_number, start, length)
+                offset = start + length
+            view.release()
+        self.index.flush()
+        return found
+
+    def __contains__(self, block_hash):
+        return block_hash in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def block_bytes(self, block_hash):
+        '''Returns the serialized block as a memoryview of its file, or None'''
+        if block_hash not in self.offsets:
+            return None
+        file_number, offset, length = self.offsets[block_hash]
+        return self._view(file_number, offset + length)[offset:offset + length]
+
+    def block(self, block_hash):
+        '''Returns the block parsed with Block.parse_full, or None. Its
+        transactions are parsed when asked for with Block.tx.'''
+        view = self.block_bytes(block_hash)
+        if view is None:
+            return None
+        return Block.parse_full(view)
+
+    def tx(self, block_hash, index):
+        '''Returns transaction index of the block as a Tx'''
+        view = self.block_bytes(block_hash)
+        if view is None:
+            raise RuntimeError('unknown block {}'.format(block_hash.hex()))
+        return Block.parse_full(view).tx(index)
+
+    def close(self):
+        for m in self.maps.values():
+            try:
+                m.close()
+            except BufferError:
+                # a block still references it, unmapped when that is gone
+                pass
+        self.maps = {}
+        self.index.close()
+
+
+class BlockFilesTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blocks = []
+        prev_block = b'\x00' * 32
+        for i in range(5):
+            coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, bytes([1, i]))],
+                          [TxOut(5000000000, p2pkh_script(bytes(20)))], 0)
+            spend = Tx(1, [TxIn(b'\x11' * 32, i, b'\x51')], [TxOut(1000 * i, p2pkh_script(bytes(20)))], 0)
+            txs = [coinbase, spend]
+            block = Block(1, prev_block, double_sha256(coinbase.serialize()), 1231006505 + i,
+                          b'\xff\xff\x00\x1d', bytes([i]) * 4)
+            block.tx_hashes = [tx.txid() for tx in txs]
+            raw = block.serialize() + bytes([len(txs)]) + b''.join(tx.serialize() for tx in txs)
+            self.blocks.append((block.hash(), raw, txs))
+            prev_block = block.hash()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, file_number, blocks, padding=0):
+        with open(os.path.join(self.path, 'blk{:05d}.dat'.format(file_number)), 'ab') as f:
+            for _, raw, _ in blocks:
+                f.write(RECORD_HEADER.pack(NETWORK_MAGIC, len(raw)) + raw)
+            f.write(b'\x00' * padding)
+
+    def test_scan(self):
+        self.write(0, self.blocks[:2])
+        self.write(1, self.blocks[2:4], padding=100)
+        files = BlockFiles(self.path)
+        self.assertEqual(files.scan(), 4)
+        self.assertEqual(len(files), 4)
+        for block_hash, raw, txs in self.blocks[:4]:
+            self.assertEqual(bytes(files.block_bytes(block_hash)), raw)
+            block = files.block(block_hash)
+            self.assertEqual(block.hash(), block_hash)
+            self.assertEqual(block.txids(), [tx.txid() for tx in txs])
+            self.assertEqual(files.tx(block_hash, 1).serialize(), txs[1].serialize())
+        self.assertIsNone(files.block(self.blocks[4][0]))
+        self.assertEqual(files.scan(), 0)
+        files.close()
+
+    def test_persistent_index(self):
+        self.write(0, self.blocks[:3])
+        files = BlockFiles(self.path)
+        files.scan()
+        files.close()
+        self.write(0, self.blocks[3:])
+        files = BlockFiles(self.path)
+        self.assertEqual(len(files), 3)
+        # only the appended blocks are hashed
+        with mock.patch('blkfile.double_sha256', wraps=double_sha256) as hashes:
+            self.assertEqual(files.scan(), 2)
+            self.assertEqual(hashes.call_count, 2)
+        block = files.block(self.blocks[4][0])
+        self.assertEqual(block.prev_block, self.blocks[3][0])
+        # a block still in use keeps its map alive past close
+        files.close()
+        self.assertEqual(block.tx(0).serialize(), self.blocks[4][2][0].serialize())
+
+    def test_partial_record(self):
+        self.write(0, self.blocks[:2])
+        with open(os.path.join(self.path, 'blk00000.dat'), 'ab') as f:
+            raw = self.blocks[2][1]
+            f.write(RECORD_HEADER.pack(NETWORK_MAGIC, len(raw)) + raw[:50])
+        with open(os.path.join(self.path, 'blocks.idx'), 'ab') as f:
+            f.write(b'\x00' * 10)
+        files = BlockFiles(self.path)
+        self.assertEqual(files.scan(), 2)
+        self.assertNotIn(self.blocks[2][0], files)
+        files.close()
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'blocks.idx')), 2 * BLOCK_RECORD.size)
+
+    def test_append_between_scans(self):
+        self.write(0, self.blocks[:2])
+        files = BlockFiles(self.path)
+        self.assertEqual(files.scan(), 2)
+        # the rest of a block being written, then more blocks
+        raw = self.blocks[2][1]
+        with open(os.path.join(self.path, 'blk00000.dat'), 'ab') as f:
+            f.write(RECORD_HEADER.pack(NETWORK_MAGIC, len(raw)) + raw[:50])
+        self.assertEqual(files.scan(), 0)
+        with open(os.path.join(self.path, 'blk00000.dat'), 'ab') as f:
+            f.write(raw[50:])
+        self.write(0, self.blocks[3:])
+        self.assertEqual(files.scan(), 3)
+        for block_hash, raw, _ in self.blocks:
+            self.assertEqual(bytes(files.block_bytes(block_hash)), raw)
+        files.close()
@@ -1,16 +1,72 @@
 from binascii import hexlify, unhexlify
+from functools import lru_cache
 from io import BytesIO
-from unittest import TestCase
+from unittest import TestCase, mock
+
+import tempfile
 
 from helper import (
+    ByteReader,
+    ByteWriter,
     double_sha256,
-    int_to_little_endian,
     little_endian_to_int,
     merkle_parent,
     merkle_parent_level,
     merkle_path,
     merkle_root,
+    p2pkh_script,
 )
+from tx import Tx, TxIn, TxOut, scan_tx, stripped_hash
+
+
+# target of the lowest difficulty, bits 0xffff001d
+MAX_TARGET = 0xffff * 2**(8*(0x1d-3))
+# time a 2016 block difficulty period should take
+TWO_WEEKS = 60 * 60 * 24 * 14
+
+
+# bits only change every 2016 blocks, a few hundred values cover a
+# chain. Bounded as headers from peers can carry any bits.
+@lru_cache(maxsize=1024)
+def bits_to_target(bits):
+    '''Returns the proof-of-work target for the 4 bytes of bits'''
+    # last byte is exponent
+    exponent = bits[-1]
+    # the first three bytes are the coefficient in little endian
+    coefficient = little_endian_to_int(bits[:-1])
+    # the formula is:
+    # coefficient * 2**(8*(exponent-3))
+    return coefficient * 2**(8*(exponent-3))
+
+
+@lru_cache(maxsize=1024)
+def bits_to_work(bits):
+    '''Returns the expected number of hashes to find a block at the
+    target of bits'''
+    return 2**256 // (bits_to_target(bits) + 1)
+
+
+def target_to_bits(target):
+    '''Turns a target integer back into bits, rounding it down to the 3
+    significant bytes bits can hold'''
+    raw_bytes = target.to_bytes(32, 'big').lstrip(b'\x00')
+    # the coefficient is signed, a leading byte over 0x7f needs a 0 in front
+    if raw_bytes[0] > 0x7f:
+        exponent = len(raw_bytes) + 1
+        coefficient = b'\x00' + raw_bytes[:2]
+    else:
+        exponent = len(raw_bytes)
+        coefficient = raw_bytes[:3]
+    return coefficient[::-1] + bytes([exponent])
+
+
+def calculate_new_bits(prev_bits, time_differential, max_target=MAX_TARGET):
+    '''Returns the bits for the next 2016 block period, given the bits of
+    the last period and the seconds between its first and last block'''
+    # the adjustment is at most a factor of 4 either way
+    time_differential = max(TWO_WEEKS // 4, min(time_differential, TWO_WEEKS * 4))
+    new_target = min(bits_to_target(prev_bits) * time_differential // TWO_WEEKS, max_target)
+    return target_to_bits(new_target)
 
 
 class Proof:
@@ -65,41 +121,117 @@ class Block:
         self.nonce = nonce
         self.tx_hashes = tx_hashes
         self.merkle_tree = None
+        # set by parse_full: the block bytes and, per transaction, where
+        # it starts, where its inputs and witnesses start and where it ends
+        self.raw = None
+        self.tx_spans = None
+        self.txs = None
 
     @classmethod
     def parse(cls, s):
         '''Takes a byte stream and parses a block. Returns a Block object'''
-        # s.read(n) will read n bytes from the stream
+        r = ByteReader.wrap(s)
         # version - 4 bytes, little endian, interpret as int
-        version = little_endian_to_int(s.read(4))
+        version = r.read_u32le()
         # prev_block - 32 bytes, little endian (use [::-1] to reverse)
-        prev_block = s.read(32)[::-1]
+        prev_block = r.read(32)[::-1]
         # merkle_root - 32 bytes, little endian (use [::-1] to reverse)
-        merkle_root = s.read(32)[::-1]
+        merkle_root = r.read(32)[::-1]
         # timestamp - 4 bytes, little endian, interpret as int
-        timestamp = little_endian_to_int(s.read(4))
+        timestamp = r.read_u32le()
         # bits - 4 bytes
-        bits = s.read(4)
+        bits = r.read(4)
         # nonce - 4 bytes
-        nonce = s.read(4)
+        nonce = r.read(4)
+        r.sync(s)
         # initialize class
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce)
 
+    @classmethod
+    def parse_full(cls, s):
+        '''Takes a byte stream and parses a whole block. Transactions are
+        only located here, tx(i) parses one on first access and txid(i)
+        hashes its bytes. A memoryview is referenced rather than copied.'''
+        r = ByteReader.wrap(s)
+        start = r.tell()
+        block = cls.parse(r)
+        # number of transactions is a varint
+        num_txs = r.read_varint()
+        offset = r.tell()
+        spans = []
+        txs = [None] * num_txs
+        if isinstance(r, ByteReader):
+            for _ in range(num_txs):
+                inputs_start, witness_start, end = scan_tx(r.view, offset)
+                spans.append((offset - start, inputs_start - start, witness_start - start, end - start))
+                offset = end
+            r.offset = offset
+        else:
+            # a stream can't be scanned ahead, so the transactions are
+            # parsed to find where they end
+            for i in range(num_txs):
+                txs[i] = tx = Tx.parse(r)
+                spans.append((offset - start, offset + tx.offsets['inputs'] - start,
+                              offset + tx.offsets['witness'] - start, r.tell() - start))
+                offset = r.tell()
+        if isinstance(s, memoryview):
+            # keep slicing the caller's buffer, such as an mmap, instead of copying
+            block.raw = r.view[start:offset]
+        else:
+            block.raw = r.slice(start, offset)
+        r.sync(s)
+        block.tx_spans = spans
+        block.txs = txs
+        return block
+
+    def tx(self, index):
+        '''Returns transaction index of a block from parse_full as a Tx'''
+        tx = self.txs[index]
+        if tx is None:
+            start, _, _, end = self.tx_spans[index]
+            tx = Tx.parse(memoryview(self.raw)[start:end])
+            self.txs[index] = tx
+        return tx
+
+    def txid(self, index):
+        '''Returns the hash of transaction index of a block from parse_full
+        without parsing it'''
+        if self.tx_hashes is not None:
+            return self.tx_hashes[index]
+        start, inputs_start, witness_start, end = self.tx_spans[index]
+        view = memoryview(self.raw)[start:end]
+        return stripped_hash(view, inputs_start - start, witness_start - start)[::-1]
+
+    def txids(self):
+        '''Returns tx_hashes, computed from the transactions first for a
+        block from parse_full'''
+        if self.tx_hashes is None and self.tx_spans is not None:
+            self.tx_hashes = [self.txid(i) for i in range(len(self.tx_spans))]
+        return self.tx_hashes
+
     def serialize(self):
         '''Returns the 80 byte block header'''
+        result = ByteWriter()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the 80 byte block header to the ByteWriter buf'''
         # version - 4 bytes, little endian
-        result = int_to_little_endian(self.version, 4)
+        buf.write_u32le(self.version)
         # prev_block - 32 bytes, little endian
-        result += self.prev_block[::-1]
+        buf.write(self.prev_block[::-1])
         # merkle_root - 32 bytes, little endian
-        result += self.merkle_root[::-1]
+        buf.write(self.merkle_root[::-1])
         # timestamp - 4 bytes, little endian
-        result += int_to_little_endian(self.timestamp, 4)
+        buf.write_u32le(self.timestamp)
         # bits - 4 bytes
-        result += self.bits
+        buf.write(self.bits)
         # nonce - 4 bytes
-        result += self.nonce
-        return result
+        buf.write(self.nonce)
+
+    def serialized_size(self):
+        return 80
 
     def hash(self):
         '''Returns the double-sha256 interpreted little endian of the block'''
@@ -131,20 +263,18 @@ class Block:
 
     def target(self):
         '''Returns the proof-of-work target based on the bits'''
-        # last byte is exponent
-        exponent = self.bits[-1]
-        # the first three bytes are the coefficient in little endian
-        coefficient = little_endian_to_int(self.bits[:-1])
-        # the formula is:
-        # coefficient * 2**(8*(exponent-3))
-        return coefficient * 2**(8*(exponent-3))
+        return bits_to_target(bytes(self.bits))
 
     def difficulty(self):
         '''Returns the block difficulty based on the bits'''
         # note difficulty is (target of lowest difficulty) / (self's target)
         # lowest difficulty has bits that equal 0xffff001d
-        lowest = 0xffff * 2**(8*(0x1d-3))
-        return lowest / self.target()
+        return MAX_TARGET / self.target()
+
+    def work(self):
+        '''Returns the expected number of hashes to find a block at this
+        target, what chainwork adds up'''
+        return bits_to_work(bytes(self.bits))
 
     def check_pow(self):
         '''Returns whether this block satisfies proof of work'''
@@ -159,8 +289,8 @@ class Block:
         '''Gets the merkle root of the tx_hashes and checks that it's
         the same as the merkle root of this block.
         '''
-        # reverse all the transaction hashes (self.tx_hashes)
-        hashes = [h[::-1] for h in self.tx_hashes]
+        # reverse all the transaction hashes (self.txids())
+        hashes = [h[::-1] for h in self.txids()]
         # get the Merkle Root
         root = merkle_root(hashes)
         # reverse the Merkle Root
@@ -174,8 +304,8 @@ class Block:
         # the bottom level and 1 the parent level of level 0 and so on.
         # initialize self.merkle_tree to be an empty list
         self.merkle_tree = []
-        # reverse all the transaction hashes (self.tx_hashes) store as current level
-        current_level = [h[::-1] for h in self.tx_hashes]
+        # reverse all the transaction hashes (self.txids()) store as current level
+        current_level = [h[::-1] for h in self.txids()]
         # if there is more than 1 hash:
         while len(current_level) > 1:
             # store current level in self.merkle_tree
@@ -188,7 +318,7 @@ class Block:
         if self.merkle_tree is None:
             self.calculate_merkle_tree()
         # find the index of this tx_hash
-        index = self.tx_hashes.index(tx_hash)
+        index = self.txids().index(tx_hash)
         # initialize merkle_proof list
         proof_hashes = []
         # initialize the current index to be the index at the base level
@@ -272,6 +402,15 @@ class BlockTest(TestCase):
         block = Block.parse(stream)
         self.assertEqual(block.target(), 0x13ce9000000000000000000000000000000000000000000)
         self.assertEqual(int(block.difficulty()), 888171856257)
+        self.assertEqual(block.work(), 2**256 // (0x13ce9000000000000000000000000000000000000000000 + 1))
+
+    def test_calculate_new_bits(self):
+        self.assertEqual(calculate_new_bits(unhexlify('54d80118'), 302400), unhexlify('00157617'))
+        # clamped to a factor of 4
+        self.assertEqual(calculate_new_bits(unhexlify('54d80118'), 1), unhexlify('00157617'))
+        # never easier than the lowest difficulty
+        self.assertEqual(calculate_new_bits(unhexlify('ffff001d'), TWO_WEEKS * 2), unhexlify('ffff001d'))
+        self.assertEqual(target_to_bits(bits_to_target(unhexlify('e93c0118'))), unhexlify('e93c0118'))
 
     def test_check_pow(self):
         block_raw = unhexlify('04000000fbedbbf0cfdaf278c094f187f2eb987c86a199da22bbb20400000000000000007b7697b29129648fa08b4bcd13c9d5e60abb973a1efac9c8d573c71c807c56c3d6213557faa80518c3737ec1')
@@ -304,6 +443,43 @@ class BlockTest(TestCase):
         block.tx_hashes = hashes
         self.assertTrue(block.validate_merkle_root())
 
+    def test_parse_full(self):
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, b'\x03\x01\x02\x03')],
+                      [TxOut(5000000000, p2pkh_script(bytes(20)))], 0)
+        segwit = Tx(2, [TxIn(b'\x11' * 32, 3, b''), TxIn(b'\x22' * 32, 0, b'\x51', 5)],
+                    [TxOut(1000, b'\x00\x14' + bytes(20))], 99)
+        segwit.tx_ins[0].script_witness = [b'\x01' * 71, b'\x02' * 33]
+        legacy = Tx(1, [TxIn(b'\x33' * 32, 1, b'\x51')], [TxOut(2000, p2pkh_script(bytes(20)))], 7)
+        txs = [coinbase, segwit, legacy]
+        hashes = [tx.txid() for tx in txs]
+        root = merkle_root([h[::-1] for h in hashes])[::-1]
+        header = Block(0x20000000, b'\x00' * 32, root, 0x59a7771e, b'\xff\xff\x00\x1d', b'\x00' * 4)
+        raw = header.serialize() + bytes([len(txs)]) + b''.join(tx.serialize() for tx in txs)
+        stream = BytesIO(raw + b'trailing')
+        with mock.patch.object(Tx, 'parse', side_effect=AssertionError):
+            block = Block.parse_full(stream)
+            self.assertEqual(block.txid(1), hashes[1])
+            self.assertEqual(block.txids(), hashes)
+            self.assertTrue(block.validate_merkle_root())
+        self.assertEqual(stream.read(), b'trailing')
+        self.assertEqual(block.hash(), header.hash())
+        self.assertEqual(block.tx(2).serialize(), legacy.serialize())
+        self.assertEqual(block.tx(1).tx_ins[0].script_witness, segwit.tx_ins[0].script_witness)
+        self.assertIsNone(block.txs[0])
+        block.merkle_root = b'\x00' * 32
+        self.assertFalse(block.validate_merkle_root())
+        with self.assertRaises(RuntimeError):
+            Block.parse_full(raw[:-1])
+        # other streams are read up to the end of the block only
+        with tempfile.TemporaryFile() as f:
+            f.write(raw + b'trailing')
+            f.seek(0)
+            block = Block.parse_full(f)
+            self.assertEqual(f.read(), b'trailing')
+        self.assertEqual(block.raw, raw)
+        self.assertEqual(block.txids(), hashes)
+        self.assertEqual(block.tx(1).hash(), segwit.hash())
+
     def test_calculate_merkle_tree(self):
         hashes_hex = [
             'f54cb69e5dc1bd38ee6901e4ec2007a5030e14bdd60afb4d2f3428c88eea17c1',
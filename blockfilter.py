@@ -0,0 +1,229 @@
+from binascii import unhexlify
+from unittest import TestCase
+
+from block import Block
+from helper import decode_varint, double_sha256, encode_varint, p2pkh_script
+from tx import decode_columns
+
+
+# BIP158 basic filter parameters
+P = 19
+M = 784931
+MASK64 = 2**64 - 1
+
+
+def siphash(k0, k1, data):
+    '''Returns SipHash-2-4 of data keyed with the 64 bit integers k0, k1'''
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    size = len(data)
+    # the last block holds the leftover bytes and the length in its top byte
+    tail = size - size % 8
+    blocks = [int.from_bytes(data[i:i + 8], 'little') for i in range(0, tail, 8)]
+    blocks.append(int.from_bytes(data[tail:], 'little') | (size & 0xff) << 56)
+    # 2 rounds per block then 4, with the rotations written out as this
+    # runs for every filter item
+    rounds = [(m, 2) for m in blocks]
+    rounds.append((None, 4))
+    for m, count in rounds:
+        if m is None:
+            v2 ^= 0xff
+        else:
+            v3 ^= m
+        for _ in range(count):
+            v0 = (v0 + v1) & MASK64
+            v1 = ((v1 << 13) | (v1 >> 51)) & MASK64 ^ v0
+            v0 = ((v0 << 32) | (v0 >> 32)) & MASK64
+            v2 = (v2 + v3) & MASK64
+            v3 = ((v3 << 16) | (v3 >> 48)) & MASK64 ^ v2
+            v0 = (v0 + v3) & MASK64
+            v3 = ((v3 << 21) | (v3 >> 43)) & MASK64 ^ v0
+            v2 = (v2 + v1) & MASK64
+            v1 = ((v1 << 17) | (v1 >> 47)) & MASK64 ^ v2
+            v2 = ((v2 << 32) | (v2 >> 32)) & MASK64
+        if m is not None:
+            v0 ^= m
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+class GCSFilter:
+    '''Golomb-coded set of BIP158: the items are hashed into [0, n * m)
+    with SipHash keyed by the 16 byte key, sorted, and the differences
+    written Golomb-Rice coded with p bit remainders.'''
+
+    def __init__(self, key, n, encoded, p=P, m=M):
+        self.key = key
+        self.k0 = int.from_bytes(key[:8], 'little')
+        self.k1 = int.from_bytes(key[8:16], 'little')
+        self.n = n
+        self.encoded = encoded
+        self.p = p
+        self.m = m
+
+    def hash_items(self, items):
+        '''Returns the sorted values items map to in this filter'''
+        k0, k1, f = self.k0, self.k1, self.n * self.m
+        return sorted((siphash(k0, k1, item) * f) >> 64 for item in items)
+
+    @classmethod
+    def build(cls, key, items, p=P, m=M):
+        '''Returns the filter of the distinct byte strings in items'''
+        items = set(items)
+        gcs = cls(key, len(items), b'', p, m)
+        # unary quotient, a 0, then the remainder in p bits, as a bit string
+        remainder_format = '0{}b'.format(p)
+        bits = []
+        last = 0
+        for value in gcs.hash_items(items):
+            delta = value - last
+            last = value
+            bits.append('1' * (delta >> p) + '0' + format(delta & ((1 << p) - 1), remainder_format))
+        bits = ''.join(bits)
+        # pad to whole bytes with 0s
+        bits += '0' * (-len(bits) % 8)
+        gcs.encoded = int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+        return gcs
+
+    @classmethod
+    def parse(cls, key, raw, p=P, m=M):
+        '''Takes the serialized filter, the item count then the bits'''
+        n, offset = decode_varint(raw)
+        return cls(key, n, bytes(raw[offset:]), p, m)
+
+    def serialize(self):
+        return encode_varint(self.n) + self.encoded
+
+    def values(self):
+        '''Yields the hashed values in the filter, in increasing order'''
+        if self.n == 0:
+            return
+        bits = format(int.from_bytes(self.encoded, 'big'), '0{}b'.format(8 * len(self.encoded)))
+        p = self.p
+        find = bits.find
+        position = 0
+        value = 0
+        for _ in range(self.n):
+            end = find('0', position)
+            quotient = end - position
+            position = end + 1 + p
+            value += (quotient << p) | int(bits[end + 1:position], 2)
+            yield value
+
+    def match(self, item):
+        return self.match_any([item])
+
+    def match_any(self, items):
+        '''Returns whether any of items is in the filter, possibly a false
+        positive (about 1 in m per item). The queries are hashed and
+        sorted, then walked together with the filter in one pass.'''
+        if self.n == 0:
+            return False
+        queries = self.hash_items(items)
+        if not queries:
+            return False
+        i = 0
+        query = queries[0]
+        for value in self.values():
+            while query < value:
+                i += 1
+                if i == len(queries):
+                    return False
+                query = queries[i]
+            if query == value:
+                return True
+        return False
+
+
+def filter_key(block_hash):
+    '''Returns the siphash key of a block's filters, the first 16 bytes
+    of its hash as serialized (block_hash is in display order)'''
+    return block_hash[::-1][:16]
+
+
+def basic_filter_items(block, spent_scripts):
+    '''Returns the items of the basic filter of a block from parse_full:
+    every output scriptPubKey except OP_RETURN ones, and spent_scripts,
+    the scriptPubKeys of the outputs the block's inputs spend. Empty
+    scripts are left out.'''
+    items = set()
+    # the outputs are read straight from the block bytes
+    columns = decode_columns(memoryview(block.raw)[block.tx_spans[0][0]:])
+    for i in range(len(columns.out_amount)):
+        script = columns.script_pubkey(i)
+        if script and script[0] != 0x6a:
+            items.add(script)
+    for script in spent_scripts:
+        if script:
+            items.add(bytes(script))
+    return items
+
+
+def spent_scripts(block, testnet=False, prevouts=None):
+    '''Looks up the scriptPubKeys spent by the block's inputs with the
+    PrevoutProvider, for blocks without undo data at hand'''
+    scripts = []
+    for i in range(1, len(block.tx_spans)):
+        for tx_in in block.tx(i).tx_ins:
+            scripts.append(tx_in.script_pubkey(testnet, prevouts).serialize())
+    return scripts
+
+
+def build_basic_filter(block, spent_scripts):
+    '''Returns the BIP158 basic GCSFilter of a block from parse_full'''
+    return GCSFilter.build(filter_key(block.hash()), basic_filter_items(block, spent_scripts))
+
+
+def filter_header(gcs, prev_header=b'\x00' * 32):
+    '''Returns the filter header chaining gcs onto the previous block's
+    filter header, both in internal byte order'''
+    return double_sha256(double_sha256(gcs.serialize()) + prev_header)
+
+
+class BlockFilterTest(TestCase):
+
+    def test_siphash(self):
+        key = bytes(range(16))
+        k0 = int.from_bytes(key[:8], 'little')
+        k1 = int.from_bytes(key[8:], 'little')
+        # from the SipHash paper's reference vectors
+        self.assertEqual(siphash(k0, k1, b''), 0x726fdb47dd0e0e31)
+        self.assertEqual(siphash(k0, k1, bytes(range(15))), 0xa129ca6149be45e5)
+        self.assertEqual(siphash(k0, k1, bytes(range(8))), 0x93f5f5799a932462)
+
+    def test_testnet_genesis(self):
+        # BIP158 test vector for block 0 of testnet3
+        raw = unhexlify('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae180101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+        block = Block.parse_full(raw)
+        self.assertEqual(block.hash(), unhexlify('000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943'))
+        gcs = build_basic_filter(block, [])
+        self.assertEqual(gcs.serialize(), unhexlify('019dfca8'))
+        header = filter_header(gcs)
+        self.assertEqual(header[::-1], unhexlify('21584579b7eb08997773e5aeff3a7f932700042d0ed2a6129012b7d7ae81b750'))
+        self.assertTrue(gcs.match(block.tx(0).tx_outs[0].script_pubkey.serialize()))
+        parsed = GCSFilter.parse(filter_key(block.hash()), gcs.serialize())
+        self.assertEqual(list(parsed.values()), list(gcs.values()))
+
+    def test_match_any(self):
+        key = bytes(range(16))
+        scripts = [p2pkh_script(i.to_bytes(20, 'big')) for i in range(1000)]
+        gcs = GCSFilter.parse(key, GCSFilter.build(key, scripts[:500] + [b'\x6a']).serialize())
+        self.assertEqual(gcs.n, 501)
+        self.assertEqual(list(gcs.values()), gcs.hash_items(scripts[:500] + [b'\x6a']))
+        for script in scripts[:500:50]:
+            self.assertTrue(gcs.match(script))
+        self.assertTrue(gcs.match_any(scripts[500:] + [scripts[123]]))
+        # 500 scripts not in the filter, a false positive is about 1 in 1500
+        self.assertFalse(gcs.match_any(scripts[500:]))
+        self.assertFalse(gcs.match_any([]))
+        empty = GCSFilter.build(key, [])
+        self.assertEqual(empty.serialize(), b'\x00')
+        self.assertFalse(empty.match(scripts[0]))
+
+    def test_basic_filter_items(self):
+        raw = unhexlify('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae180101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+        block = Block.parse_full(raw)
+        coinbase_script = block.tx(0).tx_outs[0].script_pubkey.serialize()
+        spent = [p2pkh_script(bytes(20)), b'', coinbase_script]
+        self.assertEqual(basic_filter_items(block, spent), {coinbase_script, p2pkh_script(bytes(20))})
@@ -0,0 +1,437 @@
+from array import array
+from binascii import unhexlify
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase, mock
+
+import os
+import shutil
+import tempfile
+
+from block import MAX_TARGET, Block, bits_to_target, bits_to_work, calculate_new_bits
+from helper import U32LE, double_sha256, double_sha256_batch
+
+
+GENESIS_HEADER = unhexlify('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
+
+
+class HeaderChain:
+    '''Block headers linked by prev_block, with the best chain being the
+    one with the most cumulative work.
+
+    Every header accepted, forks included, is a record: its 80 bytes in
+    the headers bytearray, the record of its parent and its height. best
+    maps a height to the record on the best chain, so lookups by height
+    are a single index, and works holds the chainwork up to each height
+    of the best chain as 32 big endian bytes. Headers off the best chain
+    keep theirs in side_works. Block hashes aren't stored: slots is an
+    open addressing table of records placed by a 4 byte tag of their
+    hash, and a probe hashes the header again when the tags match. That
+    keeps a header at about 140 bytes, half of what a dict of hashes
+    takes. If path is given, accepted headers are appended to
+    path/headers.dat and read back on the next start.
+
+    Headers are checked for proof of work, for a timestamp after the
+    median of the previous 11 and, if retarget is True, for the bits
+    of the 2016 block difficulty periods, with targets capped at
+    pow_limit. With retarget=False bits may change at any header, as
+    long as their target is within pow_limit, so testnet's minimum
+    difficulty blocks are accepted, with less checking than a node
+    does.'''
+
+    def __init__(self, genesis=GENESIS_HEADER, path=None, retarget=True, pow_limit=MAX_TARGET):
+        self.headers = bytearray()
+        self.parents = array('i')
+        self.heights = array('I')
+        self.tags = array('I')
+        self.slots = array('i', [-1]) * 1024
+        self.works = bytearray()
+        self.side_works = {}
+        self.best = array('i')
+        # headers mostly build on the one added last
+        self.last_hash = None
+        self.file = None
+        self.retarget = retarget
+        self.pow_limit = pow_limit
+        genesis = bytes(genesis)
+        self._add(genesis, double_sha256(genesis)[::-1], -1, bits_to_work(genesis[72:76]))
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            filename = os.path.join(path, 'headers.dat')
+            open(filename, 'ab').close()
+            with open(filename, 'rb') as f:
+                data = f.read()
+            # a torn record from a crash is dropped
+            usable = len(data) - len(data) % 80
+            for start in range(0, usable, 80):
+                # accepted before, the proof of work was checked then
+                self.add(data[start:start + 80], check=False)
+            self.file = open(filename, 'r+b')
+            self.file.truncate(usable)
+            self.file.seek(usable)
+
+    def __len__(self):
+        '''Number of headers on the best chain'''
+        return len(self.best)
+
+    def __contains__(self, block_hash):
+        return self.find(block_hash) is not None
+
+    def _place(self, record):
+        mask = len(self.slots) - 1
+        slot = self.tags[record] & mask
+        while self.slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        self.slots[slot] = record
+
+    def find(self, block_hash):
+        '''Returns the record of block_hash, None if unknown'''
+        if block_hash == self.last_hash:
+            return len(self.parents) - 1
+        # the last bytes are the first sha256 output bytes, the ones proof
+        # of work doesn't zero
+        tag = U32LE.unpack_from(block_hash, 28)[0]
+        mask = len(self.slots) - 1
+        slot = tag & mask
+        while True:
+            record = self.slots[slot]
+            if record < 0:
+                return None
+            if self.tags[record] == tag and \
+               double_sha256(self.headers[80 * record:80 * record + 80])[::-1] == block_hash:
+                return record
+            slot = (slot + 1) & mask
+
+    def _add(self, raw, block_hash, parent, work):
+        '''Stores a header doing work as a new record, off the best chain
+        unless it is the genesis. Returns the record.'''
+        record = len(self.parents)
+        if parent >= 0:
+            work += self.chainwork(parent)
+            height = self.heights[parent] + 1
+        else:
+            height = 0
+        self.headers += raw
+        self.parents.append(parent)
+        self.heights.append(height)
+        self.tags.append(U32LE.unpack_from(block_hash, 28)[0])
+        self.last_hash = block_hash
+        # kept at most half full, so probes stay short
+        if 2 * len(self.tags) > len(self.slots):
+            self.slots = array('i', [-1]) * (2 * len(self.slots))
+            for r in range(len(self.tags)):
+                self._place(r)
+        else:
+            self._place(record)
+        if parent < 0:
+            self.best.append(record)
+            self.works += work.to_bytes(32, 'big')
+        else:
+            self.side_works[record] = work
+        return record
+
+    def _time(self, record):
+        # timestamp is bytes 68 to 72
+        return U32LE.unpack_from(self.headers, 80 * record + 68)[0]
+
+    def on_best(self, record):
+        height = self.heights[record]
+        return height < len(self.best) and self.best[height] == record
+
+    def ancestor(self, record, height):
+        '''Returns the record at height on the branch ending in record'''
+        if self.on_best(record):
+            return self.best[height]
+        while self.heights[record] > height:
+            record = self.parents[record]
+        return record
+
+    def median_time_past(self, record):
+        '''Returns the median timestamp of record and the 10 before it'''
+        height = self.heights[record]
+        if self.on_best(record):
+            records = self.best[max(0, height - 10):height + 1]
+        else:
+            records = [record]
+            while len(records) < 11 and self.parents[records[-1]] >= 0:
+                records.append(self.parents[records[-1]])
+        times = sorted(self._time(r) for r in records)
+        return times[len(times) // 2]
+
+    def next_bits(self, parent):
+        '''Returns the bits a header building on parent needs'''
+        bits = bytes(self.headers[80 * parent + 72:80 * parent + 76])
+        height = self.heights[parent] + 1
+        if not self.retarget or height % 2016 != 0:
+            return bits
+        first = self.ancestor(parent, height - 2016)
+        return calculate_new_bits(bits, self._time(parent) - self._time(first), self.pow_limit)
+
+    def check(self, raw, block_hash, parent):
+        '''Raises RuntimeError unless the header raw hashing to block_hash
+        is valid on top of the record parent'''
+        # bits are bytes 72 to 76
+        bits = raw[72:76]
+        if self.retarget:
+            # checked first, so only bits the chain expects reach the
+            # cache in bits_to_target
+            if bits != self.next_bits(parent):
+                raise RuntimeError('bad bits for {}'.format(block_hash.hex()))
+        elif bits_to_target(bits) > self.pow_limit:
+            raise RuntimeError('bad bits for {}'.format(block_hash.hex()))
+        if int.from_bytes(block_hash, 'big') >= bits_to_target(bits):
+            raise RuntimeError('bad proof of work for {}'.format(block_hash.hex()))
+        if U32LE.unpack_from(raw, 68)[0] <= self.median_time_past(parent):
+            raise RuntimeError('timestamp too early for {}'.format(block_hash.hex()))
+
+    def chainwork(self, record=None):
+        '''Returns the cumulative work up to a record, the tip by default'''
+        if record is None:
+            record = self.best[-1]
+        if not self.on_best(record):
+            return self.side_works[record]
+        height = self.heights[record]
+        return int.from_bytes(self.works[32 * height:32 * height + 32], 'big')
+
+    def add(self, header, check=True):
+        '''Adds a Block or its 80 byte serialization. The parent has to be
+        known. Returns whether the best tip changed.'''
+        raw = header.serialize() if isinstance(header, Block) else bytes(header)
+        return self._insert(raw, double_sha256(raw)[::-1], check)
+
+    def add_headers(self, buf, check=True, workers=None):
+        '''Adds a buffer of 80 byte headers, each building on a known
+        header or one before it in buf. They are hashed up front with
+        double_sha256_batch. Raises RuntimeError at the first invalid
+        header, keeping the ones before it. Returns whether the best tip
+        changed.'''
+        view = memoryview(buf)
+        hashes = double_sha256_batch(view, 80, workers=workers)
+        changed = False
+        for i in range(0, len(view), 80):
+            raw = bytes(view[i:i + 80])
+            block_hash = hashes[32 * i // 80:32 * i // 80 + 32][::-1]
+            changed = self._insert(raw, block_hash, check) or changed
+        return changed
+
+    def _insert(self, raw, block_hash, check):
+        if self.find(block_hash) is not None:
+            return False
+        # prev_block is bytes 4 to 36, little endian
+        parent = self.find(raw[4:36][::-1])
+        if parent is None:
+            raise RuntimeError('unknown parent for {}'.format(block_hash.hex()))
+        if check:
+            self.check(raw, block_hash, parent)
+        record = self._add(raw, block_hash, parent, bits_to_work(raw[72:76]))
+        if self.file is not None:
+            self.file.write(raw)
+            self.file.flush()
+        # ties keep the tip seen first
+        if self.chainwork(record) <= self.chainwork():
+            return False
+        self._reorg(record)
+        return True
+
+    def add_many(self, headers, check=True):
+        '''Adds headers in order, as from a headers message. Returns
+        whether the best tip changed.'''
+        changed = False
+        for header in headers:
+            changed = self.add(header, check) or changed
+        return changed
+
+    def _reorg(self, record):
+        '''Makes record the best tip'''
+        # walk back to where the new branch meets the best chain
+        branch = []
+        while not self.on_best(record):
+            branch.append(record)
+            record = self.parents[record]
+        fork = self.heights[record] + 1
+        # the headers it replaces keep their chainwork off the best chain
+        for height in range(fork, len(self.best)):
+            self.side_works[self.best[height]] = \
+                int.from_bytes(self.works[32 * height:32 * height + 32], 'big')
+        del self.best[fork:]
+        del self.works[32 * fork:]
+        for record in reversed(branch):
+            self.best.append(record)
+            self.works += self.side_works.pop(record).to_bytes(32, 'big')
+
+    def height(self, block_hash=None):
+        '''Returns the height of the tip, or of block_hash if given
+        (None if unknown)'''
+        if block_hash is None:
+            return len(self.best) - 1
+        record = self.find(block_hash)
+        return None if record is None else self.heights[record]
+
+    def is_best(self, block_hash):
+        '''Returns whether block_hash is on the best chain'''
+        record = self.find(block_hash)
+        return record is not None and self.on_best(record)
+
+    def raw_header(self, height):
+        '''Returns the 80 bytes of the best chain header at height'''
+        record = self.best[height]
+        return bytes(self.headers[80 * record:80 * record + 80])
+
+    def header(self, height):
+        '''Returns the best chain header at height as a Block'''
+        return Block.parse(self.raw_header(height))
+
+    def hash_at(self, height):
+        return double_sha256(self.raw_header(height))[::-1]
+
+    def tip(self):
+        return self.header(-1)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def mine_header(prev_block, timestamp, bits=b'\xff\xff\x7f\x20', version=1):
+    '''Returns a header on prev_block meeting the bits, for testing with
+    easy targets'''
+    nonce = 0
+    while True:
+        block = Block(version, prev_block, b'\x00' * 32, timestamp, bits, nonce.to_bytes(4, 'little'))
+        if block.check_pow():
+            return block
+        nonce += 1
+
+
+class HeaderChainTest(TestCase):
+
+    # regtest genesis, its target is easy enough to mine in tests
+    genesis = unhexlify('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff7f2002000000')
+
+    def extend(self, chain, prev_block, count, timestamp):
+        hashes = []
+        for i in range(count):
+            header = mine_header(prev_block, timestamp + i)
+            chain.add(header)
+            prev_block = header.hash()
+            hashes.append(prev_block)
+        return hashes
+
+    def test_mainnet_genesis(self):
+        chain = HeaderChain()
+        want = unhexlify('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
+        self.assertEqual(chain.hash_at(0), want)
+        self.assertEqual(chain.height(), 0)
+        self.assertEqual(chain.chainwork(), 0x100010001)
+
+    def test_extend(self):
+        chain = HeaderChain(self.genesis)
+        genesis_hash = chain.hash_at(0)
+        hashes = self.extend(chain, genesis_hash, 5, 1296688700)
+        self.assertEqual(len(chain), 6)
+        self.assertEqual(chain.height(), 5)
+        self.assertEqual(chain.tip().hash(), hashes[-1])
+        self.assertEqual(chain.hash_at(3), hashes[2])
+        self.assertEqual(chain.height(hashes[2]), 3)
+        self.assertEqual(chain.header(4).prev_block, hashes[2])
+        self.assertEqual(chain.chainwork(), 6 * 2)
+        # already known
+        self.assertFalse(chain.add(chain.raw_header(2)))
+        with self.assertRaises(RuntimeError):
+            chain.add(mine_header(b'\x01' * 32, 1296689000))
+        bad = mine_header(hashes[-1], 1296689000)
+        bad.bits = b'\xff\xff\x00\x1d'
+        # unexpected bits are rejected before their target is computed
+        with mock.patch('chain.bits_to_target', wraps=bits_to_target) as targets:
+            with self.assertRaisesRegex(RuntimeError, 'bad bits'):
+                chain.add(bad)
+            self.assertEqual(targets.call_count, 0)
+
+    def test_add_headers(self):
+        pow_limit = 0x7fffff * 2**(8*(0x20-3))
+        chain = HeaderChain(self.genesis, pow_limit=pow_limit)
+        start = chain.tip().timestamp
+        bits = chain.tip().bits
+        buf = bytearray()
+        prev_block = chain.hash_at(0)
+        for height in range(1, 2016):
+            header = mine_header(prev_block, start + 300 * height)
+            buf += header.serialize()
+            prev_block = header.hash()
+        # hashed by two worker processes
+        with mock.patch('helper.BATCH_HASH_THRESHOLD', 1000), \
+             mock.patch('helper.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+            self.assertTrue(chain.add_headers(buf, workers=2))
+        pool.assert_called_once_with(max_workers=2)
+        self.assertEqual(chain.height(), 2015)
+        self.assertEqual(chain.hash_at(2015), prev_block)
+        # the hash index grew past its first 1024 slots
+        self.assertEqual(chain.height(chain.hash_at(700)), 700)
+        # a hash sharing the tag of a known one isn't found
+        self.assertIsNone(chain.height(b'\x00' * 28 + prev_block[28:]))
+        # the period took half as long as it should, the target halves
+        new_bits = calculate_new_bits(bits, 300 * 2015, pow_limit)
+        self.assertAlmostEqual(bits_to_target(bits) / bits_to_target(new_bits), 2, places=2)
+        with self.assertRaises(RuntimeError):
+            chain.add(mine_header(prev_block, start + 300 * 2016, bits))
+        # not after the median of the last 11 timestamps
+        with self.assertRaises(RuntimeError):
+            chain.add(mine_header(prev_block, start + 300 * 2010, new_bits))
+        self.assertTrue(chain.add(mine_header(prev_block, start + 300 * 2010 + 1, new_bits)))
+        self.assertEqual(chain.height(), 2016)
+        # later headers keep the bits
+        with self.assertRaises(RuntimeError):
+            chain.add(mine_header(chain.hash_at(2016), start + 300 * 2017, bits))
+
+    def test_no_retarget(self):
+        pow_limit = 0x7fffff * 2**(8*(0x20-3))
+        chain = HeaderChain(self.genesis, retarget=False, pow_limit=pow_limit)
+        start = chain.tip().timestamp
+        # harder bits, then back to the easiest allowed
+        harder = mine_header(chain.hash_at(0), start + 1, b'\xff\xff\x7f\x1f')
+        self.assertTrue(chain.add(harder))
+        self.assertTrue(chain.add(mine_header(harder.hash(), start + 2)))
+        self.assertEqual(chain.height(), 2)
+        self.assertEqual(chain.chainwork(), 2 + harder.work() + 2)
+        # but not easier than pow_limit
+        with self.assertRaisesRegex(RuntimeError, 'bad bits'):
+            chain.add(mine_header(chain.hash_at(2), start + 3, b'\xff\xff\x7f\x21'))
+
+    def test_reorg(self):
+        chain = HeaderChain(self.genesis)
+        main = self.extend(chain, chain.hash_at(0), 4, 1296688700)
+        # a fork from height 2 that first ties then overtakes
+        fork = self.extend(chain, main[1], 2, 1296689000)
+        self.assertEqual(chain.tip().hash(), main[-1])
+        self.assertFalse(chain.is_best(fork[0]))
+        self.assertEqual(chain.height(fork[1]), 4)
+        fork += self.extend(chain, fork[-1], 1, 1296689100)
+        self.assertEqual(chain.height(), 5)
+        self.assertEqual(chain.tip().hash(), fork[-1])
+        self.assertEqual([chain.hash_at(h) for h in range(1, 6)], main[:2] + fork)
+        self.assertTrue(chain.is_best(main[1]))
+        self.assertFalse(chain.is_best(main[2]))
+        # the replaced headers keep their chainwork
+        self.assertEqual(chain.chainwork(chain.find(main[-1])), 5 * 2)
+        self.assertEqual(chain.chainwork(), 6 * 2)
+
+    def test_persist(self):
+        path = tempfile.mkdtemp()
+        try:
+            chain = HeaderChain(self.genesis, path)
+            main = self.extend(chain, chain.hash_at(0), 3, 1296688700)
+            fork = self.extend(chain, main[0], 3, 1296689000)
+            chain.close()
+            with open(os.path.join(path, 'headers.dat'), 'ab') as f:
+                f.write(b'\x00' * 40)
+            chain = HeaderChain(self.genesis, path)
+            self.assertEqual(chain.tip().hash(), fork[-1])
+            self.assertEqual(chain.height(main[-1]), 3)
+            more = self.extend(chain, fork[-1], 1, 1296689100)
+            chain.close()
+            self.assertEqual(os.path.getsize(os.path.join(path, 'headers.dat')), 7 * 80)
+            chain = HeaderChain(self.genesis, path)
+            self.assertEqual(chain.tip().hash(), more[-1])
+            chain.close()
+        finally:
+            shutil.rmtree(path)
@@ -1,9 +1,8 @@
 from binascii import hexlify, unhexlify
-from io import BytesIO
 from random import randint
 from unittest import TestCase
 
-from helper import double_sha256, encode_base58, encode_base58_checksum, hash160, decode_base58_checksum, big_endian_to_int
+from helper import ByteReader, double_sha256, encode_base58, encode_base58_checksum, hash160, decode_base58_checksum, big_endian_to_int
 
 
 class FieldElement:
@@ -650,23 +649,23 @@ class Signature:
 
     @classmethod
     def parse(cls, signature_bin):
-        s = BytesIO(signature_bin)
-        compound = s.read(1)[0]
+        reader = ByteReader(signature_bin)
+        compound = reader.read_u8()
         if compound != 0x30:
             raise RuntimeError("Bad Signature")
-        length = s.read(1)[0]
+        length = reader.read_u8()
         if length + 2 != len(signature_bin):
             raise RuntimeError("Bad Signature Length")
-        marker = s.read(1)[0]
+        marker = reader.read_u8()
         if marker != 0x02:
             raise RuntimeError("Bad Signature")
-        rlength = s.read(1)[0]
-        r = int(hexlify(s.read(rlength)), 16)
-        marker = s.read(1)[0]
+        rlength = reader.read_u8()
+        r = int.from_bytes(reader.read_bytes_view(rlength), 'big')
+        marker = reader.read_u8()
         if marker != 0x02:
             raise RuntimeError("Bad Signature")
-        slength = s.read(1)[0]
-        s = int(hexlify(s.read(slength)), 16)
+        slength = reader.read_u8()
+        s = int.from_bytes(reader.read_bytes_view(slength), 'big')
         if len(signature_bin) != 6 + rlength + slength:
             raise RuntimeError("Signature too long")
         return cls(r, s)
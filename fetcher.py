@@ -0,0 +1,330 @@
+from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from urllib.parse import urlsplit
+
+import asyncio
+import json
+import ssl
+import threading
+import time
+
+from prevout import PrevoutProvider
+
+
+class FetchError(RuntimeError):
+    '''The server could not give us the transaction'''
+
+
+class Connection:
+    '''One keep-alive HTTP/1.1 connection'''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    async def get(self, host, path):
+        '''Sends a GET and returns (status, body). Raises ConnectionError
+        if the server closed the connection.'''
+        request = 'GET {} HTTP/1.1\r\nHost: {}\r\nAccept: application/json\r\n' \
+                  'Connection: keep-alive\r\n\r\n'.format(path, host)
+        self.writer.write(request.encode('ascii'))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+            body = bytes(body)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            # the body runs until the server closes the connection
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+            self.writer = None
+        return status, body
+
+
+class TxFetcher:
+    '''Fetches raw transactions from a block explorer's /rawtx endpoint
+    over at most max_connections keep-alive connections. Lookups of a tx
+    hash that is already being fetched wait for that request instead of
+    sending another. Failed requests are retried up to retries times,
+    waiting backoff, 2 * backoff, ... seconds in between.
+
+    Use it from a single event loop.'''
+
+    def __init__(self, url, max_connections=8, retries=3, backoff=0.2, timeout=30):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.base_path = parts.path.rstrip('/')
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.idle = []
+        self.semaphore = None
+        self.in_flight = {}
+
+    async def _connect(self):
+        ssl_context = ssl.create_default_context() if self.https else None
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+        return Connection(reader, writer)
+
+    async def _request(self, path):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        async with self.semaphore:
+            while self.idle:
+                # reuse a kept-alive connection, a stale one fails on use
+                connection = self.idle.pop()
+                try:
+                    status, body = await asyncio.wait_for(
+                        connection.get(self.host, path), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    continue
+                except BaseException:
+                    connection.close()
+                    raise
+                break
+            else:
+                connection = await self._connect()
+                try:
+                    status, body = await asyncio.wait_for(
+                        connection.get(self.host, path), self.timeout)
+                except BaseException:
+                    connection.close()
+                    raise
+            if connection.writer is not None:
+                self.idle.append(connection)
+        return status, body
+
+    async def _fetch(self, tx_hash):
+        path = '{}/rawtx/{}'.format(self.base_path, hexlify(tx_hash).decode('ascii'))
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                status, body = await self._request(path)
+                if status == 200:
+                    js_response = json.loads(body)
+                    if 'rawtx' not in js_response:
+                        raise FetchError('got from server: {}'.format(js_response))
+                    return unhexlify(js_response['rawtx'])
+                if status < 500 and status != 429:
+                    raise FetchError('got status {} for {}'.format(status, path))
+                error = FetchError('got status {} for {}'.format(status, path))
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                error = e
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        raise FetchError('giving up on {}: {}'.format(path, error))
+
+    async def fetch(self, tx_hash):
+        '''Returns the raw transaction for tx_hash'''
+        if tx_hash not in self.in_flight:
+            task = asyncio.ensure_future(self._fetch(tx_hash))
+            task.add_done_callback(lambda _: self.in_flight.pop(tx_hash, None))
+            self.in_flight[tx_hash] = task
+        # shield so one cancelled caller doesn't cancel the shared request
+        return await asyncio.shield(self.in_flight[tx_hash])
+
+    async def fetch_many(self, tx_hashes):
+        '''Returns a dict of tx hash to raw transaction'''
+        tx_hashes = list(dict.fromkeys(tx_hashes))
+        raws = await asyncio.gather(*[self.fetch(tx_hash) for tx_hash in tx_hashes])
+        return dict(zip(tx_hashes, raws))
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+class AsyncHttpPrevoutProvider(PrevoutProvider):
+    '''PrevoutProvider that fetches batches concurrently with TxFetcher,
+    so Tx.prefetch costs about one round trip instead of one per input.
+
+    Lookups run their own event loop. Called from a thread that is
+    already running one, they run on a worker thread and block the
+    calling loop until done; await TxFetcher there instead.'''
+
+    def __init__(self, url='https://btc-bitcore3.trezor.io/api',
+                 testnet_url='https://testnet.blockexplorer.com/api', **kwargs):
+        self.urls = {False: url, True: testnet_url}
+        self.kwargs = kwargs
+
+    def raw_txs(self, tx_hashes, testnet=False):
+        async def run():
+            fetcher = TxFetcher(self.urls[testnet], **self.kwargs)
+            try:
+                return await fetcher.fetch_many(tx_hashes)
+            finally:
+                fetcher.close()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(run())
+        # asyncio.run can't nest in a running loop
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, run()).result()
+
+    def raw_tx(self, tx_hash, testnet=False):
+        return self.raw_txs([tx_hash], testnet)[tx_hash]
+
+
+class RawTxServer(ThreadingHTTPServer):
+    '''Stand-in block explorer for the tests. Counts connections and
+    requests, fails the first failures[tx] requests for a tx with a 503
+    and answers after delay seconds.'''
+
+    daemon_threads = True
+
+    def __init__(self, txs):
+        super().__init__(('127.0.0.1', 0), RawTxHandler)
+        self.txs = {hexlify(k).decode('ascii'): hexlify(v).decode('ascii') for k, v in txs.items()}
+        self.failures = {}
+        self.delay = 0
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+
+class RawTxHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        tx_hash = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.requests.append(tx_hash)
+            failures = self.server.failures.get(tx_hash, 0)
+            self.server.failures[tx_hash] = failures - 1
+        time.sleep(self.server.delay)
+        if failures > 0:
+            status, body = 503, {'error': 'busy'}
+        elif tx_hash in self.server.txs:
+            status, body = 200, {'rawtx': self.server.txs[tx_hash]}
+        else:
+            status, body = 404, {'error': 'not found'}
+        payload = json.dumps(body).encode('ascii')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TxFetcherTest(TestCase):
+
+    txs = {bytes([i]) * 32: b'raw tx %d' % i for i in range(20)}
+
+    def setUp(self):
+        self.server = RawTxServer(self.txs)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/api'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def run_fetcher(self, coroutine_function, **kwargs):
+        async def run():
+            fetcher = TxFetcher(self.url, **kwargs)
+            try:
+                return await coroutine_function(fetcher)
+            finally:
+                fetcher.close()
+        return asyncio.run(run())
+
+    def test_fetch_many(self):
+        result = self.run_fetcher(lambda f: f.fetch_many(list(self.txs)), max_connections=4)
+        self.assertEqual(result, self.txs)
+        self.assertEqual(len(self.server.requests), 20)
+        # 20 requests over a pool of at most 4 kept-alive connections
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_coalescing(self):
+        self.server.delay = 0.1
+        tx_hash = b'\x05' * 32
+
+        async def lookups(fetcher):
+            return await asyncio.gather(*[fetcher.fetch(tx_hash) for _ in range(10)])
+        self.assertEqual(self.run_fetcher(lookups), [self.txs[tx_hash]] * 10)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retries(self):
+        tx_hash = b'\x07' * 32
+        self.server.failures[hexlify(tx_hash).decode('ascii')] = 2
+        raw = self.run_fetcher(lambda f: f.fetch(tx_hash), retries=2, backoff=0.01)
+        self.assertEqual(raw, self.txs[tx_hash])
+        self.assertEqual(len(self.server.requests), 3)
+        self.server.failures[hexlify(tx_hash).decode('ascii')] = 5
+        with self.assertRaises(FetchError):
+            self.run_fetcher(lambda f: f.fetch(tx_hash), retries=2, backoff=0.01)
+        # not found is not retried
+        self.server.requests = []
+        with self.assertRaises(FetchError):
+            self.run_fetcher(lambda f: f.fetch(b'\xff' * 32), retries=2, backoff=0.01)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_provider(self):
+        provider = AsyncHttpPrevoutProvider(self.url, self.url)
+        self.assertEqual(provider.raw_tx(b'\x01' * 32), self.txs[b'\x01' * 32])
+        self.assertEqual(provider.raw_txs(list(self.txs)[:5]), dict(list(self.txs.items())[:5]))
+
+    def test_provider_in_running_loop(self):
+        provider = AsyncHttpPrevoutProvider(self.url, self.url)
+
+        async def lookup():
+            return provider.raw_tx(b'\x02' * 32)
+        self.assertEqual(asyncio.run(lookup()), self.txs[b'\x02' * 32])
+
+    def test_reused_connection_closed_on_timeout(self):
+        async def lookups(fetcher):
+            await fetcher.fetch(b'\x01' * 32)
+            connection = fetcher.idle[0]
+            self.server.delay = 0.2
+            with self.assertRaises(FetchError):
+                await fetcher.fetch(b'\x02' * 32)
+            self.assertEqual(fetcher.idle, [])
+            return connection.writer.is_closing()
+        self.assertTrue(self.run_fetcher(lookups, retries=0, timeout=0.05))
@@ -1,14 +1,32 @@
 from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from subprocess import check_output
-from unittest import TestCase, TestSuite, TextTestRunner
+from unittest import TestCase, TestSuite, TextTestRunner, mock
 
 import hashlib
 import math
+import os
+import struct
+import tempfile
+import weakref
 
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
+# batches smaller than this are hashed in the calling process. hashlib
+# holds the GIL for short inputs, so only processes hash records in
+# parallel, and starting them costs about as much as hashing this many.
+BATCH_HASH_THRESHOLD = 1 << 16
+# precompiled little-endian codecs for the fixed-width integer fields
+U8 = struct.Struct('<B')
+U16LE = struct.Struct('<H')
+U32LE = struct.Struct('<I')
+U64LE = struct.Struct('<Q')
+LE_CODECS = {1: U8, 2: U16LE, 4: U32LE, 8: U64LE}
 BASE58_ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 
@@ -37,6 +55,83 @@ def sha256(s):
 def double_sha256(s):
     return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
+
+def _records(data, size):
+    '''Splits data into the list of items to hash. data is either a sequence
+    of byte strings or, when size is given, a contiguous buffer of size-byte
+    records which are sliced without copying'''
+    if size is None:
+        return data
+    view = memoryview(data)
+    if len(view) % size != 0:
+        raise RuntimeError('buffer length {} is not a multiple of {}'.format(len(view), size))
+    return [view[i:i+size] for i in range(0, len(view), size)]
+
+
+def _double_sha256_chunk(base, records):
+    result = bytearray()
+    for record in records:
+        h = base.copy()
+        h.update(record)
+        result += hashlib.sha256(h.digest()).digest()
+    return result
+
+
+def _hash160_chunk(base, records):
+    result = bytearray()
+    for record in records:
+        h = base.copy()
+        h.update(record)
+        result += hashlib.new('ripemd160', h.digest()).digest()
+    return result
+
+
+def _hash_records(chunk, prefix, data, size):
+    '''Hashes one chunk of a batch in a worker process'''
+    return bytes(chunk(hashlib.sha256(prefix), _records(data, size)))
+
+
+def _hash_batch(chunk, data, size, prefix, workers):
+    records = _records(data, size)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(records) < BATCH_HASH_THRESHOLD:
+        # sha256 state after the shared prefix, copied for every record
+        return bytes(chunk(hashlib.sha256(prefix), records))
+    step = -(-len(records) // workers)
+    if size is None:
+        chunks = [[bytes(r) for r in records[i:i+step]] for i in range(0, len(records), step)]
+    else:
+        # contiguous slices of the buffer pickle as one string each
+        view = memoryview(data)
+        chunks = [bytes(view[i*size:(i+step)*size]) for i in range(0, len(records), step)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return b''.join(pool.map(_hash_records, [chunk] * len(chunks), [prefix] * len(chunks),
+                                 chunks, [size] * len(chunks)))
+
+
+def double_sha256_batch(data, size=None, prefix=b'', workers=None):
+    '''Returns the double-sha256 of prefix + item for every item in data,
+    packed into one buffer of 32-byte digests in input order.
+    data is a sequence of byte strings or, if size is given, a buffer of
+    size-byte records. Large batches are spread over worker processes.
+    '''
+    return _hash_batch(_double_sha256_chunk, data, size, prefix, workers)
+
+
+def hash160_batch(data, size=None, prefix=b'', workers=None):
+    '''Returns the hash160 of prefix + item for every item in data,
+    packed into one buffer of 20-byte digests in input order.
+    Takes the same arguments as double_sha256_batch.
+    '''
+    return _hash_batch(_hash160_chunk, data, size, prefix, workers)
+
+
+def split_digests(buf, size):
+    '''Splits a packed digest buffer into a list of size-byte digests'''
+    return [bytes(buf[i:i+size]) for i in range(0, len(buf), size)]
+
+
 import functools
 count_prefix = lambda t, s: next((i for i,v in enumerate(s) if v != t), 0)
 count_zero = functools.partial(count_prefix, 0)
@@ -90,6 +185,8 @@ def decode_base58_checksum(s):
 
 def read_varint(s):
     '''read_varint reads a variable integer from a stream'''
+    if isinstance(s, (ByteReader, StreamReader)):
+        return s.read_varint()
     i = s.read(1)[0]
     if i == 0xfd:
         # 0xfd means the next two bytes are the number
@@ -105,16 +202,370 @@ def read_varint(s):
         return i
 
 
+class ByteReader:
+    '''Cursor over a memoryview of a byte buffer. Integers are unpacked in
+    place with precompiled structs and read_bytes_view returns slices of the
+    buffer without copying. read(n) keeps the stream interface so a reader
+    can be passed anywhere a BytesIO was.
+    '''
+
+    def __init__(self, data, offset=0):
+        self.view = memoryview(data)
+        self.offset = offset
+        # stream this reader was made from and its position at view[0]
+        self.stream = None
+        self.base = 0
+
+    @classmethod
+    def wrap(cls, s):
+        '''Returns a reader for s. A reader is returned as is, buffers and
+        BytesIO are read in place (a BytesIO from its current position) and
+        any other stream goes through a StreamReader, which reads from it
+        only what is parsed.
+        '''
+        if isinstance(s, (cls, StreamReader)):
+            return s
+        if isinstance(s, (bytes, bytearray, memoryview)):
+            return cls(s)
+        if isinstance(s, BytesIO):
+            reader = cls(s.getbuffer(), s.tell())
+            reader.stream = s
+            return reader
+        return StreamReader(s)
+
+    def sync(self, s):
+        '''Moves the stream this reader was made from to the first unread
+        byte and releases the buffer. Does nothing when s is the reader
+        itself, so nested parsers can all call it.
+        '''
+        if s is self:
+            return
+        if self.stream is not None:
+            self.stream.seek(self.base + self.offset)
+        self.view.release()
+
+    def tell(self):
+        return self.offset
+
+    def remaining(self):
+        return len(self.view) - self.offset
+
+    def _truncated(self, n):
+        return RuntimeError('need {} bytes, only {} left'.format(n, len(self.view) - self.offset))
+
+    def read_bytes_view(self, n):
+        '''Returns the next n bytes as a memoryview without copying'''
+        start = self.offset
+        end = start + n
+        if end > len(self.view):
+            raise self._truncated(n)
+        self.offset = end
+        return self.view[start:end]
+
+    def read(self, n):
+        '''Returns the next n bytes as bytes'''
+        return self.read_bytes_view(n).tobytes()
+
+    def peek(self, n):
+        '''Returns up to the next n bytes without moving the cursor'''
+        return self.view[self.offset:self.offset+n]
+
+    def slice(self, start, end):
+        '''Returns the bytes from offset start to end as bytes'''
+        return bytes(self.view[start:end])
+
+    def read_u8(self):
+        try:
+            value = self.view[self.offset]
+        except IndexError:
+            raise self._truncated(1)
+        self.offset += 1
+        return value
+
+    def read_u16le(self):
+        try:
+            value, = U16LE.unpack_from(self.view, self.offset)
+        except struct.error:
+            raise self._truncated(2)
+        self.offset += 2
+        return value
+
+    def read_u32le(self):
+        try:
+            value, = U32LE.unpack_from(self.view, self.offset)
+        except struct.error:
+            raise self._truncated(4)
+        self.offset += 4
+        return value
+
+    def read_u64le(self):
+        try:
+            value, = U64LE.unpack_from(self.view, self.offset)
+        except struct.error:
+            raise self._truncated(8)
+        self.offset += 8
+        return value
+
+    def read_varint(self):
+        try:
+            value, self.offset = decode_varint(self.view, self.offset)
+        except (IndexError, struct.error):
+            raise RuntimeError('varint is truncated, only {} bytes left'.format(len(self.view) - self.offset))
+        return value
+
+
+class StreamReader:
+    '''The ByteReader interface over a stream that can't be read in
+    place, such as a file or a socket. Bytes are read from the stream as
+    the parser asks for them, so nothing past the message being parsed is
+    consumed, except what peek looked at on a stream that can't seek.
+    What was read is kept for slice.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = bytearray()
+        # read position in buf, what is after it was only peeked at
+        self.offset = 0
+        self.base = stream.tell() if stream.seekable() else None
+
+    def _fill(self, n):
+        '''Reads until n bytes past the cursor are buffered or the stream
+        ends. Returns how many are.'''
+        missing = self.offset + n - len(self.buf)
+        while missing > 0:
+            data = self.stream.read(missing)
+            if not data:
+                break
+            self.buf += data
+            missing -= len(data)
+        return min(n, len(self.buf) - self.offset)
+
+    def sync(self, s):
+        '''Moves a seekable stream back to the first byte not read'''
+        if s is self:
+            return
+        if self.base is not None:
+            self.stream.seek(self.base + self.offset)
+
+    def tell(self):
+        return self.offset
+
+    def remaining(self):
+        '''Returns 0 at the end of the stream, else a positive number'''
+        return self._fill(1)
+
+    def read_bytes_view(self, n):
+        '''Returns the next n bytes, as bytes since the buffer grows'''
+        available = self._fill(n)
+        if available < n:
+            raise RuntimeError('need {} bytes, only {} left'.format(n, available))
+        start = self.offset
+        self.offset += n
+        return bytes(self.buf[start:self.offset])
+
+    read = read_bytes_view
+
+    def peek(self, n):
+        '''Returns up to the next n bytes without moving the cursor'''
+        self._fill(n)
+        return bytes(self.buf[self.offset:self.offset + n])
+
+    def slice(self, start, end):
+        '''Returns the bytes from offset start to end as bytes'''
+        return bytes(self.buf[start:end])
+
+    def read_u8(self):
+        return self.read_bytes_view(1)[0]
+
+    def read_u16le(self):
+        return U16LE.unpack(self.read_bytes_view(2))[0]
+
+    def read_u32le(self):
+        return U32LE.unpack(self.read_bytes_view(4))[0]
+
+    def read_u64le(self):
+        return U64LE.unpack(self.read_bytes_view(8))[0]
+
+    def read_varint(self):
+        i = self.read_u8()
+        if i < 0xfd:
+            return i
+        elif i == 0xfd:
+            return self.read_u16le()
+        elif i == 0xfe:
+            return self.read_u32le()
+        return self.read_u64le()
+
+
+class Watchers:
+    '''Objects to tell, through their touch(signed) method, that the
+    object holding this changed in place. signed says whether the change
+    is to something that gets signed; watchers added with signed=False
+    are always told False. Only weak references are kept.'''
+
+    __slots__ = ('refs',)
+
+    def __init__(self, watcher=None, signed=True):
+        self.refs = () if watcher is None else ((weakref.ref(watcher), signed),)
+
+    def add(self, watcher, signed=True):
+        refs = []
+        # drop dead watchers and watcher itself, if already there
+        for ref, ref_signed in self.refs:
+            current = ref()
+            if current is not None and current is not watcher:
+                refs.append((ref, ref_signed))
+        refs.append((weakref.ref(watcher), signed))
+        self.refs = tuple(refs)
+
+    def touch(self, signed=True):
+        for ref, ref_signed in self.refs:
+            watcher = ref()
+            if watcher is not None:
+                watcher.touch(signed and ref_signed)
+
+
+class WatchedList(list):
+    '''List that tells its Watchers when it is changed in place. added
+    is called with the items put in, for lists that watch their items.'''
+
+    __slots__ = ('watchers', '__weakref__')
+
+    def __init__(self, items=(), watcher=None, signed=True):
+        list.__init__(self, items)
+        self.watchers = Watchers(watcher, signed)
+        if self:
+            self.added(self)
+
+    def watch(self, watcher, signed=True):
+        self.watchers.add(watcher, signed)
+
+    def touch(self, signed=True):
+        self.watchers.touch(signed)
+
+    def added(self, items):
+        pass
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self.added(value)
+        else:
+            self.added((value,))
+        list.__setitem__(self, index, value)
+        self.touch()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def append(self, item):
+        self.added((item,))
+        list.append(self, item)
+        self.touch()
+
+    def extend(self, items):
+        items = list(items)
+        self.added(items)
+        list.extend(self, items)
+        self.touch()
+
+    def insert(self, index, item):
+        self.added((item,))
+        list.insert(self, index, item)
+        self.touch()
+
+    def _changed(method):
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self.touch()
+            return result
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    __delitem__ = _changed(list.__delitem__)
+    __imul__ = _changed(list.__imul__)
+    pop = _changed(list.pop)
+    remove = _changed(list.remove)
+    clear = _changed(list.clear)
+    reverse = _changed(list.reverse)
+    sort = _changed(list.sort)
+
+    del _changed
+
+
+class ByteWriter(bytearray):
+    '''Growable output buffer that serializers append to in place, so
+    building a transaction or block is linear in its size. It is a
+    bytearray, bytes(writer) gives the result.
+    '''
+
+    def write(self, b):
+        self += b
+
+    def write_u8(self, n):
+        self.append(n)
+
+    def write_u16le(self, n):
+        self += U16LE.pack(n)
+
+    def write_u32le(self, n):
+        self += U32LE.pack(n)
+
+    def write_u64le(self, n):
+        self += U64LE.pack(n)
+
+    def write_varint(self, n):
+        if n < 0xfd:
+            self.append(n)
+        elif n < 0x10000:
+            self.append(0xfd)
+            self += U16LE.pack(n)
+        elif n < 0x100000000:
+            self.append(0xfe)
+            self += U32LE.pack(n)
+        else:
+            self.append(0xff)
+            self += U64LE.pack(n)
+
+
+def decode_varint(buf, offset=0):
+    '''Decodes the varint at offset in buf (any bytes-like object)
+    Returns the value and the offset just past the varint'''
+    i = buf[offset]
+    if i < 0xfd:
+        return i, offset + 1
+    elif i == 0xfd:
+        return U16LE.unpack_from(buf, offset + 1)[0], offset + 3
+    elif i == 0xfe:
+        return U32LE.unpack_from(buf, offset + 1)[0], offset + 5
+    else:
+        return U64LE.unpack_from(buf, offset + 1)[0], offset + 9
+
+
+def varint_size(i):
+    '''Returns the number of bytes encode_varint(i) takes'''
+    if i < 0xfd:
+        return 1
+    elif i < 0x10000:
+        return 3
+    elif i < 0x100000000:
+        return 5
+    else:
+        return 9
+
+
 def encode_varint(i):
     '''encodes an integer as a varint'''
     if i < 0xfd:
-        return bytes([i])
+        return U8.pack(i)
     elif i < 0x10000:
-        return b'\xfd' + int_to_little_endian(i, 2)
+        return b'\xfd' + U16LE.pack(i)
     elif i < 0x100000000:
-        return b'\xfe' + int_to_little_endian(i, 4)
+        return b'\xfe' + U32LE.pack(i)
     elif i < 0x10000000000000000:
-        return b'\xff' + int_to_little_endian(i, 8)
+        return b'\xff' + U64LE.pack(i)
     else:
         raise RuntimeError('integer too large: {}'.format(i))
 
@@ -134,7 +585,10 @@ def flip_endian(h):
 def little_endian_to_int(b):
     '''little_endian_to_int takes byte sequence as a little-endian number.
     Returns an integer'''
-    # use the from_bytes method of int
+    codec = LE_CODECS.get(len(b))
+    if codec is not None:
+        return codec.unpack(b)[0]
+    # use the from_bytes method of int for other widths
     return int.from_bytes(b, 'little')
 
 def big_endian_to_int(b):
@@ -147,7 +601,14 @@ def big_endian_to_int(b):
 def int_to_little_endian(n, length):
     '''endian_to_little_endian takes an integer and returns the little-endian
     byte sequence of length'''
-    # use the to_bytes method of n
+    codec = LE_CODECS.get(length)
+    if codec is not None:
+        try:
+            return codec.pack(n)
+        except struct.error:
+            # out of range, let to_bytes raise the OverflowError
+            pass
+    # use the to_bytes method of n for other widths
     return n.to_bytes(length, 'little')
 
 
@@ -229,6 +690,184 @@ def merkle_path(index, total):
     return path
 
 
+class MerkleTree:
+    '''Merkle tree that is kept up to date as leaves are appended,
+    replaced or removed, for hashes in internal byte order like
+    merkle_root. levels[0] are the leaves and levels[k + 1] the parents
+    of the complete pairs in levels[k]. The right edge, where an odd node
+    gets paired with itself, is only folded in by root(), so appending
+    or replacing a leaf costs one hash per level.'''
+
+    def __init__(self, hashes=()):
+        self.levels = [[]]
+        for h in hashes:
+            self.append(h)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self, h):
+        self.levels[0].append(h)
+        k = 0
+        # every completed pair adds a node one level up
+        while len(self.levels[k]) % 2 == 0:
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            self.levels[k + 1].append(merkle_parent(self.levels[k][-2], self.levels[k][-1]))
+            k += 1
+
+    def extend(self, hashes):
+        '''Appends many leaves, hashing each level in one batch'''
+        self.levels[0].extend(hashes)
+        k = 0
+        while len(self.levels[k]) > 1:
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            level, parents = self.levels[k], self.levels[k + 1]
+            start, end = 2 * len(parents), len(level) - len(level) % 2
+            if start == end:
+                break
+            digests = double_sha256_batch(b''.join(level[start:end]), 64)
+            parents.extend(split_digests(digests, 32))
+            k += 1
+        while len(self.levels) > 1 and not self.levels[-1]:
+            self.levels.pop()
+
+    def replace(self, index, h):
+        '''Changes the leaf at index to h'''
+        self.levels[0][index] = h
+        for k in range(len(self.levels) - 1):
+            index //= 2
+            level = self.levels[k]
+            if 2 * index + 1 >= len(level):
+                # unpaired, there is nothing above to update
+                break
+            self.levels[k + 1][index] = merkle_parent(level[2 * index], level[2 * index + 1])
+
+    def truncate(self, size):
+        '''Drops the leaves from size on'''
+        for k, level in enumerate(self.levels):
+            del level[size >> k:]
+        while len(self.levels) > 1 and not self.levels[-1]:
+            self.levels.pop()
+
+    def remove(self, index):
+        '''Removes the leaf at index, the leaves after it move down one.
+        Costs a hash per leaf after it, removing the last one is cheap.'''
+        rest = self.levels[0][index + 1:]
+        self.truncate(index)
+        for h in rest:
+            self.append(h)
+
+    def root(self):
+        '''Returns the merkle root, what merkle_root(leaves) returns'''
+        if not self.levels[0]:
+            raise RuntimeError('no leaves')
+        # carry is the parent of the right edge not stored in the levels
+        carry = None
+        for level in self.levels:
+            size = len(level) + (carry is not None)
+            if size == 1:
+                return level[0] if carry is None else carry
+            if size % 2 == 1:
+                last = level[-1] if carry is None else carry
+                carry = merkle_parent(last, last)
+            elif carry is not None:
+                carry = merkle_parent(level[-1], carry)
+        return carry
+
+
+class TxCache:
+    '''LRU cache of serialized transactions keyed by tx hash, bounded by
+    max_entries and by max_bytes, an approximation of the memory used.
+    Values can be set as raw bytes or as objects with serialize(). Lookups
+    return parse(raw), reusing the last parsed_entries parsed objects so
+    repeated lookups of one transaction don't parse it each time.'''
+
+    # rough per-entry cost of the key, the dict slot and the bytes header
+    ENTRY_OVERHEAD = 160
+
+    def __init__(self, parse, max_entries=10000, max_bytes=64 * 1024 * 1024, parsed_entries=16):
+        self.parse = parse
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.parsed_entries = parsed_entries
+        self.raws = OrderedDict()
+        self.parsed = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.raws)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raws
+
+    def __setitem__(self, tx_hash, tx):
+        raw = tx if isinstance(tx, (bytes, bytearray, memoryview)) else tx.serialize()
+        raw = bytes(raw)
+        if tx_hash in self.raws:
+            self._remove(tx_hash)
+        self.raws[tx_hash] = raw
+        self.size += len(raw) + self.ENTRY_OVERHEAD
+        while self.raws and (len(self.raws) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.raws)))
+            self.evictions += 1
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __delitem__(self, tx_hash):
+        if tx_hash not in self.raws:
+            raise KeyError(tx_hash)
+        self._remove(tx_hash)
+
+    def _remove(self, tx_hash):
+        raw = self.raws.pop(tx_hash)
+        self.parsed.pop(tx_hash, None)
+        self.size -= len(raw) + self.ENTRY_OVERHEAD
+
+    def raw(self, tx_hash):
+        '''Returns the serialized transaction or None, without counting
+        it as a hit or miss'''
+        return self.raws.get(tx_hash)
+
+    def get(self, tx_hash, default=None):
+        if tx_hash not in self.raws:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.raws.move_to_end(tx_hash)
+        if tx_hash in self.parsed:
+            self.parsed.move_to_end(tx_hash)
+            return self.parsed[tx_hash]
+        tx = self.parse(self.raws[tx_hash])
+        if self.parsed_entries:
+            self.parsed[tx_hash] = tx
+            if len(self.parsed) > self.parsed_entries:
+                self.parsed.popitem(last=False)
+        return tx
+
+    def clear(self):
+        self.raws.clear()
+        self.parsed.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.raws),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 class HelperTest(TestCase):
 
     def test_bytes(self):
@@ -250,6 +889,145 @@ class HelperTest(TestCase):
         got = encode_base58_checksum(prefix + unhexlify(h160))
         self.assertEqual(got, addr)
 
+    def test_double_sha256_batch(self):
+        items = [bytes([i]) * i for i in range(50)]
+        want = b''.join(double_sha256(x) for x in items)
+        self.assertEqual(double_sha256_batch(items), want)
+        self.assertEqual(double_sha256_batch(items, workers=4), want)
+        records = b''.join(bytes([i]) * 80 for i in range(10))
+        want = b''.join(double_sha256(records[i:i+80]) for i in range(0, 800, 80))
+        self.assertEqual(double_sha256_batch(records, size=80), want)
+        self.assertEqual(split_digests(want, 32)[3], double_sha256(records[240:320]))
+        with self.assertRaises(RuntimeError):
+            double_sha256_batch(records[:-1], size=80)
+
+    def test_hash160_batch(self):
+        secs = [bytes([2]) + bytes([i % 256]) * 32 for i in range(100)]
+        want = b''.join(hash160(x) for x in secs)
+        self.assertEqual(hash160_batch(secs, workers=3), want)
+        self.assertEqual(hash160_batch(b''.join(secs), size=33, workers=1), want)
+        want = b''.join(hash160(b'\x02' + x[1:]) for x in secs[:5])
+        self.assertEqual(hash160_batch([x[1:] for x in secs[:5]], prefix=b'\x02'), want)
+
+    def test_batch_workers(self):
+        secs = [bytes([2]) + bytes([i % 256]) * 32 for i in range(100)]
+        records = b''.join(bytes([i]) * 80 for i in range(100))
+        with mock.patch('helper.BATCH_HASH_THRESHOLD', 16), \
+             mock.patch('helper.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+            want = b''.join(hash160(b'\x03' + x) for x in secs)
+            self.assertEqual(hash160_batch(secs, prefix=b'\x03', workers=3), want)
+            want = b''.join(double_sha256(records[i:i+80]) for i in range(0, 8000, 80))
+            self.assertEqual(double_sha256_batch(records, size=80, workers=3), want)
+            self.assertEqual(double_sha256_batch(bytearray(records), size=80, workers=2), want)
+            # hashed in the calling process below the threshold
+            double_sha256_batch(records[:800], size=80, workers=3)
+        self.assertEqual(pool.call_count, 3)
+
+    def test_byte_reader(self):
+        raw = unhexlify('0100000002fd2c01fe11223344ff0102030405060708aabbcc')
+        reader = ByteReader(raw)
+        self.assertEqual(reader.read_u32le(), 1)
+        self.assertEqual(read_varint(reader), 2)
+        self.assertEqual(reader.read_varint(), 300)
+        self.assertEqual(reader.read_varint(), 0x44332211)
+        self.assertEqual(reader.read_varint(), 0x0807060504030201)
+        view = reader.read_bytes_view(2)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, b'\xaa\xbb')
+        self.assertEqual(reader.remaining(), 1)
+        with self.assertRaises(RuntimeError):
+            reader.read(2)
+        # fixed size reads past the end fail the same way
+        for read in (reader.read_u16le, reader.read_u32le, reader.read_u64le):
+            with self.assertRaises(RuntimeError):
+                read()
+        reader.read_u8()
+        for read in (reader.read_u8, reader.read_varint):
+            with self.assertRaises(RuntimeError):
+                read()
+
+    def test_byte_reader_stream(self):
+        stream = BytesIO(b'\x05' + b'hello' + b'rest')
+        reader = ByteReader.wrap(stream)
+        self.assertEqual(reader.read(reader.read_varint()), b'hello')
+        reader.sync(stream)
+        self.assertEqual(stream.read(), b'rest')
+        # nested parsers get the same reader back and leave it alone
+        reader = ByteReader(b'abcd')
+        self.assertIs(ByteReader.wrap(reader), reader)
+        reader.read(1)
+        reader.sync(reader)
+        self.assertEqual(reader.read(3), b'bcd')
+
+    def test_stream_reader(self):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as pipe, open(write_fd, 'wb', buffering=0) as writer:
+            writer.write(b'\x05hello\x01\x00\x00\x00rest')
+            reader = ByteReader.wrap(pipe)
+            self.assertIsInstance(reader, StreamReader)
+            self.assertEqual(read_varint(reader), 5)
+            self.assertEqual(reader.peek(2), b'he')
+            self.assertEqual(reader.read(5), b'hello')
+            self.assertEqual(reader.read_u32le(), 1)
+            self.assertEqual(reader.slice(1, 6), b'hello')
+            reader.sync(pipe)
+            # only what was parsed was taken from the pipe
+            self.assertEqual(pipe.read(4), b'rest')
+            writer.close()
+            with self.assertRaises(RuntimeError):
+                reader.read_u32le()
+            self.assertEqual(reader.remaining(), 0)
+        # seekable streams are moved back past what was peeked at
+        with tempfile.TemporaryFile() as f:
+            f.write(b'abcdef')
+            f.seek(1)
+            reader = ByteReader.wrap(f)
+            self.assertEqual(reader.read(2), b'bc')
+            self.assertEqual(reader.peek(2), b'de')
+            reader.sync(f)
+            self.assertEqual(f.read(), b'def')
+
+    def test_watched_list(self):
+        class Counter:
+            def __init__(self):
+                self.touches = []
+
+            def touch(self, signed=True):
+                self.touches.append(signed)
+
+        signed, unsigned = Counter(), Counter()
+        items = WatchedList([1, 2], signed)
+        items.watch(unsigned, False)
+        items.append(3)
+        items[0] = 0
+        items += [4]
+        items.sort(reverse=True)
+        del items[0]
+        self.assertEqual(items, [3, 2, 0])
+        self.assertEqual(signed.touches, [True] * 5)
+        self.assertEqual(unsigned.touches, [False] * 5)
+        # watchers are only weakly referenced
+        del signed
+        items.pop()
+        self.assertEqual(len(items.watchers.refs), 2)
+        items.watch(unsigned, False)
+        self.assertEqual(len(items.watchers.refs), 1)
+
+    def test_byte_writer(self):
+        w = ByteWriter()
+        w.write_u32le(1)
+        w.write_varint(2)
+        w.write_varint(300)
+        w.write_varint(0x44332211)
+        w.write_varint(0x0807060504030201)
+        w.write(b'\xaa\xbb')
+        w.write_u8(0xcc)
+        self.assertEqual(bytes(w), unhexlify('0100000002fd2c01fe11223344ff0102030405060708aabbcc'))
+        for n in (0, 0xfc, 0xfd, 0xffff, 0x10000, 0xffffffff, 0x100000000):
+            w = ByteWriter()
+            w.write_varint(n)
+            self.assertEqual(bytes(w), encode_varint(n))
+
     def test_flip_endian(self):
         h = '03ee4f7a4e68f802303bc659f8f817964b4b74fe046facc3ae1be4679d622c45'
         w = '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03'
@@ -265,6 +1043,18 @@ class HelperTest(TestCase):
         h = unhexlify('a135ef0100000000')
         want = 32454049
         self.assertEqual(little_endian_to_int(h), want)
+        self.assertEqual(little_endian_to_int(b'\x01\x02\x03'), 0x030201)
+        self.assertEqual(little_endian_to_int(memoryview(b'\x01\x02')), 0x0201)
+
+    def test_varint_codec(self):
+        for n in (0, 1, 0xfc, 0xfd, 0xffff, 0x10000, 0xffffffff, 0x100000000, 2**64 - 1):
+            encoded = encode_varint(n)
+            self.assertEqual(varint_size(n), len(encoded))
+            buf = b'\xaa' + encoded + b'\xbb'
+            self.assertEqual(decode_varint(buf, 1), (n, 1 + len(encoded)))
+            self.assertEqual(read_varint(BytesIO(encoded)), n)
+        with self.assertRaises(RuntimeError):
+            encode_varint(2**64)
 
     def test_int_to_little_endian(self):
         n = 1
@@ -273,6 +1063,11 @@ class HelperTest(TestCase):
         n = 10011545
         want = b'\x99\xc3\x98\x00\x00\x00\x00\x00'
         self.assertEqual(int_to_little_endian(n, 8), want)
+        self.assertEqual(int_to_little_endian(0x030201, 3), b'\x01\x02\x03')
+        with self.assertRaises(OverflowError):
+            int_to_little_endian(-1, 4)
+        with self.assertRaises(OverflowError):
+            int_to_little_endian(2**32, 4)
 
     def test_p2pkh_address(self):
         h160 = unhexlify('74d691da1574e6b3c192ecfb52cc8984ee7b6c56')
@@ -373,3 +1168,56 @@ class HelperTest(TestCase):
         total = 11
         want = [7, 3, 1, 0]
         self.assertEqual(merkle_path(i, total), want)
+
+    def test_merkle_tree(self):
+        hashes = [double_sha256(bytes([i])) for i in range(40)]
+        tree = MerkleTree()
+        for i, h in enumerate(hashes):
+            tree.append(h)
+            self.assertEqual(tree.root(), merkle_root(hashes[:i + 1]))
+        batched = MerkleTree(hashes[:3])
+        batched.extend(hashes[3:])
+        self.assertEqual(batched.levels, tree.levels)
+        tree.replace(0, hashes[39])
+        tree.replace(38, hashes[0])
+        swapped = [hashes[39]] + hashes[1:38] + [hashes[0], hashes[39]]
+        self.assertEqual(tree.root(), merkle_root(list(swapped)))
+        tree.remove(5)
+        del swapped[5]
+        self.assertEqual(tree.root(), merkle_root(list(swapped)))
+        tree.truncate(7)
+        self.assertEqual(tree.root(), merkle_root(swapped[:7]))
+        tree.truncate(1)
+        self.assertEqual(tree.root(), swapped[0])
+        self.assertEqual(len(tree.levels), 1)
+
+    def test_tx_cache(self):
+        class Raw(bytes):
+            def serialize(self):
+                return bytes(self)
+        parses = []
+
+        def parse(raw):
+            parses.append(raw)
+            return Raw(raw)
+        cache = TxCache(parse, max_entries=3, max_bytes=10000, parsed_entries=1)
+        for i in range(3):
+            cache[bytes([i])] = b'x' * 100
+        self.assertEqual(cache[b'\x00'], b'x' * 100)
+        self.assertEqual(cache[b'\x00'], b'x' * 100)
+        self.assertEqual(len(parses), 1)
+        # 1 is now the least recently used
+        cache[b'\x03'] = Raw(b'y' * 100)
+        self.assertNotIn(b'\x01', cache)
+        self.assertIn(b'\x00', cache)
+        self.assertIsNone(cache.get(b'\x01'))
+        with self.assertRaises(KeyError):
+            cache[b'\x01']
+        self.assertEqual(cache.raw(b'\x03'), b'y' * 100)
+        # a big entry pushes out older ones to stay under max_bytes
+        cache[b'\x04'] = b'z' * 9500
+        self.assertEqual(list(cache.raws), [b'\x03', b'\x04'])
+        self.assertLessEqual(cache.stats()['bytes'], 10000)
+        del cache[b'\x04']
+        self.assertEqual(cache.stats(), {'entries': 1, 'bytes': 100 + TxCache.ENTRY_OVERHEAD,
+                                         'hits': 2, 'misses': 2, 'evictions': 3})
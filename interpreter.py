@@ -0,0 +1,755 @@
+from unittest import TestCase
+
+import hashlib
+
+from ecc import PrivateKey, S256Point, Signature
+from helper import (
+    double_sha256,
+    hash160,
+    p2pkh_script,
+    sha256,
+)
+from script import OP_CODES, Script
+
+
+MAX_ELEMENT_SIZE = 520
+MAX_STACK_SIZE = 1000
+MAX_PUBKEYS_PER_MULTISIG = 20
+LOCKTIME_THRESHOLD = 500000000
+SEQUENCE_DISABLE_FLAG = 1 << 31
+SEQUENCE_TYPE_FLAG = 1 << 22
+SEQUENCE_MASK = 0x0000ffff
+
+# signature versions passed to SignatureChecker.check_sig
+SIGVERSION_BASE = 0
+SIGVERSION_WITNESS_V0 = 1
+
+
+class ScriptError(RuntimeError):
+    '''Raised inside the interpreter when a script fails'''
+
+
+def encode_num(num):
+    '''Encodes an integer the way script numbers are stored on the stack'''
+    if num == 0:
+        return b''
+    abs_num = abs(num)
+    negative = num < 0
+    result = bytearray()
+    while abs_num:
+        result.append(abs_num & 0xff)
+        abs_num >>= 8
+    # the top bit of the last byte is the sign
+    if result[-1] & 0x80:
+        result.append(0x80 if negative else 0)
+    elif negative:
+        result[-1] |= 0x80
+    return bytes(result)
+
+
+def decode_num(element, max_size=4):
+    '''Decodes a stack element into an integer'''
+    if len(element) > max_size:
+        raise ScriptError('script number overflow')
+    if element == b'':
+        return 0
+    num = int.from_bytes(element, 'little')
+    if element[-1] & 0x80:
+        return -(num & ~(0x80 << (8 * (len(element) - 1))))
+    return num
+
+
+def cast_to_bool(element):
+    for i, b in enumerate(element):
+        if b != 0:
+            # negative zero is false too
+            return not (i == len(element) - 1 and b == 0x80)
+    return False
+
+
+class SignatureChecker:
+    '''Hooks the interpreter calls for the opcodes that depend on the
+    spending transaction. The base class accepts nothing.'''
+
+    def check_sig(self, sig, sec, script_code, sig_version):
+        '''sig is the DER signature with the hash type byte appended, sec the
+        public key and script_code the raw script being executed'''
+        return False
+
+    def check_locktime(self, locktime):
+        return False
+
+    def check_sequence(self, sequence):
+        return False
+
+
+class TxSignatureChecker(SignatureChecker):
+    '''Checks signatures against input input_index of tx'''
+
+    def __init__(self, tx, input_index):
+        self.tx = tx
+        self.input_index = input_index
+
+    def check_sig(self, sig, sec, script_code, sig_version):
+        if len(sig) == 0:
+            return False
+        der, hash_type = sig[:-1], sig[-1]
+        try:
+            point = S256Point.parse(sec)
+            signature = Signature.parse(der)
+        except (RuntimeError, ValueError, IndexError):
+            return False
+        if sig_version == SIGVERSION_BASE:
+            z = self.tx.sig_hash(self.input_index, hash_type, script_code)
+        else:
+            z = self.tx.sig_hash_w0(self.input_index, hash_type, script_code=script_code)
+        return point.verify(z, signature)
+
+    def check_locktime(self, locktime):
+        tx_locktime = self.tx.locktime
+        # both must be block heights or both timestamps
+        if (locktime < LOCKTIME_THRESHOLD) != (tx_locktime < LOCKTIME_THRESHOLD):
+            return False
+        if locktime > tx_locktime:
+            return False
+        # a final input would bypass the locktime
+        return self.tx.tx_ins[self.input_index].sequence != 0xffffffff
+
+    def check_sequence(self, sequence):
+        tx_sequence = self.tx.tx_ins[self.input_index].sequence
+        if self.tx.version < 2 or tx_sequence & SEQUENCE_DISABLE_FLAG:
+            return False
+        mask = SEQUENCE_TYPE_FLAG | SEQUENCE_MASK
+        sequence &= mask
+        tx_sequence &= mask
+        if (sequence < SEQUENCE_TYPE_FLAG) != (tx_sequence < SEQUENCE_TYPE_FLAG):
+            return False
+        return sequence <= tx_sequence
+
+
+# opcode handlers, each takes the interpreter and the opcode
+
+
+def op_n(vm, op):
+    # OP_1NEGATE is 79, OP_1 to OP_16 are 81 to 96
+    vm.stack.append(encode_num(op - 80))
+
+
+def op_nop(vm, op):
+    pass
+
+
+def op_if(vm, op):
+    value = False
+    if not vm.skipping:
+        value = cast_to_bool(vm.stack.pop())
+        if op == 100:  # OP_NOTIF
+            value = not value
+    vm.exec_stack.append(value)
+    if not value:
+        vm.skipping += 1
+
+
+def op_else(vm, op):
+    if not vm.exec_stack:
+        raise ScriptError('OP_ELSE without OP_IF')
+    value = vm.exec_stack[-1]
+    vm.skipping += 1 if value else -1
+    vm.exec_stack[-1] = not value
+
+
+def op_endif(vm, op):
+    if not vm.exec_stack:
+        raise ScriptError('OP_ENDIF without OP_IF')
+    if not vm.exec_stack.pop():
+        vm.skipping -= 1
+
+
+def op_verify(vm, op):
+    if not cast_to_bool(vm.stack.pop()):
+        raise ScriptError('OP_VERIFY failed')
+
+
+def op_return(vm, op):
+    raise ScriptError('OP_RETURN')
+
+
+def op_toaltstack(vm, op):
+    vm.altstack.append(vm.stack.pop())
+
+
+def op_fromaltstack(vm, op):
+    vm.stack.append(vm.altstack.pop())
+
+
+def need(vm, n):
+    if len(vm.stack) < n:
+        raise ScriptError('stack too small')
+
+
+def op_2drop(vm, op):
+    need(vm, 2)
+    del vm.stack[-2:]
+
+
+def op_2dup(vm, op):
+    need(vm, 2)
+    vm.stack.extend(vm.stack[-2:])
+
+
+def op_3dup(vm, op):
+    need(vm, 3)
+    vm.stack.extend(vm.stack[-3:])
+
+
+def op_2over(vm, op):
+    need(vm, 4)
+    vm.stack.extend(vm.stack[-4:-2])
+
+
+def op_2rot(vm, op):
+    need(vm, 6)
+    items = vm.stack[-6:-4]
+    del vm.stack[-6:-4]
+    vm.stack.extend(items)
+
+
+def op_2swap(vm, op):
+    need(vm, 4)
+    vm.stack[-4:] = vm.stack[-2:] + vm.stack[-4:-2]
+
+
+def op_ifdup(vm, op):
+    if cast_to_bool(vm.stack[-1]):
+        vm.stack.append(vm.stack[-1])
+
+
+def op_depth(vm, op):
+    vm.stack.append(encode_num(len(vm.stack)))
+
+
+def op_drop(vm, op):
+    vm.stack.pop()
+
+
+def op_dup(vm, op):
+    vm.stack.append(vm.stack[-1])
+
+
+def op_nip(vm, op):
+    del vm.stack[-2]
+
+
+def op_over(vm, op):
+    vm.stack.append(vm.stack[-2])
+
+
+def op_pick(vm, op):
+    n = decode_num(vm.stack.pop())
+    if n < 0 or n >= len(vm.stack):
+        raise ScriptError('bad OP_PICK/OP_ROLL index')
+    item = vm.stack[-1 - n]
+    if op == 122:  # OP_ROLL
+        del vm.stack[-1 - n]
+    vm.stack.append(item)
+
+
+def op_rot(vm, op):
+    vm.stack.append(vm.stack.pop(-3))
+
+
+def op_swap(vm, op):
+    vm.stack.append(vm.stack.pop(-2))
+
+
+def op_tuck(vm, op):
+    need(vm, 2)
+    vm.stack.insert(-2, vm.stack[-1])
+
+
+def op_size(vm, op):
+    vm.stack.append(encode_num(len(vm.stack[-1])))
+
+
+def op_equal(vm, op):
+    equal = vm.stack.pop() == vm.stack.pop()
+    if op == 136:  # OP_EQUALVERIFY
+        if not equal:
+            raise ScriptError('OP_EQUALVERIFY failed')
+    else:
+        vm.stack.append(b'\x01' if equal else b'')
+
+
+UNARY_OPS = {
+    139: lambda a: a + 1,              # OP_1ADD
+    140: lambda a: a - 1,              # OP_1SUB
+    143: lambda a: -a,                 # OP_NEGATE
+    144: abs,                          # OP_ABS
+    145: lambda a: int(a == 0),        # OP_NOT
+    146: lambda a: int(a != 0),        # OP_0NOTEQUAL
+}
+
+BINARY_OPS = {
+    147: lambda a, b: a + b,                    # OP_ADD
+    148: lambda a, b: a - b,                    # OP_SUB
+    154: lambda a, b: int(a != 0 and b != 0),   # OP_BOOLAND
+    155: lambda a, b: int(a != 0 or b != 0),    # OP_BOOLOR
+    156: lambda a, b: int(a == b),              # OP_NUMEQUAL
+    157: lambda a, b: int(a == b),              # OP_NUMEQUALVERIFY
+    158: lambda a, b: int(a != b),              # OP_NUMNOTEQUAL
+    159: lambda a, b: int(a < b),               # OP_LESSTHAN
+    160: lambda a, b: int(a > b),               # OP_GREATERTHAN
+    161: lambda a, b: int(a <= b),              # OP_LESSTHANOREQUAL
+    162: lambda a, b: int(a >= b),              # OP_GREATERTHANOREQUAL
+    163: min,                                   # OP_MIN
+    164: max,                                   # OP_MAX
+}
+
+
+def op_unary(vm, op):
+    vm.stack.append(encode_num(UNARY_OPS[op](decode_num(vm.stack.pop()))))
+
+
+def op_binary(vm, op):
+    b = decode_num(vm.stack.pop())
+    a = decode_num(vm.stack.pop())
+    result = BINARY_OPS[op](a, b)
+    if op == 157:  # OP_NUMEQUALVERIFY
+        if not result:
+            raise ScriptError('OP_NUMEQUALVERIFY failed')
+    else:
+        vm.stack.append(encode_num(result))
+
+
+def op_within(vm, op):
+    maximum = decode_num(vm.stack.pop())
+    minimum = decode_num(vm.stack.pop())
+    x = decode_num(vm.stack.pop())
+    vm.stack.append(encode_num(int(minimum <= x < maximum)))
+
+
+HASH_OPS = {
+    166: lambda x: hashlib.new('ripemd160', x).digest(),   # OP_RIPEMD160
+    167: lambda x: hashlib.sha1(x).digest(),               # OP_SHA1
+    168: sha256,                                           # OP_SHA256
+    169: hash160,                                          # OP_HASH160
+    170: double_sha256,                                    # OP_HASH256
+}
+
+
+def op_hash(vm, op):
+    vm.stack.append(HASH_OPS[op](vm.stack.pop()))
+
+
+def op_checksig(vm, op):
+    sec = vm.stack.pop()
+    sig = vm.stack.pop()
+    ok = vm.checker.check_sig(sig, sec, vm.script_code, vm.sig_version)
+    if op == 173:  # OP_CHECKSIGVERIFY
+        if not ok:
+            raise ScriptError('OP_CHECKSIGVERIFY failed')
+    else:
+        vm.stack.append(b'\x01' if ok else b'')
+
+
+def check_multisig(checker, sigs, pubkeys, script_code, sig_version):
+    '''Returns whether every signature matches one of the public keys, in
+    the same order as the keys'''
+    key_index = 0
+    for sig in sigs:
+        while True:
+            if len(pubkeys) - key_index < 1:
+                return False
+            key_index += 1
+            if checker.check_sig(sig, pubkeys[key_index - 1], script_code, sig_version):
+                break
+    return True
+
+
+def op_checkmultisig(vm, op):
+    stack = vm.stack
+    n = decode_num(stack.pop())
+    if not 0 <= n <= MAX_PUBKEYS_PER_MULTISIG or len(stack) < n + 1:
+        raise ScriptError('bad pubkey count')
+    pubkeys = stack[len(stack) - n:]
+    del stack[len(stack) - n:]
+    m = decode_num(stack.pop())
+    # m signatures and the extra dummy element
+    if not 0 <= m <= n or len(stack) < m + 1:
+        raise ScriptError('bad signature count')
+    sigs = stack[len(stack) - m:]
+    del stack[len(stack) - m - 1:]
+    ok = len(sigs) <= len(pubkeys) and \
+        check_multisig(vm.checker, sigs, pubkeys, vm.script_code, vm.sig_version)
+    if op == 175:  # OP_CHECKMULTISIGVERIFY
+        if not ok:
+            raise ScriptError('OP_CHECKMULTISIGVERIFY failed')
+    else:
+        stack.append(b'\x01' if ok else b'')
+
+
+def op_checklocktimeverify(vm, op):
+    locktime = decode_num(vm.stack[-1], max_size=5)
+    if locktime < 0 or not vm.checker.check_locktime(locktime):
+        raise ScriptError('OP_CHECKLOCKTIMEVERIFY failed')
+
+
+def op_checksequenceverify(vm, op):
+    sequence = decode_num(vm.stack[-1], max_size=5)
+    if sequence < 0:
+        raise ScriptError('negative sequence')
+    if sequence & SEQUENCE_DISABLE_FLAG:
+        return
+    if not vm.checker.check_sequence(sequence):
+        raise ScriptError('OP_CHECKSEQUENCEVERIFY failed')
+
+
+HANDLERS = {
+    'OP_1NEGATE': op_n,
+    'OP_NOP': op_nop,
+    'OP_IF': op_if,
+    'OP_NOTIF': op_if,
+    'OP_ELSE': op_else,
+    'OP_ENDIF': op_endif,
+    'OP_VERIFY': op_verify,
+    'OP_RETURN': op_return,
+    'OP_TOALTSTACK': op_toaltstack,
+    'OP_FROMALTSTACK': op_fromaltstack,
+    'OP_2DROP': op_2drop,
+    'OP_2DUP': op_2dup,
+    'OP_3DUP': op_3dup,
+    'OP_2OVER': op_2over,
+    'OP_2ROT': op_2rot,
+    'OP_2SWAP': op_2swap,
+    'OP_IFDUP': op_ifdup,
+    'OP_DEPTH': op_depth,
+    'OP_DROP': op_drop,
+    'OP_DUP': op_dup,
+    'OP_NIP': op_nip,
+    'OP_OVER': op_over,
+    'OP_PICK': op_pick,
+    'OP_ROLL': op_pick,
+    'OP_ROT': op_rot,
+    'OP_SWAP': op_swap,
+    'OP_TUCK': op_tuck,
+    'OP_SIZE': op_size,
+    'OP_EQUAL': op_equal,
+    'OP_EQUALVERIFY': op_equal,
+    'OP_WITHIN': op_within,
+    'OP_CODESEPARATOR': op_nop,
+    'OP_CHECKSIG': op_checksig,
+    'OP_CHECKSIGVERIFY': op_checksig,
+    'OP_CHECKMULTISIG': op_checkmultisig,
+    'OP_CHECKMULTISIGVERIFY': op_checkmultisig,
+    'OP_CHECKLOCKTIMEVERIFY': op_checklocktimeverify,
+    'OP_CHECKSEQUENCEVERIFY': op_checksequenceverify,
+}
+for op_code in range(81, 97):
+    HANDLERS[OP_CODES[op_code]] = op_n
+for op_code in UNARY_OPS:
+    HANDLERS[OP_CODES[op_code]] = op_unary
+for op_code in BINARY_OPS:
+    HANDLERS[OP_CODES[op_code]] = op_binary
+for op_code in HASH_OPS:
+    HANDLERS[OP_CODES[op_code]] = op_hash
+for name in ('OP_NOP1', 'OP_NOP4', 'OP_NOP5', 'OP_NOP6', 'OP_NOP7',
+             'OP_NOP8', 'OP_NOP9', 'OP_NOP10'):
+    HANDLERS[name] = op_nop
+
+# dispatch table indexed by opcode, None means the opcode fails
+OPERATIONS = [None] * 256
+for op_code, name in OP_CODES.items():
+    OPERATIONS[op_code] = HANDLERS.get(name)
+
+# these fail even in a branch that is not executed
+DISABLED_OPS = frozenset(range(126, 130)) | frozenset(range(131, 135)) \
+    | frozenset((141, 142, 149, 150, 151, 152, 153))
+
+
+class Interpreter:
+
+    def __init__(self, checker=None, sig_version=SIGVERSION_BASE):
+        self.checker = checker or SignatureChecker()
+        self.sig_version = sig_version
+        self.stack = []
+        self.altstack = []
+        self.exec_stack = []
+        # number of False entries in exec_stack
+        self.skipping = 0
+        self.script_code = b''
+
+    def execute(self, script):
+        '''Runs script on the current stack. Raises ScriptError if it fails'''
+        self.script_code = script.serialize()
+        self.altstack = []
+        self.exec_stack = []
+        self.skipping = 0
+        stack = self.stack
+        for op_code, data in script.instructions():
+            if op_code == 0:
+                if not self.skipping:
+                    if len(data) > MAX_ELEMENT_SIZE:
+                        raise ScriptError('push too large')
+                    stack.append(data)
+                continue
+            if op_code in DISABLED_OPS:
+                raise ScriptError('disabled opcode {}'.format(OP_CODES[op_code]))
+            if self.skipping and not 99 <= op_code <= 104:
+                # only OP_IF to OP_ENDIF matter in a skipped branch
+                continue
+            handler = OPERATIONS[op_code]
+            if handler is None:
+                raise ScriptError('bad opcode {}'.format(op_code))
+            try:
+                handler(self, op_code)
+            except IndexError:
+                raise ScriptError('stack too small for {}'.format(OP_CODES[op_code]))
+            if len(stack) + len(self.altstack) > MAX_STACK_SIZE:
+                raise ScriptError('stack too large')
+        if self.exec_stack:
+            raise ScriptError('unbalanced conditional')
+
+    def succeeded(self):
+        return len(self.stack) > 0 and cast_to_bool(self.stack[-1])
+
+
+def _pushes(script):
+    '''Returns the pushed data of a push-only script, or None'''
+    result = []
+    for op_code, data in script.instructions():
+        if op_code != 0:
+            return None
+        result.append(data)
+    return result
+
+
+def _multisig_keys(script):
+    '''Returns m and the pubkeys of a multisig script'''
+    instructions = script.instructions()
+    return instructions[0][0] - 80, [data for _, data in instructions[1:-2]]
+
+
+def _fast_verify(script_sig, script_pubkey, checker, witness):
+    '''Checks the standard templates directly.
+    Returns None when the generic interpreter has to decide.'''
+    kind = script_pubkey.type()
+    if kind == 'p2pkh':
+        items = _pushes(script_sig)
+        if items is None or len(items) != 2:
+            return None
+        sig, sec = items
+        if hash160(sec) != script_pubkey.serialize()[3:23]:
+            return False
+        return checker.check_sig(sig, sec, script_pubkey.serialize(), SIGVERSION_BASE)
+    elif kind == 'p2pk':
+        items = _pushes(script_sig)
+        if items is None or len(items) != 1:
+            return None
+        sec = script_pubkey.elements[0]
+        return checker.check_sig(items[0], sec, script_pubkey.serialize(), SIGVERSION_BASE)
+    elif kind == 'p2wpkh':
+        if script_sig.serialize() != b'' or witness is None or len(witness) != 2:
+            return None
+        sig, sec = witness
+        h160 = script_pubkey.serialize()[2:]
+        if len(sec) > MAX_ELEMENT_SIZE or hash160(sec) != h160:
+            return False
+        return checker.check_sig(sig, sec, p2pkh_script(h160), SIGVERSION_WITNESS_V0)
+    elif kind in ('multisig', 'p2sh'):
+        items = _pushes(script_sig)
+        if items is None or any(len(x) > MAX_ELEMENT_SIZE for x in items):
+            return None
+        if kind == 'p2sh':
+            if not items or hash160(items[-1]) != script_pubkey.serialize()[2:22]:
+                return None
+            script_code = Script.parse(items.pop())
+            if script_code.type() != 'multisig':
+                return None
+        else:
+            script_code = script_pubkey
+        m, pubkeys = _multisig_keys(script_code)
+        # dummy element then exactly m signatures
+        if len(items) != m + 1:
+            return None
+        return check_multisig(checker, items[1:], pubkeys, script_code.serialize(), SIGVERSION_BASE)
+    return None
+
+
+def _verify_witness_program(script_pubkey, witness, checker):
+    kind = script_pubkey.type()
+    program = script_pubkey.serialize()[2:]
+    witness = list(witness or [])
+    if kind == 'p2wpkh':
+        if len(witness) != 2:
+            return False
+        script_code = Script.parse(p2pkh_script(program))
+    else:
+        if not witness:
+            return False
+        witness_script = witness.pop()
+        if sha256(witness_script) != program:
+            return False
+        script_code = Script.parse(witness_script)
+    if any(len(x) > MAX_ELEMENT_SIZE for x in witness):
+        return False
+    vm = Interpreter(checker, SIGVERSION_WITNESS_V0)
+    vm.stack = witness
+    vm.execute(script_code)
+    # witness scripts must leave exactly one true element
+    return len(vm.stack) == 1 and vm.succeeded()
+
+
+def verify_script(script_sig, script_pubkey, checker=None, witness=None, fast=True):
+    '''Returns whether script_sig (and the witness, if any) satisfies
+    script_pubkey. Standard templates are checked directly unless fast is
+    False, everything else runs through the interpreter.'''
+    checker = checker or SignatureChecker()
+    try:
+        if fast:
+            result = _fast_verify(script_sig, script_pubkey, checker, witness)
+            if result is not None:
+                return result
+        vm = Interpreter(checker)
+        vm.execute(script_sig)
+        stack_copy = list(vm.stack)
+        vm.execute(script_pubkey)
+        if not vm.succeeded():
+            return False
+        kind = script_pubkey.type()
+        if kind in ('p2wpkh', 'p2wsh'):
+            if script_sig.serialize() != b'':
+                return False
+            return _verify_witness_program(script_pubkey, witness, checker)
+        if kind == 'p2sh':
+            if not script_sig.is_push_only() or not stack_copy:
+                return False
+            redeem_script = Script.parse(stack_copy.pop())
+            vm.stack = stack_copy
+            vm.execute(redeem_script)
+            if not vm.succeeded():
+                return False
+            if redeem_script.type() in ('p2wpkh', 'p2wsh'):
+                # nested segwit, the scriptSig is only the redeem script
+                if len(script_sig.elements) != 1:
+                    return False
+                return _verify_witness_program(redeem_script, witness, checker)
+        return True
+    except (RuntimeError, ValueError, IndexError):
+        # a ScriptError, or data the checker can't make sense of
+        return False
+
+
+class KeyChecker(SignatureChecker):
+    '''Checks signatures against a fixed message z, for testing'''
+
+    def __init__(self, z):
+        self.z = z
+
+    def check_sig(self, sig, sec, script_code, sig_version):
+        try:
+            return S256Point.parse(sec).verify(self.z, Signature.parse(sig[:-1]))
+        except (RuntimeError, ValueError, IndexError):
+            return False
+
+
+class InterpreterTest(TestCase):
+
+    z = 0x7c076ff316692a3d7eb3c3bb0f8b1488cf72e1afcd929e29307032997a838a3d
+
+    def sign(self, secret):
+        return PrivateKey(secret).sign(self.z).der() + b'\x01'
+
+    def run_script(self, script):
+        vm = Interpreter()
+        vm.execute(script)
+        return vm.stack
+
+    def test_num(self):
+        for n in (0, 1, -1, 127, 128, -128, 255, 256, -255, 2**31 - 1, -(2**31 - 1)):
+            self.assertEqual(decode_num(encode_num(n)), n)
+        self.assertEqual(encode_num(-1), b'\x81')
+        self.assertEqual(encode_num(128), b'\x80\x00')
+        self.assertFalse(cast_to_bool(b'\x00\x80'))
+        self.assertTrue(cast_to_bool(b'\x80\x00'))
+
+    def test_arithmetic(self):
+        # 2 3 OP_ADD 5 OP_EQUAL
+        self.assertEqual(self.run_script(Script([0x52, 0x53, 0x93, 0x55, 0x87])), [b'\x01'])
+        # 5 OP_1NEGATE OP_SUB 6 OP_NUMEQUALVERIFY 2 1 4 OP_WITHIN
+        stack = self.run_script(Script([0x55, 0x4f, 0x94, 0x56, 0x9d, 0x52, 0x51, 0x54, 0xa5]))
+        self.assertEqual(stack, [b'\x01'])
+
+    def test_conditionals(self):
+        # 1 OP_IF 2 OP_ELSE 3 OP_ENDIF
+        self.assertEqual(self.run_script(Script([0x51, 0x63, 0x52, 0x67, 0x53, 0x68])), [b'\x02'])
+        # 0 OP_IF 2 OP_ELSE 3 OP_ENDIF
+        self.assertEqual(self.run_script(Script([b'', 0x63, 0x52, 0x67, 0x53, 0x68])), [b'\x03'])
+        # 0 OP_NOTIF 0 OP_IF OP_RETURN OP_ENDIF 7 OP_ENDIF
+        self.assertEqual(self.run_script(Script([b'', 0x64, b'', 0x63, 0x6a, 0x68, 0x57, 0x68])), [b'\x07'])
+        with self.assertRaises(ScriptError):
+            self.run_script(Script([0x51, 0x63]))
+        with self.assertRaises(ScriptError):
+            self.run_script(Script([0x68]))
+
+    def test_stack_ops(self):
+        # 1 2 3 OP_ROT -> 2 3 1, OP_2DUP, OP_DEPTH
+        stack = self.run_script(Script([0x51, 0x52, 0x53, 0x7b, 0x6e, 0x74]))
+        self.assertEqual(stack, [b'\x02', b'\x03', b'\x01', b'\x03', b'\x01', b'\x05'])
+        # 1 2 3 4 OP_2SWAP 2 OP_ROLL
+        stack = self.run_script(Script([0x51, 0x52, 0x53, 0x54, 0x72, 0x52, 0x7a]))
+        self.assertEqual(stack, [b'\x03', b'\x01', b'\x02', b'\x04'])
+        with self.assertRaises(ScriptError):
+            self.run_script(Script([0x76]))
+        # disabled opcodes fail even when not executed
+        with self.assertRaises(ScriptError):
+            self.run_script(Script([b'', 0x63, 0x7e, 0x68]))
+
+    def test_hashes(self):
+        stack = self.run_script(Script([b'abc', 0xa9, b'abc', 0xaa, 0xa8]))
+        self.assertEqual(stack, [hash160(b'abc'), sha256(double_sha256(b'abc'))])
+
+    def test_p2pkh(self):
+        key = PrivateKey(8675309)
+        sec = key.point.sec()
+        script_pubkey = Script.parse(p2pkh_script(hash160(sec)))
+        script_sig = Script([self.sign(8675309), sec])
+        checker = KeyChecker(self.z)
+        for fast in (True, False):
+            self.assertTrue(verify_script(script_sig, script_pubkey, checker, fast=fast))
+            bad_sig = Script([self.sign(12345), sec])
+            self.assertFalse(verify_script(bad_sig, script_pubkey, checker, fast=fast))
+            other_key = Script([self.sign(12345), PrivateKey(12345).point.sec()])
+            self.assertFalse(verify_script(other_key, script_pubkey, checker, fast=fast))
+
+    def test_p2sh_multisig(self):
+        secrets = (101, 202, 303)
+        pubkeys = [PrivateKey(x).point.sec() for x in secrets]
+        redeem_script = Script([0x52] + pubkeys + [0x53, 0xae]).serialize()
+        script_pubkey = Script([0xa9, hash160(redeem_script), 0x87])
+        self.assertEqual(script_pubkey.type(), 'p2sh')
+        checker = KeyChecker(self.z)
+        for fast in (True, False):
+            script_sig = Script([b'', self.sign(101), self.sign(303), redeem_script])
+            self.assertTrue(verify_script(script_sig, script_pubkey, checker, fast=fast))
+            # signatures out of key order
+            script_sig = Script([b'', self.sign(303), self.sign(101), redeem_script])
+            self.assertFalse(verify_script(script_sig, script_pubkey, checker, fast=fast))
+            # missing the dummy element
+            script_sig = Script([self.sign(101), self.sign(303), redeem_script])
+            self.assertFalse(verify_script(script_sig, script_pubkey, checker, fast=fast))
+
+    def test_p2wpkh(self):
+        sec = PrivateKey(8675309).point.sec()
+        script_pubkey = Script([b'', hash160(sec)])
+        checker = KeyChecker(self.z)
+        for fast in (True, False):
+            witness = [self.sign(8675309), sec]
+            self.assertTrue(verify_script(Script([]), script_pubkey, checker, witness, fast=fast))
+            self.assertFalse(verify_script(Script([]), script_pubkey, checker, witness[:1], fast=fast))
+
+    def test_p2wsh(self):
+        # witness script: OP_ADD 5 OP_EQUAL
+        witness_script = Script([0x93, 0x55, 0x87]).serialize()
+        script_pubkey = Script([b'', sha256(witness_script)])
+        self.assertTrue(verify_script(Script([]), script_pubkey, witness=[b'\x02', b'\x03', witness_script]))
+        self.assertFalse(verify_script(Script([]), script_pubkey, witness=[b'\x02', b'\x02', witness_script]))
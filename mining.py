@@ -0,0 +1,275 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from unittest import TestCase, mock
+
+import hashlib
+import multiprocessing
+import os
+import time
+
+from block import Block, bits_to_target, target_to_bits
+from helper import U32LE, p2pkh_script
+from template import BlockTemplate
+from tx import Tx, TxIn, TxOut
+
+
+NONCE_SPACE = 2**32
+# nonces a worker tries between looking whether its search was called off
+STOP_CHECK_INTERVAL = 1 << 14
+
+
+def search_nonces(prefix, target, start, end):
+    '''Tries the nonces from start to end after the 76 byte header prefix.
+    Returns the first nonce whose header hash is below target, or None.'''
+    # sha256 state after the first 64 byte block, the same for every nonce
+    midstate = hashlib.sha256(prefix[:64])
+    tail = prefix[64:76]
+    pack = U32LE.pack
+    sha256 = hashlib.sha256
+    from_bytes = int.from_bytes
+    for nonce in range(start, end):
+        h = midstate.copy()
+        h.update(tail + pack(nonce))
+        if from_bytes(sha256(h.digest()).digest(), 'little') < target:
+            return nonce
+    return None
+
+
+# the search generation shared with the pool workers, set by their
+# initializer
+_generation = None
+
+
+def _init_worker(generation):
+    global _generation
+    _generation = generation
+
+
+def _search_chunk(prefix, target, start, end, generation):
+    '''search_nonces in a worker, giving up with None once the Miner
+    moved on from generation'''
+    for begin in range(start, end, STOP_CHECK_INTERVAL):
+        if _generation.value != generation:
+            return None
+        nonce = search_nonces(prefix, target, begin, min(begin + STOP_CHECK_INTERVAL, end))
+        if nonce is not None:
+            return nonce
+    return None
+
+
+class ExtraNonceRoller:
+    '''Gives Miner.mine a new header once the nonces run out by pushing
+    an extra nonce at the end of the coinbase scriptSig of a
+    BlockTemplate. Replacing the coinbase only rehashes its merkle
+    branch.'''
+
+    def __init__(self, template, size=4):
+        self.template = template
+        self.size = size
+        self.extranonce = 0
+        coinbase = template.txs[0]
+        self.script_sig = coinbase.tx_ins[0].script_sig.serialize()
+
+    def __call__(self, header):
+        self.extranonce += 1
+        coinbase = self.template.txs[0]
+        tx_in = coinbase.tx_ins[0]
+        script_sig = self.script_sig + bytes([self.size]) + self.extranonce.to_bytes(self.size, 'little')
+        new = Tx(coinbase.version, [TxIn(tx_in.prev_tx, tx_in.prev_index, script_sig, tx_in.sequence)],
+                 coinbase.tx_outs, coinbase.locktime)
+        new.tx_ins[0].script_witness = tx_in.script_witness
+        self.template.set_coinbase(new)
+        return self.template.header()
+
+
+def roll_timestamp(header):
+    '''Returns header a second later, what Miner.mine does by default'''
+    return Block(header.version, header.prev_block, header.merkle_root, header.timestamp + 1,
+                 header.bits, header.nonce, header.tx_hashes)
+
+
+class Miner:
+    '''Searches nonces for block headers. The first inline nonces are
+    tried in this process, which is all an easy regtest target needs;
+    after that the nonce space is split into chunk_size ranges run on
+    a pool of workers processes, started on first use and kept until
+    close(). Once a nonce is found the chunks still running stop within
+    STOP_CHECK_INTERVAL nonces. hashes and seconds add up all the work
+    done.'''
+
+    def __init__(self, workers=None, chunk_size=1 << 20, inline=1 << 16, nonce_space=NONCE_SPACE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.inline = inline
+        self.nonce_space = nonce_space
+        self.pool = None
+        self.generation = None
+        self.hashes = 0
+        self.seconds = 0.0
+
+    def hash_rate(self):
+        '''Returns the hashes per second done so far'''
+        return self.hashes / self.seconds if self.seconds else 0.0
+
+    def search(self, header):
+        '''Returns the nonce making header meet its target, None if there
+        is none in the nonce space'''
+        prefix = header.serialize()[:76]
+        target = bits_to_target(bytes(header.bits))
+        start_time = time.perf_counter()
+        try:
+            end = min(self.inline, self.nonce_space)
+            nonce = search_nonces(prefix, target, 0, end)
+            if nonce is not None:
+                self.hashes += nonce + 1
+                return nonce
+            self.hashes += end
+            if self.workers <= 1:
+                nonce = search_nonces(prefix, target, end, self.nonce_space)
+                self.hashes += (self.nonce_space if nonce is None else nonce + 1) - end
+                return nonce
+            return self._search_pool(prefix, target, end)
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+    def _search_pool(self, prefix, target, start):
+        if self.pool is None:
+            self.generation = multiprocessing.RawValue('Q', 0)
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=(self.generation,))
+        generation = self.generation.value
+        ranges = iter(range(start, self.nonce_space, self.chunk_size))
+        running = {}
+
+        def submit():
+            for begin in ranges:
+                end = min(begin + self.chunk_size, self.nonce_space)
+                future = self.pool.submit(_search_chunk, prefix, target, begin, end, generation)
+                running[future] = (begin, end)
+                return
+
+        # two ranges per worker so none waits for the next
+        for _ in range(2 * self.workers):
+            submit()
+        found = None
+        while running and found is None:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                begin, end = running.pop(future)
+                nonce = future.result()
+                if nonce is None:
+                    self.hashes += end - begin
+                    submit()
+                elif found is None or nonce < found:
+                    self.hashes += nonce - begin + 1
+                    found = nonce
+        # chunks that haven't started are dropped, running ones see the
+        # new generation and return
+        for future in running:
+            future.cancel()
+        self.generation.value = generation + 1
+        return found
+
+    def mine(self, header, roll=roll_timestamp, max_rolls=None):
+        '''Returns header with a nonce meeting its target. When the nonce
+        space runs out the header is replaced with roll(header), such as
+        an ExtraNonceRoller. Returns None after max_rolls rolls.'''
+        rolls = 0
+        while True:
+            nonce = self.search(header)
+            if nonce is not None:
+                header.nonce = U32LE.pack(nonce)
+                return header
+            if max_rolls is not None and rolls >= max_rolls:
+                return None
+            header = roll(header)
+            rolls += 1
+
+    def close(self):
+        if self.pool is not None:
+            self.generation.value += 1
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+class MinerTest(TestCase):
+
+    def header(self, bits=b'\xff\xff\x7f\x20'):
+        return Block(0x20000000, b'\x11' * 32, b'\x22' * 32, 1296688700, bits, b'\x00' * 4)
+
+    def test_search_nonces(self):
+        header = self.header(target_to_bits(2**248))
+        prefix = header.serialize()[:76]
+        nonce = search_nonces(prefix, 2**248, 0, 10000)
+        header.nonce = U32LE.pack(nonce)
+        self.assertTrue(header.check_pow())
+        # the nonces before it don't work
+        for i in range(nonce):
+            header.nonce = U32LE.pack(i)
+            self.assertFalse(header.check_pow())
+        self.assertIsNone(search_nonces(prefix, 2**248, 0, nonce))
+
+    def test_regtest(self):
+        miner = Miner(workers=1)
+        header = miner.mine(self.header())
+        self.assertTrue(header.check_pow())
+        self.assertGreater(miner.hashes, 0)
+        self.assertGreater(miner.hash_rate(), 0)
+
+    def test_roll(self):
+        # about one in 256 hashes wins and only 16 nonces per header
+        bits = target_to_bits(2**248)
+        miner = Miner(workers=1, nonce_space=16)
+        header = miner.mine(self.header(bits))
+        self.assertTrue(header.check_pow())
+        self.assertGreater(header.timestamp, 1296688700)
+        rolls = header.timestamp - 1296688700
+        self.assertEqual(miner.hashes, 16 * rolls + U32LE.unpack(header.nonce)[0] + 1)
+        self.assertIsNone(miner.mine(self.header(target_to_bits(1)), max_rolls=2))
+
+    def test_extranonce(self):
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, b'\x03\x01\x02\x03')],
+                      [TxOut(5000000000, p2pkh_script(bytes(20)))], 0)
+        template = BlockTemplate(b'\x11' * 32, target_to_bits(2**248), 1296688700, coinbase)
+        template.add(Tx(1, [TxIn(b'\x33' * 32, 0, b'')], [TxOut(1000, p2pkh_script(bytes(20)))], 0))
+        miner = Miner(workers=1, nonce_space=16)
+        roller = ExtraNonceRoller(template)
+        header = miner.mine(template.header(), roll=roller)
+        self.assertTrue(header.check_pow())
+        self.assertEqual(header.timestamp, 1296688700)
+        self.assertGreater(roller.extranonce, 0)
+        self.assertTrue(header.validate_merkle_root())
+        script_sig = template.txs[0].tx_ins[0].script_sig.serialize()
+        self.assertEqual(script_sig, b'\x03\x01\x02\x03\x04' + roller.extranonce.to_bytes(4, 'little'))
+        block = Block.parse_full(template.serialize(header))
+        self.assertEqual(block.hash(), header.hash())
+        self.assertTrue(block.validate_merkle_root())
+
+    def test_pool(self):
+        miner = Miner(workers=2, chunk_size=64, inline=0)
+        try:
+            header = self.header(target_to_bits(2**246))
+            found = miner.mine(header)
+            self.assertTrue(found.check_pow())
+            # the lowest winning nonce of the chunks that ran
+            prefix = found.serialize()[:76]
+            nonce = U32LE.unpack(found.nonce)[0]
+            self.assertIsNone(search_nonces(prefix, 2**246, nonce // 64 * 64, nonce))
+        finally:
+            miner.close()
+
+    def test_pool_stops(self):
+        miner = Miner(workers=2, chunk_size=1 << 30, inline=0)
+        try:
+            header = self.header(target_to_bits(2**246))
+            self.assertTrue(miner.mine(header).check_pow())
+            # the chunks still running were called off
+            self.assertEqual(miner.generation.value, 1)
+            prefix = header.serialize()[:76]
+            with mock.patch('mining._generation', miner.generation):
+                self.assertEqual(_search_chunk(prefix, 2**246, 0, 1 << 20, 1),
+                                 search_nonces(prefix, 2**246, 0, 1 << 20))
+                with mock.patch('mining.search_nonces') as search:
+                    self.assertIsNone(_search_chunk(prefix, 1, 0, 1 << 30, 0))
+                    search.assert_not_called()
+        finally:
+            miner.close()
@@ -2,10 +2,12 @@ from binascii import hexlify, unhexlify
 from io import BytesIO
 from unittest import TestCase
 
+import socket
+
 from helper import (
+    ByteReader,
+    ByteWriter,
     double_sha256,
-    int_to_little_endian,
-    little_endian_to_int,
 )
 
 
@@ -27,37 +29,47 @@ class NetworkEnvelope:
     @classmethod
     def parse(cls, s):
         '''Takes a stream and creates a NetworkEnvelope'''
+        r = ByteReader.wrap(s)
         # check the network magic b'\xf9\xbe\xb4\xd9'
-        magic = s.read(4)
-        if magic != b'\xf9\xbe\xb4\xd9':
+        magic = r.read_bytes_view(4)
+        if magic != NETWORK_MAGIC:
             raise RuntimeError('magic is not right')
         # command 12 bytes
-        command = s.read(12)
+        command = r.read(12)
         # payload length 4 bytes, little endian
-        payload_length = little_endian_to_int(s.read(4))
+        payload_length = r.read_u32le()
         # checksum 4 bytes, first four of double-sha256 of payload
-        checksum = s.read(4)
+        checksum = r.read_bytes_view(4)
         # payload is of length payload_length
-        payload = s.read(payload_length)
+        payload = r.read(payload_length)
         # verify checksum
         calculated_checksum = double_sha256(payload)[:4]
         if calculated_checksum != checksum:
             raise RuntimeError('checksum does not match')
+        r.sync(s)
         return cls(command, payload)
 
     def serialize(self):
         '''Returns the byte serialization of the entire network message'''
+        result = ByteWriter()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the network message to the ByteWriter buf'''
         # add the network magic b'\xf9\xbe\xb4\xd9'
-        result = b'\xf9\xbe\xb4\xd9'
+        buf.write(NETWORK_MAGIC)
         # command 12 bytes
-        result += self.command
+        buf.write(self.command)
         # payload length 4 bytes, little endian
-        result += int_to_little_endian(len(self.payload), 4)
+        buf.write_u32le(len(self.payload))
         # checksum 4 bytes, first four of double-sha256 of payload
-        result += double_sha256(self.payload)[:4]
+        buf.write(double_sha256(self.payload)[:4])
         # payload
-        result += self.payload
-        return result
+        buf.write(self.payload)
+
+    def serialized_size(self):
+        return 24 + len(self.payload)
 
 
 class NetworkEnvelopeTest(TestCase):
@@ -74,12 +86,29 @@ class NetworkEnvelopeTest(TestCase):
         self.assertEqual(envelope.command[:7], b'version')
         self.assertEqual(envelope.payload, msg[24:])
 
+    def test_parse_socket(self):
+        verack = unhexlify('f9beb4d976657261636b000000000000000000005df6e0e2')
+        ping = NetworkEnvelope(b'ping' + b'\x00' * 8, b'\x01' * 8).serialize()
+        a, b = socket.socketpair()
+        with a, b:
+            b.settimeout(5)
+            stream = b.makefile('rb')
+            a.sendall(verack + ping)
+            # the socket stays open, each parse reads only its envelope
+            self.assertEqual(NetworkEnvelope.parse(stream).command[:6], b'verack')
+            envelope = NetworkEnvelope.parse(stream)
+            self.assertEqual(envelope.command[:4], b'ping')
+            self.assertEqual(envelope.payload, b'\x01' * 8)
+            stream.close()
+
     def test_serialize(self):
         msg = unhexlify('f9beb4d976657261636b000000000000000000005df6e0e2')
         stream = BytesIO(msg)
         envelope = NetworkEnvelope.parse(stream)
         self.assertEqual(envelope.serialize(), msg)
+        self.assertEqual(envelope.serialized_size(), len(msg))
         msg = unhexlify('f9beb4d976657273696f6e0000000000650000005f1a69d2721101000100000000000000bc8f5e5400000000010000000000000000000000000000000000ffffc61b6409208d010000000000000000000000000000000000ffffcb0071c0208d128035cbc97953f80f2f5361746f7368693a302e392e332fcf05050001')
         stream = BytesIO(msg)
         envelope = NetworkEnvelope.parse(stream)
         self.assertEqual(envelope.serialize(), msg)
+        self.assertEqual(envelope.serialized_size(), len(msg))
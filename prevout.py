@@ -0,0 +1,159 @@
+from binascii import hexlify, unhexlify
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import requests
+
+
+class PrevoutProvider:
+    '''Where TxIn looks up the transactions its inputs spend from.
+    Subclasses implement raw_tx, which returns the serialized transaction
+    for the tx hash (big endian, as in TxIn.prev_tx) or raises
+    RuntimeError when it is not known.'''
+
+    def raw_tx(self, tx_hash, testnet=False):
+        raise NotImplementedError
+
+    def raw_txs(self, tx_hashes, testnet=False):
+        '''Returns a dict of tx hash to serialized transaction for all of
+        tx_hashes. Providers that can batch lookups override this.'''
+        return {tx_hash: self.raw_tx(tx_hash, testnet) for tx_hash in tx_hashes}
+
+
+class DictPrevoutProvider(PrevoutProvider):
+    '''Serves transactions from memory'''
+
+    def __init__(self, txs=None):
+        self.txs = dict(txs or {})
+
+    def add(self, tx_hash, raw):
+        self.txs[tx_hash] = bytes(raw)
+
+    def raw_tx(self, tx_hash, testnet=False):
+        if tx_hash not in self.txs:
+            raise RuntimeError('unknown transaction {}'.format(hexlify(tx_hash).decode('ascii')))
+        return self.txs[tx_hash]
+
+
+class DirectoryPrevoutProvider(PrevoutProvider):
+    '''Serves transactions from a directory holding one file of raw bytes
+    per transaction, named by the hex tx hash. Testnet transactions are
+    kept in a testnet subdirectory.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, tx_hash, testnet=False):
+        name = hexlify(tx_hash).decode('ascii') + '.tx'
+        if testnet:
+            return os.path.join(self.path, 'testnet', name)
+        return os.path.join(self.path, name)
+
+    def add(self, tx_hash, raw, testnet=False):
+        filename = self.filename(tx_hash, testnet)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write then rename so readers never see a partial file
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp, filename)
+
+    def raw_tx(self, tx_hash, testnet=False):
+        try:
+            with open(self.filename(tx_hash, testnet), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise RuntimeError('unknown transaction {}'.format(hexlify(tx_hash).decode('ascii')))
+
+
+class HttpPrevoutProvider(PrevoutProvider):
+    '''Fetches transactions from a block explorer's /rawtx endpoint,
+    reusing one HTTP connection'''
+
+    def __init__(self, url='https://btc-bitcore3.trezor.io/api',
+                 testnet_url='https://testnet.blockexplorer.com/api'):
+        self.url = url
+        self.testnet_url = testnet_url
+        self.session = requests.Session()
+
+    def raw_tx(self, tx_hash, testnet=False):
+        base = self.testnet_url if testnet else self.url
+        url = base + '/rawtx/{}'.format(hexlify(tx_hash).decode('ascii'))
+        js_response = self.session.get(url).json()
+        if 'rawtx' not in js_response:
+            raise RuntimeError('got from server: {}'.format(js_response))
+        return unhexlify(js_response['rawtx'])
+
+
+class RawTxHandler(BaseHTTPRequestHandler):
+    '''Answers /rawtx/<hash> from the server's txs dict, for testing'''
+
+    def do_GET(self):
+        tx_hash = self.path.rsplit('/', 1)[-1]
+        self.server.requests += 1
+        if tx_hash in self.server.txs:
+            body = {'rawtx': self.server.txs[tx_hash]}
+        else:
+            body = {'error': 'not found'}
+        payload = json.dumps(body).encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class PrevoutTest(TestCase):
+
+    txs = {
+        b'\x01' * 32: b'first',
+        b'\x02' * 32: b'second',
+    }
+
+    def check_provider(self, provider, testnet=False):
+        self.assertEqual(provider.raw_tx(b'\x01' * 32, testnet), b'first')
+        self.assertEqual(provider.raw_txs(list(self.txs), testnet), self.txs)
+        with self.assertRaises(RuntimeError):
+            provider.raw_tx(b'\x03' * 32, testnet)
+
+    def test_dict(self):
+        provider = DictPrevoutProvider()
+        for tx_hash, raw in self.txs.items():
+            provider.add(tx_hash, raw)
+        self.check_provider(provider)
+
+    def test_directory(self):
+        path = tempfile.mkdtemp()
+        try:
+            provider = DirectoryPrevoutProvider(path)
+            for tx_hash, raw in self.txs.items():
+                provider.add(tx_hash, raw, testnet=True)
+            self.check_provider(provider, testnet=True)
+            with self.assertRaises(RuntimeError):
+                provider.raw_tx(b'\x01' * 32)
+        finally:
+            shutil.rmtree(path)
+
+    def test_http(self):
+        server = HTTPServer(('127.0.0.1', 0), RawTxHandler)
+        server.txs = {hexlify(k).decode('ascii'): hexlify(v).decode('ascii') for k, v in self.txs.items()}
+        server.requests = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}'.format(server.server_port)
+            self.check_provider(HttpPrevoutProvider(url, url))
+            self.assertEqual(server.requests, 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
@@ -1,8 +1,9 @@
 from binascii import hexlify, unhexlify
-from io import BytesIO
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from helper import h160_to_p2pkh_address, h160_to_p2sh_address, hash160
+import random
+
+from helper import ByteWriter, Watchers, WatchedList, h160_to_p2pkh_address, h160_to_p2sh_address, hash160
 
 
 OP_CODES = {
@@ -126,10 +127,112 @@ OP_CODES = {
 }
 
 
+def _is_multisig(raw):
+    '''OP_m <pubkey> ... <pubkey> OP_n OP_CHECKMULTISIG'''
+    m = raw[0] - 0x50
+    n = raw[-2] - 0x50
+    if not 1 <= m <= n <= 16:
+        return False
+    offset, end, count = 1, len(raw) - 2, 0
+    while offset < end:
+        if raw[offset] not in (0x21, 0x41):
+            return False
+        offset += 1 + raw[offset]
+        count += 1
+    return offset == end and count == n
+
+
+def script_type(raw):
+    '''Classifies raw script bytes against the standard output templates by
+    length and fixed bytes. Returns the template name or None.'''
+    size = len(raw)
+    if size == 0:
+        return 'blank'
+    first = raw[0]
+    if size == 25 and raw[:3] == b'\x76\xa9\x14' and raw[23:] == b'\x88\xac':
+        # OP_DUP OP_HASH160 <20-byte hash> OP_EQUALVERIFY OP_CHECKSIG
+        return 'p2pkh'
+    elif size == 23 and raw[:2] == b'\xa9\x14' and raw[22] == 0x87:
+        # OP_HASH160 <20-byte hash> OP_EQUAL
+        return 'p2sh'
+    elif size == 22 and raw[:2] == b'\x00\x14':
+        # OP_0 <20-byte hash>
+        return 'p2wpkh'
+    elif size == 34 and raw[:2] == b'\x00\x20':
+        # OP_0 <32-byte hash>
+        return 'p2wsh'
+    elif (size == 35 and first == 0x21 or size == 67 and first == 0x41) \
+         and raw[-1] == 0xac:
+        # <pubkey> OP_CHECKSIG
+        return 'p2pk'
+    elif first == 0x6a:
+        # OP_RETURN <data>
+        return 'nulldata'
+    elif size >= 37 and raw[-1] == 0xae and _is_multisig(raw):
+        return 'multisig'
+    return None
+
+
+def push_size(size):
+    '''Returns the serialized length of a push of size bytes'''
+    if size <= 75:
+        return 1 + size
+    elif size <= 0xff:
+        return 2 + size
+    elif size <= 0xffff:
+        return 3 + size
+    return 5 + size
+
+
 class Script:
 
-    def __init__(self, elements):
-        self.elements = elements
+    def __init__(self, elements=None, raw=None):
+        # Watchers of the transaction parts holding the script, told when
+        # it is changed in place
+        self._watchers = None
+        self._elements = None
+        if elements is not None:
+            self._set_elements(elements)
+        # raw bytes the script was parsed from, serialized verbatim
+        # as long as the elements are not changed
+        self._raw = raw
+        # copy of the elements as decoded from raw
+        self._parsed = None
+        # type() result and the raw bytes it was computed from
+        self._type = None
+        self._type_raw = None
+        # instructions() result and the raw bytes it was computed from
+        self._instructions = None
+        self._instructions_raw = None
+
+    @property
+    def elements(self):
+        if self._elements is None:
+            self._set_elements(self.parse_elements(self._raw))
+            self._parsed = list(self._elements)
+        return self._elements
+
+    @elements.setter
+    def elements(self, elements):
+        self._set_elements(elements)
+        self._raw = None
+        self.touch()
+
+    def _set_elements(self, elements):
+        # a copy that tells the script when it is changed in place
+        self._elements = WatchedList(elements, self)
+
+    def watch(self, watcher, signed=True):
+        '''Has watcher.touch(signed) called whenever the script changes,
+        see helper.Watchers'''
+        if self._watchers is None:
+            self._watchers = Watchers(watcher, signed)
+        else:
+            self._watchers.add(watcher, signed)
+
+    def touch(self, signed=True):
+        if self._watchers is not None:
+            self._watchers.touch(signed)
 
     def __repr__(self):
         result = ''
@@ -142,67 +245,85 @@ class Script:
 
     @classmethod
     def parse(cls, binary):
-        s = BytesIO(binary)
+        '''Takes the raw script and returns a Script. The elements are
+        decoded on first use'''
+        return cls(raw=bytes(binary))
+
+    @staticmethod
+    def parse_elements(binary):
+        '''Decodes raw script bytes into a list of elements in one pass'''
+        raw = bytes(binary)
+        end = len(raw)
+        offset = 0
         elements = []
-        current = s.read(1)
-        while current != b'':
-            op_code = current[0]
-            if op_code == 0:
-                elements.append(b'')
-            elif 0 < op_code <= op_code <= 75:
-                # we have an element
-                elements.append(s.read(op_code))
-            elif 76 <= op_code <=78: # OP_PUSHDATA[1,2,4]
-                sz = s.read(op_code - 76 + 1)[0]
-                elements.append(s.read(sz))
+        while offset < end:
+            op_code = raw[offset]
+            offset += 1
+            if op_code <= 75:
+                # op_code is the length of the element
+                size = op_code
+            elif op_code <= 78:
+                # OP_PUSHDATA1, 2 and 4 have a 1, 2 or 4 byte length
+                width = 1 << (op_code - 76)
+                size = int.from_bytes(raw[offset:offset + width], 'little')
+                offset += width
             else:
                 elements.append(op_code)
-            current = s.read(1)
-        return cls(elements)
+                continue
+            # the element is truncated if the script ends early
+            elements.append(raw[offset:offset + size])
+            offset += size
+        return elements
+
+    def raw(self):
+        '''Returns the raw bytes if they still match the elements, else None'''
+        if self._raw is None:
+            return None
+        if self._elements is not None and self._elements != self._parsed:
+            # the element list was changed in place
+            self._raw = None
+        return self._raw
 
     def type(self):
-        '''Some standard pay-to type scripts.'''
-        if len(self.elements) == 0:
-            return 'blank'
-        elif self.elements[0] == 0x76 \
-           and self.elements[1] == 0xa9 \
-           and type(self.elements[2]) == bytes \
-           and len(self.elements[2]) == 0x14 \
-           and self.elements[3] == 0x88 \
-           and self.elements[4] == 0xac:
-            # p2pkh:
-            # OP_DUP OP_HASH160 <20-byte hash> <OP_EQUALVERIFY> <OP_CHECKSIG>
-            return 'p2pkh'
-        elif type(self.elements[0]) == bytes \
-            and len(self.elements[0]) == 33 \
-            and self.elements[-1] == 0xac:
-            return 'p2pk'
-        elif self.elements[0] == 0xa9 \
-             and type(self.elements[1]) == bytes \
-             and len(self.elements[1]) == 0x14 \
-           and self.elements[-1] == 0x87:
-            # p2sh:
-            # OP_HASH160 <20-byte hash> <OP_EQUAL>
-            return 'p2sh'
-        elif self.elements[0] == b'' \
-              and type(self.elements[1]) == bytes \
-              and len(self.elements[1]) == 0x14:
-            return 'p2wpkh'
-        elif self.elements[0] == b'' \
-              and type(self.elements[1]) == bytes \
-              and len(self.elements[1]) == 0x20:
-            return 'p2wsh'
-        elif type(self.elements[0]) == bytes \
-             and len(self.elements[0]) in (0x47, 0x48, 0x49) \
-             and type(self.elements[1]) == bytes \
-             and len(self.elements[1]) in (0x21, 0x41):
+        '''Some standard pay-to type scripts. The result is cached until
+        the script changes.'''
+        raw = self.serialize()
+        if self._type_raw is not raw:
+            self._type = script_type(raw) or self._sig_type()
+            self._type_raw = raw
+        return self._type
+
+    def instructions(self):
+        '''Returns the script as a tuple of (op_code, data) pairs for the
+        interpreter. Data pushes have op_code 0 and the pushed bytes,
+        other opcodes have data None. Cached until the script changes.'''
+        raw = self.serialize()
+        if self._instructions_raw is not raw:
+            self._instructions = tuple(
+                (0, element) if type(element) == bytes else (element, None)
+                for element in self.elements)
+            self._instructions_raw = raw
+        return self._instructions
+
+    def is_push_only(self):
+        return all(op_code == 0 or 79 <= op_code <= 96 for op_code, _ in self.instructions())
+
+    def _sig_type(self):
+        '''Classifies the scriptSigs the templates don't cover'''
+        elements = self.elements
+        if len(elements) > 1 \
+           and type(elements[0]) == bytes \
+           and len(elements[0]) in (0x47, 0x48, 0x49) \
+           and type(elements[1]) == bytes \
+           and len(elements[1]) in (0x21, 0x41):
             # p2pkh scriptSig:
             # <signature> <pubkey>
             return 'p2pkh sig'
-        elif len(self.elements) > 1 \
-             and type(self.elements[1]) == bytes \
-             and len(self.elements[1]) in (0x47, 0x48, 0x49) \
-             and self.elements[-1][-1] == 0xae:
+        elif len(elements) > 1 \
+             and type(elements[1]) == bytes \
+             and len(elements[1]) in (0x47, 0x48, 0x49) \
+             and type(elements[-1]) == bytes \
+             and elements[-1][-1:] == b'\xae':
             # HACK: assumes p2sh is a multisig
             # p2sh multisig:
             # <x> <sig1> ... <sigm> <redeemscript ends with OP_CHECKMULTISIG>
@@ -211,13 +332,52 @@ class Script:
             return 'unknown'
 
     def serialize(self):
-        result = b''
+        raw = self.raw()
+        if raw is not None:
+            return raw
+        result = ByteWriter()
+        self.serialize_into(result)
+        self._raw = bytes(result)
+        self._parsed = list(self._elements)
+        return self._raw
+
+    def serialize_into(self, buf):
+        '''Appends the script to the ByteWriter buf (without a length prefix)'''
+        raw = self.raw()
+        if raw is not None:
+            buf.write(raw)
+            return
         for element in self.elements:
             if type(element) == int:
-                result += bytes([element])
+                buf.write_u8(element)
             else:
-                result += bytes([len(element)]) + element
-        return result
+                # smallest length prefix that fits the element
+                size = len(element)
+                if size <= 75:
+                    buf.write_u8(size)
+                elif size <= 0xff:
+                    buf.write_u8(76)
+                    buf.write_u8(size)
+                elif size <= 0xffff:
+                    buf.write_u8(77)
+                    buf.write_u16le(size)
+                else:
+                    buf.write_u8(78)
+                    buf.write_u32le(size)
+                buf.write(element)
+
+    def serialized_size(self):
+        '''Returns the length of the serialized script without building it'''
+        raw = self.raw()
+        if raw is not None:
+            return len(raw)
+        size = 0
+        for element in self.elements:
+            if type(element) == int:
+                size += 1
+            else:
+                size += push_size(len(element))
+        return size
 
     def der_signature(self, index=0):
         '''index isn't used for p2pkh, for p2sh, means one of m sigs'''
@@ -312,6 +472,90 @@ class ScriptTest(TestCase):
         self.assertEqual(script_sig.sec_pubkey(index=0), unhexlify('022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb70'))
         self.assertEqual(script_sig.sec_pubkey(index=1), unhexlify('03b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb71'))
 
+    def test_lazy_parse(self):
+        # OP_PUSHDATA1 for a short push is kept verbatim until changed
+        raw = unhexlify('4c0401020304ac')
+        script = Script.parse(raw)
+        self.assertIsNone(script._elements)
+        self.assertEqual(script.serialize(), raw)
+        self.assertIsNone(script._elements)
+        self.assertEqual(script.elements, [b'\x01\x02\x03\x04', 0xac])
+        self.assertEqual(script.serialize(), raw)
+        script.elements.append(0x87)
+        self.assertEqual(script.serialize(), unhexlify('0401020304ac87'))
+        script.elements = [0x51]
+        self.assertEqual(script.serialize(), b'\x51')
+        self.assertEqual(script.serialized_size(), 1)
+
+    def test_script_type(self):
+        cases = (
+            ('76a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac', 'p2pkh'),
+            ('a91474d691da1574e6b3c192ecfb52cc8984ee7b6c5687', 'p2sh'),
+            ('00141d0f172a0ecb48aee1be1f2687d2963ae33f71a1', 'p2wpkh'),
+            ('0020701a8d401c84fb13e6baf169d59684e17abd9fa216c8cc5b9fc63d622ff8c58d', 'p2wsh'),
+            ('2103c9f4836b9a4f77fc0d81f7bcb01b7f1b35916864b9476c241ce9fc198bd25432ac', 'p2pk'),
+            ('6a0b68656c6c6f20776f726c64', 'nulldata'),
+            ('5221022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb702103b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb7152ae', 'multisig'),
+            ('', 'blank'),
+            ('76a9', 'unknown'),
+            ('5321022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb7052ae', 'unknown'),
+        )
+        for raw_hex, want in cases:
+            self.assertEqual(Script.parse(unhexlify(raw_hex)).type(), want)
+
+    def test_type_cached(self):
+        script = Script.parse(unhexlify('76a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac'))
+        with mock.patch('script.script_type', wraps=script_type) as classify:
+            for _ in range(5):
+                self.assertEqual(script.type(), 'p2pkh')
+            self.assertEqual(classify.call_count, 1)
+            script.elements = [0xa9, b'\x00' * 20, 0x87]
+            self.assertEqual(script.type(), 'p2sh')
+            self.assertEqual(classify.call_count, 2)
+
+    def test_pushdata(self):
+        # a 2-of-3 redeem script is over 75 bytes so needs OP_PUSHDATA1
+        redeem_script = unhexlify('5221022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb702103b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb712103b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb7153ae')
+        for size, prefix in ((75, b'\x4b'), (76, b'\x4c\x4c'), (255, b'\x4c\xff'),
+                             (256, b'\x4d\x00\x01'), (520, b'\x4d\x08\x02'),
+                             (0x10000, b'\x4e\x00\x00\x01\x00')):
+            element = (redeem_script * (size // len(redeem_script) + 1))[:size]
+            script = Script([b'', element, 0xae])
+            want = b'\x00' + prefix + element + b'\xae'
+            self.assertEqual(script.serialize(), want)
+            self.assertEqual(script.serialized_size(), len(want))
+            self.assertEqual(Script.parse(want).elements, [b'', element, 0xae])
+        # non-minimal pushes are kept verbatim
+        raw = b'\x4e\x02\x00\x00\x00ab\x4d\x01\x00c'
+        self.assertEqual(Script.parse(raw).elements, [b'ab', b'c'])
+        self.assertEqual(Script.parse(raw).serialize(), raw)
+
+    def test_round_trip_fuzz(self):
+        rng = random.Random(2018)
+        op_codes = [op for op in OP_CODES if op > 78]
+        sizes = (1, 20, 33, 72, 75, 76, 200, 255, 256, 520, 0xffff, 0x10000)
+        for _ in range(200):
+            elements = []
+            for _ in range(rng.randint(0, 12)):
+                if rng.random() < 0.5:
+                    elements.append(rng.choice(op_codes))
+                else:
+                    size = rng.choice(sizes) if rng.random() < 0.5 else rng.randint(0, 80)
+                    elements.append(bytes(rng.getrandbits(8) for _ in range(size)))
+            raw = Script(elements).serialize()
+            self.assertEqual(len(raw), Script(list(elements)).serialized_size())
+            script = Script.parse(raw)
+            self.assertEqual(script.elements, elements)
+            # re-encoding the decoded elements gives the same bytes
+            self.assertEqual(Script(script.elements).serialize(), raw)
+        # arbitrary bytes, including truncated pushes, parse without error
+        # and serialize back unchanged
+        for _ in range(500):
+            raw = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 40)))
+            script = Script.parse(raw)
+            script.elements
+            self.assertEqual(script.serialize(), raw)
+
     def test_address(self):
         script_raw = unhexlify('76a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac')
         script_pubkey = Script.parse(script_raw)
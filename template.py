@@ -0,0 +1,348 @@
+from heapq import heapify, heappop, heappush
+from unittest import TestCase
+
+from block import Block
+from helper import MerkleTree, double_sha256, encode_varint, merkle_root, p2pkh_script
+from tx import Tx, TxIn, TxOut
+
+
+MAX_BLOCK_WEIGHT = 4000000
+# weight kept free for the coinbase, which is added after selection
+COINBASE_RESERVED_WEIGHT = 4000
+# OP_RETURN, push 36 bytes, then the commitment header of BIP141
+WITNESS_COMMITMENT_HEADER = b'\x6a\x24\xaa\x21\xa9\xed'
+
+
+class MempoolEntry:
+    '''A mempool transaction with the fee and weight of it and all its
+    unconfirmed ancestors'''
+
+    def __init__(self, tx, fee, weight):
+        self.tx = tx
+        self.txid = tx.txid()
+        self.wtxid = tx.hash()
+        self.fee = fee
+        self.weight = weight
+        self.parents = set()
+        self.children = set()
+        self.ancestors = set()
+        self.ancestor_fee = fee
+        self.ancestor_weight = weight
+
+    def score(self):
+        '''Returns minus the ancestor fee rate, so the best sorts first'''
+        return -self.ancestor_fee / self.ancestor_weight
+
+
+class Mempool:
+    '''Unconfirmed transactions by txid. Ancestor sets and totals are
+    worked out once when a transaction is added, which has to happen
+    after its unconfirmed parents were added.
+
+    heap holds (score, txid) for every entry, kept as transactions come
+    and go so a template starts from a copy of it instead of sorting the
+    whole mempool. Entries left behind by removals are skipped by
+    BlockTemplate.fill and dropped when they outnumber the live ones.'''
+
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def add(self, tx, fee=None):
+        '''Adds tx paying fee, looked up with Tx.fee if not given'''
+        if fee is None:
+            fee = tx.fee()
+        entry = MempoolEntry(tx, fee, tx.weight())
+        for tx_in in tx.tx_ins:
+            if tx_in.prev_tx in self.entries:
+                entry.parents.add(tx_in.prev_tx)
+                self.entries[tx_in.prev_tx].children.add(entry.txid)
+        for parent in entry.parents:
+            entry.ancestors.add(parent)
+            entry.ancestors |= self.entries[parent].ancestors
+        for ancestor in entry.ancestors:
+            entry.ancestor_fee += self.entries[ancestor].fee
+            entry.ancestor_weight += self.entries[ancestor].weight
+        self.entries[entry.txid] = entry
+        heappush(self.heap, (entry.score(), entry.txid))
+        return entry
+
+    def descendants(self, txid):
+        '''Returns the txids of all the transactions spending from txid,
+        directly or not'''
+        result = set()
+        todo = list(self.entries[txid].children)
+        while todo:
+            child = todo.pop()
+            if child not in result:
+                result.add(child)
+                todo.extend(self.entries[child].children)
+        return result
+
+    def remove(self, txid):
+        '''Removes a transaction that got mined. Its descendants stay and
+        stop counting it as an ancestor.'''
+        entry = self.entries[txid]
+        descendants = self.descendants(txid)
+        for descendant in descendants:
+            other = self.entries[descendant]
+            other.ancestors.discard(txid)
+            other.ancestor_fee -= entry.fee
+            other.ancestor_weight -= entry.weight
+            heappush(self.heap, (other.score(), descendant))
+        for child in entry.children:
+            self.entries[child].parents.discard(txid)
+        for parent in entry.parents:
+            self.entries[parent].children.discard(txid)
+        del self.entries[txid]
+        self.stale += 1 + len(descendants)
+        if self.stale > len(self.entries):
+            self.heap = [(e.score(), t) for t, e in self.entries.items()]
+            heapify(self.heap)
+            self.stale = 0
+
+
+class BlockTemplate:
+    '''A block being assembled on top of prev_block. The merkle trees of
+    txids and of wtxids are updated as transactions are added or
+    removed and when the coinbase is replaced, instead of being hashed
+    again for every header.
+
+    The coinbase is the caller's: give a placeholder, then set_coinbase
+    the one paying the subsidy plus fee and, if the block has witness
+    transactions, with an output of witness_commitment().'''
+
+    def __init__(self, prev_block, bits, timestamp, coinbase, version=0x20000000,
+                 max_weight=MAX_BLOCK_WEIGHT):
+        self.prev_block = prev_block
+        self.bits = bits
+        self.timestamp = timestamp
+        self.version = version
+        self.max_weight = max_weight
+        self.txs = [coinbase]
+        self.fees = [0]
+        self.positions = {coinbase.txid(): 0}
+        self.tree = MerkleTree([coinbase.txid()[::-1]])
+        # the coinbase wtxid is taken as 0 in the witness commitment
+        self.witness_tree = MerkleTree([b'\x00' * 32])
+        # header, a 3 byte transaction count and the coinbase
+        self.weight = 4 * (80 + 3) + COINBASE_RESERVED_WEIGHT
+        self.fee = 0
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txid):
+        return txid in self.positions
+
+    def add(self, tx, fee=0):
+        '''Appends tx, whose inputs must be confirmed or before it'''
+        self._append(tx, tx.txid(), tx.hash(), fee, tx.weight())
+
+    def _append(self, tx, txid, wtxid, fee, weight):
+        self.positions[txid] = len(self.txs)
+        self.txs.append(tx)
+        self.fees.append(fee)
+        self.tree.append(txid[::-1])
+        self.witness_tree.append(wtxid[::-1])
+        self.weight += weight
+        self.fee += fee
+
+    def remove(self, txid):
+        '''Removes a transaction and those in the block spending from it'''
+        removed = {txid}
+        start = self.positions[txid]
+        kept = []
+        for tx, fee in zip(self.txs[start:], self.fees[start:]):
+            if tx.txid() in removed or any(t.prev_tx in removed for t in tx.tx_ins):
+                removed.add(tx.txid())
+                self.weight -= tx.weight()
+                self.fee -= fee
+            else:
+                kept.append((tx, fee))
+        del self.txs[start:]
+        del self.fees[start:]
+        self.tree.truncate(start)
+        self.witness_tree.truncate(start)
+        for txid in removed:
+            del self.positions[txid]
+        for tx, fee in kept:
+            self.positions[tx.txid()] = len(self.txs)
+            self.txs.append(tx)
+            self.fees.append(fee)
+            self.tree.append(tx.txid()[::-1])
+            self.witness_tree.append(tx.hash()[::-1])
+
+    def set_coinbase(self, coinbase):
+        '''Replaces the coinbase, one hash per merkle tree level'''
+        del self.positions[self.txs[0].txid()]
+        self.positions[coinbase.txid()] = 0
+        self.txs[0] = coinbase
+        self.tree.replace(0, coinbase.txid()[::-1])
+
+    def fill(self, mempool):
+        '''Adds mempool transactions with the highest fee per weight,
+        counting in their ancestors not in the block yet, until the block
+        is full. Returns the number of transactions added.'''
+        entries = mempool.entries
+
+        def package(txid):
+            entry = entries[txid]
+            if not entry.ancestors:
+                return [txid], -entry.fee / entry.weight
+            missing = [a for a in entry.ancestors if a not in self.positions]
+            missing.append(txid)
+            fee = sum(entries[t].fee for t in missing)
+            weight = sum(entries[t].weight for t in missing)
+            return missing, -fee / weight
+
+        # a copy of a heap is a heap
+        heap = list(mempool.heap)
+        # the merkle trees are extended in one go at the end
+        start = len(self.txs)
+        failures = 0
+        while heap:
+            score, txid = heappop(heap)
+            if txid in self.positions or txid not in entries:
+                continue
+            missing, current = package(txid)
+            if current != score:
+                # the score changed since this was pushed, look again
+                # once the heap gets down to the current one
+                heappush(heap, (current, txid))
+                continue
+            weight = sum(entries[t].weight for t in missing)
+            if self.weight + weight > self.max_weight:
+                failures += 1
+                # give up when nearly full rather than try everything
+                if failures > 1000 and self.weight > self.max_weight - 4000:
+                    break
+                continue
+            # ancestors have fewer ancestors than their descendants
+            missing.sort(key=lambda t: len(entries[t].ancestors))
+            for t in missing:
+                entry = entries[t]
+                self.positions[t] = len(self.txs)
+                self.txs.append(entry.tx)
+                self.fees.append(entry.fee)
+                self.weight += entry.weight
+                self.fee += entry.fee
+            # descendants of the package now score without it
+            for t in missing:
+                if entries[t].children:
+                    for descendant in mempool.descendants(t):
+                        if descendant not in self.positions:
+                            heappush(heap, (package(descendant)[1], descendant))
+        new = [entries[tx.txid()] for tx in self.txs[start:]]
+        self.tree.extend([entry.txid[::-1] for entry in new])
+        self.witness_tree.extend([entry.wtxid[::-1] for entry in new])
+        return len(new)
+
+    def merkle_root(self):
+        '''Returns the merkle root in the byte order of Block.merkle_root'''
+        return self.tree.root()[::-1]
+
+    def witness_commitment(self, reserved=b'\x00' * 32):
+        '''Returns the scriptPubKey committing to the wtxids, for a coinbase
+        whose witness is the 32 byte reserved value'''
+        return WITNESS_COMMITMENT_HEADER + double_sha256(self.witness_tree.root() + reserved)
+
+    def header(self):
+        '''Returns the block header as a Block with a zero nonce'''
+        return Block(self.version, self.prev_block, self.merkle_root(), self.timestamp,
+                     self.bits, b'\x00' * 4, tx_hashes=[tx.txid() for tx in self.txs])
+
+    def serialize(self, header=None):
+        '''Returns the full block, with header or the zero nonce one'''
+        header = header or self.header()
+        parts = [header.serialize(), encode_varint(len(self.txs))]
+        parts.extend(tx.serialize() for tx in self.txs)
+        return b''.join(parts)
+
+
+class BlockTemplateTest(TestCase):
+
+    def make_tx(self, prev_tx, amount=1000, witness=False):
+        tx = Tx(1, [TxIn(prev_tx, 0, b'')], [TxOut(amount, p2pkh_script(bytes(20)))], 0)
+        if witness:
+            tx.tx_ins[0].script_witness = [b'\x01' * 72]
+        return tx
+
+    def coinbase(self, amount=5000000000):
+        return Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, b'\x03\x01\x02\x03')],
+                  [TxOut(amount, p2pkh_script(bytes(20)))], 0)
+
+    def test_mempool(self):
+        mempool = Mempool()
+        parent = self.make_tx(b'\x01' * 32)
+        child = self.make_tx(parent.txid())
+        grandchild = self.make_tx(child.txid())
+        for tx, fee in ((parent, 100), (child, 200), (grandchild, 300)):
+            mempool.add(tx, fee)
+        entry = mempool.entries[grandchild.txid()]
+        self.assertEqual(entry.ancestors, {parent.txid(), child.txid()})
+        self.assertEqual(entry.ancestor_fee, 600)
+        self.assertEqual(entry.ancestor_weight, 3 * parent.weight())
+        self.assertEqual(mempool.descendants(parent.txid()), {child.txid(), grandchild.txid()})
+        mempool.remove(parent.txid())
+        self.assertEqual(entry.ancestors, {child.txid()})
+        self.assertEqual(entry.ancestor_fee, 500)
+        self.assertEqual(mempool.entries[child.txid()].parents, set())
+
+    def test_fill(self):
+        mempool = Mempool()
+        # a parent paying little with a child paying for both
+        parent = self.make_tx(b'\x01' * 32)
+        child = self.make_tx(parent.txid())
+        medium = self.make_tx(b'\x02' * 32)
+        low = self.make_tx(b'\x03' * 32, witness=True)
+        mempool.add(parent, 10)
+        mempool.add(child, 5000)
+        mempool.add(medium, 2000)
+        mempool.add(low, 100)
+        weight = parent.weight()
+        room = 4 * (80 + 3) + COINBASE_RESERVED_WEIGHT + 3 * weight
+        template = BlockTemplate(b'\x00' * 32, b'\xff\xff\x7f\x20', 1296688700, self.coinbase(),
+                                 max_weight=room)
+        self.assertEqual(template.fill(mempool), 3)
+        self.assertEqual([tx.txid() for tx in template.txs[1:]],
+                         [parent.txid(), child.txid(), medium.txid()])
+        self.assertEqual(template.fee, 7010)
+        self.assertLessEqual(template.weight, room)
+        header = template.header()
+        self.assertEqual(header.nonce, b'\x00' * 4)
+        self.assertTrue(header.validate_merkle_root())
+        # the rest fits once the limit goes up
+        template.max_weight = MAX_BLOCK_WEIGHT
+        self.assertEqual(template.fill(mempool), 1)
+        hashes = [tx.hash()[::-1] for tx in template.txs[1:]]
+        want = WITNESS_COMMITMENT_HEADER + double_sha256(merkle_root([b'\x00' * 32] + hashes) + b'\x00' * 32)
+        self.assertEqual(template.witness_commitment(), want)
+        self.assertTrue(template.header().validate_merkle_root())
+
+    def test_incremental_merkle(self):
+        template = BlockTemplate(b'\x00' * 32, b'\xff\xff\x7f\x20', 1296688700, self.coinbase())
+        txs = [self.make_tx(bytes([i]) * 32) for i in range(1, 10)]
+        for tx in txs:
+            template.add(tx, 10)
+        spending = self.make_tx(txs[3].txid())
+        template.add(spending, 10)
+        template.remove(txs[3].txid())
+        self.assertNotIn(spending.txid(), template)
+        self.assertEqual(template.fee, 80)
+        self.assertEqual(len(template), 9)
+        coinbase = self.coinbase(5000000080)
+        coinbase.tx_outs.append(TxOut(0, template.witness_commitment()))
+        template.set_coinbase(coinbase)
+        want = [coinbase.txid()] + [tx.txid() for tx in txs[:3] + txs[4:]]
+        self.assertEqual(template.merkle_root(), merkle_root([h[::-1] for h in want])[::-1])
+        block = Block.parse_full(template.serialize())
+        self.assertEqual(block.txids(), want)
+        self.assertTrue(block.validate_merkle_root())
@@ -1,6 +1,5 @@
 from binascii import hexlify, unhexlify
 from io import BytesIO
-from unittest import TestCase
 
 import random
 import requests
@@ -17,9 +16,10 @@ from helper import (
     SIGHASH_ALL,
 )
 from script import Script
+from tx import TxInCacheTestCase
 from wtx import Tx, TxIn, TxOut
 
-class TxTest(TestCase):
+class TxTest(TxInCacheTestCase):
 
     def test_sign_witness(self):
         # from https://github.com/bitcoin/bips/blob/master/bip-0143.mediawiki
@@ -1,31 +1,289 @@
 from binascii import hexlify, unhexlify
+from array import array
 from io import BytesIO
-from unittest import TestCase
+from unittest import TestCase, mock
 
+import hashlib
 import random
-import requests
+import struct
 
-from ecc import PrivateKey, S256Point, Signature
+from ecc import PrivateKey
 from helper import (
+    ByteReader,
+    ByteWriter,
+    TxCache,
+    WatchedList,
+    Watchers,
     decode_base58,
     double_sha256,
     encode_varint,
+    hash160,
     int_to_little_endian,
     little_endian_to_int,
     p2pkh_script,
-    read_varint,
+    varint_size,
     SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_NONE,
+    SIGHASH_SINGLE,
+    U32LE,
+    U64LE,
+    decode_varint,
 )
-from script import Script
+from interpreter import TxSignatureChecker, verify_script
+from prevout import DictPrevoutProvider, HttpPrevoutProvider
+from script import Script, script_type
+
+
+class TxEdits:
+    '''Edit counters of one transaction for its caches: signed counts
+    changes to fields that get signed, serialized changes to anything
+    that gets serialized. The inputs, outputs, their scripts and witness
+    lists tell the counters of the transactions they are in when they are
+    changed in place; building or parsing transactions doesn't count.'''
+
+    __slots__ = ('signed', 'serialized', '__weakref__')
+
+    def __init__(self):
+        self.signed = 0
+        self.serialized = 0
+
+    def touch(self, signed=True):
+        if signed:
+            self.signed += 1
+        self.serialized += 1
+
+
+class TxList(WatchedList):
+    '''List of inputs or outputs, watching them for changes'''
+
+    __slots__ = ()
+
+    def added(self, items):
+        for item in items:
+            item.watch(self)
+
+
+class WitnessList(WatchedList):
+    '''Witness items of an input, which change the wtxid but aren't signed'''
+
+    __slots__ = ()
+
+
+class LegacySigHasher:
+    '''Computes the pre-segwit signature hashes of every input of tx.
+    The version, the inputs with blank scripts, the outputs and the
+    locktime are serialized once, sig_hash splices the script code of
+    the input being signed in between.'''
+
+    def __init__(self, tx):
+        self.tx_edits = tx._edits
+        self.edits = tx._edits.signed
+        self.version = U32LE.pack(tx.version)
+        self.locktime = U32LE.pack(tx.locktime)
+        self.outpoints = []
+        self.sequences = []
+        blank_inputs = ByteWriter()
+        for tx_in in tx.tx_ins:
+            outpoint = tx_in.prev_tx[::-1] + U32LE.pack(tx_in.prev_index)
+            sequence = U32LE.pack(tx_in.sequence)
+            self.outpoints.append(outpoint)
+            self.sequences.append(sequence)
+            # outpoint, empty scriptSig, sequence: 41 bytes each
+            blank_inputs.write(outpoint)
+            blank_inputs.write_u8(0)
+            blank_inputs.write(sequence)
+        self.blank_inputs = bytes(blank_inputs)
+        self.outputs = [tx_out.serialize() for tx_out in tx.tx_outs]
+        self.all_outputs = encode_varint(len(self.outputs)) + b''.join(self.outputs)
+        # sha256 state after the inputs before index i, for SIGHASH_ALL
+        self.midstates = [hashlib.sha256(self.version + encode_varint(len(self.outpoints)))]
+
+    def is_current(self):
+        '''Returns whether the transaction is unchanged since computing'''
+        return self.edits == self.tx_edits.signed
+
+    def prefix(self, input_index):
+        '''Returns a sha256 object fed up to the input at input_index'''
+        midstates = self.midstates
+        while len(midstates) <= input_index:
+            i = len(midstates) - 1
+            h = midstates[-1].copy()
+            h.update(self.blank_inputs[41 * i:41 * (i + 1)])
+            midstates.append(h)
+        return midstates[input_index].copy()
+
+    def sig_hash(self, input_index, hash_type, script_code):
+        '''Returns the 32 byte hash to sign for input_index, where
+        script_code is the raw script replacing its scriptSig'''
+        base_type = hash_type & 0x1f
+        if base_type == SIGHASH_SINGLE and input_index >= len(self.outputs):
+            # no matching output, the original client signs the number 1
+            return b'\x01' + b'\x00' * 31
+        own_input = self.outpoints[input_index] + encode_varint(len(script_code)) \
+            + script_code + self.sequences[input_index]
+        if hash_type & SIGHASH_ANYONECANPAY:
+            # only the input being signed
+            h = hashlib.sha256(self.version + b'\x01' + own_input)
+        elif base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+            # the other inputs are signed with sequence 0
+            h = hashlib.sha256(self.version + encode_varint(len(self.outpoints)))
+            for i, outpoint in enumerate(self.outpoints):
+                if i == input_index:
+                    h.update(own_input)
+                else:
+                    h.update(outpoint + b'\x00\x00\x00\x00\x00')
+        else:
+            h = self.prefix(input_index)
+            h.update(own_input)
+            h.update(memoryview(self.blank_inputs)[41 * (input_index + 1):])
+        if base_type == SIGHASH_NONE:
+            h.update(b'\x00')
+        elif base_type == SIGHASH_SINGLE:
+            # blank outputs (amount -1, empty script) before the signed one
+            h.update(encode_varint(input_index + 1))
+            h.update((b'\xff' * 8 + b'\x00') * input_index)
+            h.update(self.outputs[input_index])
+        else:
+            h.update(self.all_outputs)
+        h.update(self.locktime)
+        h.update(U32LE.pack(hash_type))
+        return hashlib.sha256(h.digest()).digest()
+
+
+def stripped_hash(raw, inputs_start, witness_start):
+    '''Returns the double sha256 of the serialized transaction raw
+    without the segwit marker, flag and witnesses, the txid in internal
+    byte order. inputs_start and witness_start are where the input count
+    and the witnesses (or the locktime) start in raw.'''
+    view = memoryview(raw)
+    h = hashlib.sha256(view[:4])
+    h.update(view[inputs_start:witness_start])
+    h.update(view[-4:])
+    return hashlib.sha256(h.digest()).digest()
+
+
+def scan_tx(buf, offset=0):
+    '''Walks the serialized transaction at offset in buf without decoding
+    it. Returns where its input count and its witnesses (or locktime if it
+    has none) start and where it ends, all relative to buf.'''
+    view = memoryview(buf)
+    try:
+        offset += 4
+        segwit = view[offset] == 0 and view[offset + 1] == 1
+        if segwit:
+            offset += 2
+        inputs_start = offset
+        num_inputs, offset = decode_varint(view, offset)
+        for _ in range(num_inputs):
+            length, offset = decode_varint(view, offset + 36)
+            offset += length + 4
+        num_outputs, offset = decode_varint(view, offset)
+        for _ in range(num_outputs):
+            length, offset = decode_varint(view, offset + 8)
+            offset += length
+        witness_start = offset
+        if segwit:
+            for _ in range(num_inputs):
+                items, offset = decode_varint(view, offset)
+                for _ in range(items):
+                    length, offset = decode_varint(view, offset)
+                    offset += length
+    except (IndexError, struct.error):
+        raise RuntimeError('transaction is truncated')
+    end = offset + 4
+    if end > len(view):
+        raise RuntimeError('transaction is truncated')
+    return inputs_start, witness_start, end
+
+
+class PrecomputedTxData:
+    '''The BIP143 digests that are the same for every input of a
+    transaction. Compute once and share across signing or verifying
+    all the inputs.'''
+
+    def __init__(self, tx):
+        self.tx_edits = tx._edits
+        self.edits = tx._edits.signed
+        prevouts = ByteWriter()
+        sequences = ByteWriter()
+        for tx_in in tx.tx_ins:
+            prevouts.write(tx_in.prev_tx[::-1])
+            prevouts.write_u32le(tx_in.prev_index)
+            sequences.write_u32le(tx_in.sequence)
+        outputs = ByteWriter()
+        for tx_out in tx.tx_outs:
+            tx_out.serialize_into(outputs)
+        self.hash_prevouts = double_sha256(prevouts)
+        self.hash_sequence = double_sha256(sequences)
+        self.hash_outputs = double_sha256(outputs)
+
+    def is_current(self):
+        '''Returns whether no input or output changed since computing'''
+        return self.edits == self.tx_edits.signed
+
 
 class Tx:
+    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False, prevouts=None):
+        # filled in directly, a new transaction has no caches to invalidate
+        fields = self.__dict__
+        fields['_edits'] = TxEdits()
+        fields['version'] = version
+        fields['tx_ins'] = self._watched(tx_ins)
+        fields['tx_outs'] = self._watched(tx_outs)
+        fields['locktime'] = locktime
+        fields['testnet'] = testnet
+        # PrevoutProvider to look up the outputs being spent, None for
+        # the TxIn default
+        fields['prevouts'] = prevouts
+
+    def _watched(self, items):
+        '''Returns items as a TxList telling this transaction's TxEdits'''
+        if type(items) != TxList:
+            return TxList(items, self._edits)
+        items.watch(self._edits)
+        return items
+
+    def __setattr__(self, name, value):
+        if name in ('tx_ins', 'tx_outs'):
+            value = self._watched(value)
+        if name in ('version', 'tx_ins', 'tx_outs', 'locktime') and name in self.__dict__:
+            self._edits.touch()
+        object.__setattr__(self, name, value)
 
-    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False):
-        self.version = version
-        self.tx_ins = tx_ins
-        self.tx_outs = tx_outs
-        self.locktime = locktime
-        self.testnet = testnet
+    def raw(self):
+        '''Returns the bytes the transaction was parsed from and the offsets
+        of the inputs and of the witnesses in them, if nothing changed
+        since. Else None. Changes in place to the inputs, outputs, their
+        scripts and witnesses count too, see TxEdits.'''
+        raw = self.__dict__.get('_raw')
+        if raw is not None and raw[0] == self._edits.serialized:
+            return raw[1:]
+        return None
+
+    def txid(self):
+        """ non-witness serialization for txid """
+        # as TxIn doesn't include signature anymore this serialization is immune to tx malleability problem
+        cached = self.__dict__.get('_txid')
+        if cached is None or cached[0] != self._edits.serialized:
+            parsed = self.raw()
+            if parsed is None:
+                s256 = double_sha256(self.serialize(with_witness=False))
+            else:
+                s256 = stripped_hash(*parsed)
+            cached = (self._edits.serialized, s256[::-1])
+            self._txid = cached
+        return cached[1]
+
+    def hash(self):
+        """ witness id """
+        cached = self.__dict__.get('_hash')
+        if cached is None or cached[0] != self._edits.serialized:
+            parsed = self.raw()
+            raw = self.serialize() if parsed is None else parsed[0]
+            cached = (self._edits.serialized, double_sha256(raw)[::-1])
+            self._hash = cached
+        return cached[1]
 
     def __repr__(self):
         tx_ins = ''
@@ -43,57 +301,209 @@ class Tx:
 
     @classmethod
     def parse(cls, s):
-        '''Takes a byte stream and parses the transaction at the start
-        return a Tx object
+        '''Takes a byte stream, a ByteReader or a buffer and parses the
+        transaction at the start, return a Tx object. Streams are left
+        positioned right after the transaction.
         '''
-        # s.read(n) will return n bytes
+        r = ByteReader.wrap(s)
+        start = r.tell()
         # version has 4 bytes, little-endian, interpret as int
-        version = little_endian_to_int(s.read(4))
-        # num_inputs is a varint, use read_varint(s)
-        num_inputs = read_varint(s)
-        # each input needs parsing
+        version = r.read_u32le()
+
+        # check witness: marker 0x00 and flag 0x01 follow the version
+        has_witnesses = r.peek(2) == b'\x00\x01'
+        if has_witnesses:
+            # witness tx
+            r.read_bytes_view(2)
+        inputs_start = r.tell() - start
+
+        # num_inputs is a varint, use r.read_varint()
+        num_inputs = r.read_varint()
+        # each input needs parsing, note where each starts
         inputs = []
+        input_offsets = []
         for _ in range(num_inputs):
-            inputs.append(TxIn.parse(s))
-        # num_outputs is a varint, use read_varint(s)
-        num_outputs = read_varint(s)
-        # each output needs parsing
+            input_offsets.append(r.tell() - start)
+            inputs.append(TxIn.parse(r))
+        outputs_start = r.tell() - start
+        # num_outputs is a varint, use r.read_varint()
+        num_outputs = r.read_varint()
+        # each output needs parsing, note where each starts
         outputs = []
+        output_offsets = []
         for _ in range(num_outputs):
-            outputs.append(TxOut.parse(s))
+            output_offsets.append(r.tell() - start)
+            outputs.append(TxOut.parse(r))
+
+        witness_start = r.tell() - start
+        # no of script witnesses implied by txin_count
+        if has_witnesses:
+            for tx_in in inputs:
+                witness = []
+                for _ in range(r.read_varint()):
+                    sz_witness = r.read_varint()
+                    witness.append(r.read(sz_witness))
+                # the input isn't in a transaction yet, this isn't an edit
+                list.extend(tx_in.script_witness, witness)
+
         # locktime is 4 bytes, little-endian
-        locktime = little_endian_to_int(s.read(4))
+        locktime_start = r.tell() - start
+        locktime = r.read_u32le()
+        # keep the bytes parsed to hash for the txid and wtxid
+        raw = r.slice(start, r.tell())
+        r.sync(s)
         # return an instance of the class (cls(...))
-        return cls(version, inputs, outputs, locktime)
+        tx = cls(version, inputs, outputs, locktime)
+        tx._raw = (tx._edits.serialized, raw, inputs_start, witness_start)
+        tx.offsets = {
+            'version': 0,
+            'inputs': inputs_start,
+            'tx_ins': input_offsets,
+            'outputs': outputs_start,
+            'tx_outs': output_offsets,
+            'witness': witness_start,
+            'locktime': locktime_start,
+            'end': len(raw),
+        }
+        return tx
 
-    def serialize(self):
+    @classmethod
+    def parse_many(cls, s, count=None):
+        '''Parses count transactions stored back to back, or all of them
+        up to the end if count is None. s is anything Tx.parse takes and
+        is left positioned after the last transaction.'''
+        r = ByteReader.wrap(s)
+        txs = []
+        while (r.remaining() > 0) if count is None else (len(txs) < count):
+            txs.append(cls.parse(r))
+        r.sync(s)
+        return txs
+
+    def field_offset(self, name, index=None):
+        '''Returns where a field starts in the bytes returned by raw(), or
+        None if the transaction wasn't parsed or changed since. name is a
+        key of the offsets dict set by parse, with index picking an input
+        or output for 'tx_ins' and 'tx_outs'.'''
+        if self.raw() is None:
+            return None
+        offset = self.offsets[name]
+        return offset if index is None else offset[index]
+
+    def serialize(self, with_witness=True):
         '''Returns the byte serialization of the transaction'''
+        result = ByteWriter()
+        self.serialize_into(result, with_witness)
+        return bytes(result)
+
+    def has_witness(self):
+        return any(len(t.script_witness) > 0 for t in self.tx_ins)
+
+    def uses_extended_format(self):
+        '''Whether serialize writes the segwit marker and flag. Transactions
+        without inputs need them too, or the 0 input count followed by the
+        output count would read back as the marker.'''
+        return self.has_witness() or len(self.tx_ins) == 0
+
+    def serialize_into(self, buf, with_witness=True):
+        '''Appends the serialization of the transaction to the ByteWriter buf'''
         # serialize version (4 bytes, little endian)
-        result = int_to_little_endian(self.version, 4)
-        # encode_varint on the number of inputs
-        result += encode_varint(len(self.tx_ins))
+        buf.write_u32le(self.version)
+
+        has_witnesses = with_witness and self.uses_extended_format()
+        if has_witnesses:
+            buf.write(b'\x00\x01')  # marker, flag
+
+        # varint on the number of inputs
+        buf.write_varint(len(self.tx_ins))
         # iterate inputs
         for tx_in in self.tx_ins:
             # serialize each input
-            result += tx_in.serialize()
-        # encode_varint on the number of inputs
-        result += encode_varint(len(self.tx_outs))
+            tx_in.serialize_into(buf)
+        # varint on the number of outputs
+        buf.write_varint(len(self.tx_outs))
         # iterate outputs
         for tx_out in self.tx_outs:
             # serialize each output
-            result += tx_out.serialize()
+            tx_out.serialize_into(buf)
+
+        # iterate witnesses for each input
+        if has_witnesses:
+            for tx_in in self.tx_ins:
+                buf.write_varint(len(tx_in.script_witness))
+                for w in tx_in.script_witness:
+                    buf.write_varint(len(w))
+                    buf.write(w)
+
         # serialize locktime (4 bytes, little endian)
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+        buf.write_u32le(self.locktime)
+
+    def serialized_size(self, with_witness=True):
+        '''Returns the length of the serialization without building it'''
+        size = 8 + varint_size(len(self.tx_ins)) + varint_size(len(self.tx_outs))
+        for tx_in in self.tx_ins:
+            size += tx_in.serialized_size()
+        for tx_out in self.tx_outs:
+            size += tx_out.serialized_size()
+        if with_witness and self.uses_extended_format():
+            size += 2
+            for tx_in in self.tx_ins:
+                size += varint_size(len(tx_in.script_witness))
+                for w in tx_in.script_witness:
+                    size += varint_size(len(w)) + len(w)
+        return size
+
+    def size(self, with_witness=True):
+        '''Returns the length of the serialization, taken from the parsed
+        bytes if nothing changed since parsing'''
+        parsed = self.raw()
+        if parsed is None:
+            return self.serialized_size(with_witness)
+        raw, inputs_start, witness_start = parsed
+        if with_witness:
+            return len(raw)
+        # drop the marker, flag and witnesses, if any
+        return len(raw) - (inputs_start - 4) - (len(raw) - 4 - witness_start)
 
-    def fee(self):
-        '''Returns the fee of this transaction in satoshi'''
+    def weight(self):
+        '''Returns the BIP141 weight, 3 times the size without witnesses
+        plus the full size'''
+        return 3 * self.size(with_witness=False) + self.size()
+
+    def vsize(self):
+        '''Returns the virtual size, the weight / 4 rounded up'''
+        return (self.weight() + 3) // 4
+
+    def fee_rate(self, prevouts=None):
+        '''Returns the fee in satoshi per virtual byte'''
+        return self.fee(prevouts) / self.vsize()
+
+    def prefetch(self, prevouts=None):
+        '''Looks up all the transactions the inputs spend from with one
+        call to the PrevoutProvider, prevouts if given, so later lookups
+        don't go to it'''
+        tx_hashes = []
+        for tx_in in self.tx_ins:
+            if tx_in.prev_tx not in TxIn.cache and tx_in.prev_tx not in tx_hashes \
+               and tx_in.prev_tx != b'\x00' * 32:
+                tx_hashes.append(tx_in.prev_tx)
+        if not tx_hashes:
+            return
+        provider = prevouts or self.prevouts or TxIn.default_prevouts()
+        for tx_hash, raw in provider.raw_txs(tx_hashes, self.testnet).items():
+            TxIn.cache[tx_hash] = raw
+
+    def fee(self, prevouts=None):
+        '''Returns the fee of this transaction in satoshi, looking up the
+        outputs spent in prevouts if given'''
+        prevouts = prevouts or self.prevouts
+        # one lookup for all the inputs instead of one per input
+        self.prefetch(prevouts)
         # initialize input sum and output sum
         input_sum, output_sum = 0, 0
         # iterate through inputs
         for tx_in in self.tx_ins:
             # for each input get the value and add to input sum
-            input_sum += tx_in.value()
+            input_sum += tx_in.value(self.testnet, prevouts)
         # iterate through outputs
         for tx_out in self.tx_outs:
             # for each output get the amount and add to output sum
@@ -101,75 +511,152 @@ class Tx:
         # return input sum - output sum
         return input_sum - output_sum
 
-    def sig_hash(self, input_index, hash_type):
+    def precomputed(self):
+        '''Returns the PrecomputedTxData for this transaction, computed
+        again only after an input or output changed'''
+        txdata = self.__dict__.get('_txdata')
+        if txdata is None or not txdata.is_current():
+            txdata = PrecomputedTxData(self)
+            self._txdata = txdata
+        return txdata
+
+    def hash_prevouts(self, hash_type=SIGHASH_ALL, txdata=None):
+        if hash_type & SIGHASH_ANYONECANPAY:
+            return b'\x00' * 32
+        return (txdata or self.precomputed()).hash_prevouts
+
+    def hash_outputs(self, hash_type=SIGHASH_ALL, txdata=None, input_index=None):
+        base_type = hash_type & 0x1f
+        if base_type not in (SIGHASH_SINGLE, SIGHASH_NONE):
+            return (txdata or self.precomputed()).hash_outputs
+        if base_type == SIGHASH_SINGLE and input_index is not None \
+           and input_index < len(self.tx_outs):
+            # only the output with the same index is signed
+            return double_sha256(self.tx_outs[input_index].serialize())
+        return b'\x00' * 32
+
+    def hash_sequence(self, hash_type=SIGHASH_ALL, txdata=None):
+        if hash_type & SIGHASH_ANYONECANPAY or \
+           hash_type & 0x1f in (SIGHASH_SINGLE, SIGHASH_NONE):
+            return b'\x00' * 32
+        return (txdata or self.precomputed()).hash_sequence
+
+    def witness_program(self, input_index):
+        '''Returns the witness program Script spent by input_index, the
+        scriptPubKey itself or, for nested segwit, the program pushed by
+        the scriptSig. None if the input doesn't spend one.'''
+        tx_in = self.tx_ins[input_index]
+        script_pubkey = tx_in.script_pubkey(self.testnet, self.prevouts)
+        if script_pubkey.type() == 'p2sh':
+            elements = tx_in.script_sig.elements
+            if len(elements) != 1 or type(elements[0]) != bytes:
+                return None
+            script_pubkey = Script.parse(elements[0])
+        if script_pubkey.type() in ('p2wpkh', 'p2wsh'):
+            return script_pubkey
+        return None
+
+    def witness_script_code(self, input_index):
+        '''Returns the raw BIP143 script code of input_index: the p2pkh
+        script of the key hash for p2wpkh (nested or not) and the witness
+        script, the last witness item, for p2wsh'''
+        program = self.witness_program(input_index)
+        if program is not None:
+            raw = program.serialize()
+            if program.type() == 'p2wpkh':
+                return p2pkh_script(raw[2:])
+            witness = self.tx_ins[input_index].script_witness
+            if witness:
+                return witness[-1]
+        raise RuntimeError('no witness script code for input {}'.format(input_index))
+
+    def sig_hash_w0_preimage(self, input_index, hash_type, txdata=None, script_code=None):
+        '''Returns the BIP143 preimage for input_index. script_code is the
+        raw script code, by default from witness_script_code. txdata is
+        the PrecomputedTxData to use, by default the one cached on the Tx'''
+        tx_in = self.tx_ins[input_index] # tx_in to sign
+        if script_code is None:
+            script_code = self.witness_script_code(input_index)
+
+        hash_prevouts = self.hash_prevouts(hash_type, txdata)
+        hash_sequence = self.hash_sequence(hash_type, txdata)
+        hash_outputs = self.hash_outputs(hash_type, txdata, input_index)
+
+        result = ByteWriter()
+        result.write_u32le(self.version)
+        result.write(hash_prevouts)
+        result.write(hash_sequence)
+        result.write(tx_in.prev_tx[::-1])
+        result.write_u32le(tx_in.prev_index)
+        result.write_varint(len(script_code))
+        result.write(script_code)
+        result.write_u64le(tx_in.value(self.testnet, self.prevouts))
+        result.write_u32le(tx_in.sequence)
+        result.write(hash_outputs)
+        result.write_u32le(self.locktime)
+        result.write_u32le(hash_type)
+        return bytes(result)
+
+    # only applicable to sigops in version 0 witness program
+    def sig_hash_w0(self, input_index, hash_type, txdata=None, script_code=None):
+        s256 = double_sha256(self.sig_hash_w0_preimage(input_index, hash_type, txdata, script_code))
+        return int.from_bytes(s256, 'big')
+
+    def legacy_sig_hasher(self):
+        '''Returns the LegacySigHasher for this transaction, built again
+        only after a signed field changed'''
+        hasher = self.__dict__.get('_legacy_sig_hasher')
+        if hasher is None or not hasher.is_current():
+            hasher = LegacySigHasher(self)
+            self._legacy_sig_hasher = hasher
+        return hasher
+
+    def sig_hash(self, input_index, hash_type, script_code=None):
         '''Returns the integer representation of the hash that needs to get
-        signed for index input_index'''
-        # create a new set of tx_ins (alt_tx_ins)
-        alt_tx_ins = []
-        # iterate over self.tx_ins
-        for tx_in in self.tx_ins:
-            # create a new TxIn that has a blank script_sig (b'') and add to alt_tx_ins
-            alt_tx_ins.append(TxIn(
-                prev_tx=tx_in.prev_tx,
-                prev_index=tx_in.prev_index,
-                script_sig=b'',
-                sequence=tx_in.sequence,
-            ))
-        # grab the input at the input_index
-        signing_input = alt_tx_ins[input_index]
-        # grab the script_pubkey of the input
-        script_pubkey = signing_input.script_pubkey(self.testnet)
-        # Exercise 6.2: get the sig type from script_pubkey.type()
-        sig_type = script_pubkey.type()
-        # Exercise 6.2: the script_sig of the signing_input should be script_pubkey for p2pkh
-        if sig_type == 'p2pkh':
-            # Exercise 6.2: replace the input's scriptSig with the scriptPubKey
-            signing_input.script_sig = script_pubkey
-        # Exercise 6.2: the script_sig of the signing_input should be the redeemScript
-        #               of the current input of the real tx_in (self.tx_ins[input_index].redeem_script()
-        elif sig_type == 'p2sh':
-            # Exercise 6.2: replace the input's scriptSig with the RedeemScript
-            current_input = self.tx_ins[input_index]
-            # Exercise 6.2: replace the input's scriptSig with the Script.parse(redeem_script)
-            signing_input.script_sig = Script.parse(
-                current_input.redeem_script())
-        else:
-            raise RuntimeError('no valid sig_type')
-        # create an alternate transaction with the modified tx_ins
-        alt_tx = self.__class__(
-            version=self.version,
-            tx_ins=alt_tx_ins,
-            tx_outs=self.tx_outs,
-            locktime=self.locktime)
-        # add the hash_type int 4 bytes, little endian
-        result = alt_tx.serialize() + int_to_little_endian(hash_type, 4)
-        # get the double_sha256 of the tx serialization
-        s256 = double_sha256(result)
+        signed for index input_index. script_code is the raw script that
+        replaces the scriptSig, by default derived from the output spent.'''
+        if script_code is None:
+            script_pubkey = self.tx_ins[input_index].script_pubkey(self.testnet, self.prevouts)
+            sig_type = script_pubkey.type()
+            if self.witness_program(input_index) is not None:
+                return self.sig_hash_w0(input_index, hash_type)
+            # Exercise 6.2: the script code should be script_pubkey for p2pkh and p2pk
+            if sig_type in ('p2pkh', 'p2pk'):
+                script_code = script_pubkey.serialize()
+            # Exercise 6.2: the script code should be the redeemScript
+            #               of the current input (self.tx_ins[input_index].redeem_script())
+            elif sig_type == 'p2sh':
+                script_code = self.tx_ins[input_index].redeem_script()
+            else:
+                raise RuntimeError('no valid sig_type')
+        # the parts shared by all inputs are serialized once per transaction
+        s256 = self.legacy_sig_hasher().sig_hash(input_index, hash_type, script_code)
         # convert this to a big-endian integer using int.from_bytes(x, 'big')
         return int.from_bytes(s256, 'big')
 
+    def verify(self):
+        '''Returns whether the transaction doesn't create coins and every
+        input has a valid signature'''
+        # one lookup for all the inputs instead of one per input
+        self.prefetch()
+        if self.fee() < 0:
+            return False
+        for i in range(len(self.tx_ins)):
+            if not self.verify_input(i):
+                return False
+        return True
+
     def verify_input(self, input_index):
         '''Returns whether the input has a valid signature'''
-        # Exercise 1.1: get the relevant input
+        # get the relevant input
         tx_in = self.tx_ins[input_index]
-        # Exercise 6.2: get the number of signatures required. This is available in tx_in.script_sig.num_sigs_required()
-        sigs_required = tx_in.script_sig.num_sigs_required()
-        # Exercise 6.2: iterate over the sigs required and check each signature
-        for sig_num in range(sigs_required):
-            # Exercise 1.1: get the point from the sec format (tx_in.sec_pubkey())
-            # Exercise 6.2: get the sec_pubkey at current signature index (check sec_pubkey function)
-            point = S256Point.parse(tx_in.sec_pubkey(index=sig_num))
-            # Exercise 1.1: get the der sig and hash_type from input
-            # Exercise 6.2: get the der_signature at current signature index (check der_signature function)
-            der, hash_type = tx_in.der_signature(index=sig_num)
-            # Exercise 1.1: get the signature from der format
-            signature = Signature.parse(der)
-            # Exercise 1.1: get the hash to sign
-            z = self.sig_hash(input_index, hash_type)
-            # Exercise 1.1: use point.verify on the hash to sign and signature
-            if not point.verify(z, signature):
-                return False
-        return True
+        # run the scriptSig against the scriptPubKey of the output being spent
+        return verify_script(
+            tx_in.script_sig,
+            tx_in.script_pubkey(self.testnet, self.prevouts),
+            TxSignatureChecker(self, input_index),
+            witness=tx_in.script_witness,
+        )
 
     def sign_input(self, input_index, private_key, hash_type):
         '''Signs the input using the private key'''
@@ -181,10 +668,15 @@ class Tx:
         sig = der + bytes([hash_type])
         # calculate the sec
         sec = private_key.point.sec()
-        # initialize a new script with [sig, sec] as the elements
-        script_sig = Script([sig, sec])
-        # change input's script_sig to new script
-        self.tx_ins[input_index].script_sig = script_sig
+        sig_type = self.tx_ins[input_index].script_pubkey(self.testnet, self.prevouts).type()
+        # change input's script_sig (or witness) to spend the output
+        if sig_type == 'p2wpkh':
+            self.tx_ins[input_index].script_witness = [sig, sec]
+        elif sig_type == 'p2pk':
+            # the pubkey is already in the scriptPubKey
+            self.tx_ins[input_index].script_sig = Script([sig])
+        else:
+            self.tx_ins[input_index].script_sig = Script([sig, sec])
         # return whether sig is valid using self.verify_input
         return self.verify_input(input_index)
 
@@ -219,13 +711,44 @@ class Tx:
 
 class TxIn:
 
-    cache = {}
+    # previous transactions, kept serialized and parsed on lookup
+    cache = TxCache(lambda raw: Tx.parse(BytesIO(raw)))
+    # default PrevoutProvider, see default_prevouts
+    prevouts = None
 
     def __init__(self, prev_tx, prev_index, script_sig, sequence=4294967295):
-        self.prev_tx = prev_tx
-        self.prev_index = prev_index
-        self.script_sig = Script.parse(script_sig)
-        self.sequence = sequence
+        # filled in directly, a new input has nothing to tell
+        fields = self.__dict__
+        # the TxLists holding this input, set by watch
+        fields['_watchers'] = None
+        fields['prev_tx'] = prev_tx
+        fields['prev_index'] = prev_index
+        fields['script_sig'] = Script.parse(script_sig)
+        fields['script_sig'].watch(self, False)
+        fields['sequence'] = sequence
+        fields['script_witness'] = WitnessList((), self, False)
+
+    def __setattr__(self, name, value):
+        if name == 'script_witness':
+            if type(value) != WitnessList:
+                value = WitnessList(value)
+            value.watch(self, False)
+        elif name == 'script_sig':
+            value.watch(self, False)
+        # the outpoint and sequence are hashed into PrecomputedTxData
+        if name in self.__dict__:
+            self.touch(name in ('prev_tx', 'prev_index', 'sequence'))
+        object.__setattr__(self, name, value)
+
+    def watch(self, watcher, signed=True):
+        if self._watchers is None:
+            self.__dict__['_watchers'] = Watchers(watcher, signed)
+        else:
+            self._watchers.add(watcher, signed)
+
+    def touch(self, signed=True):
+        if self._watchers is not None:
+            self._watchers.touch(signed)
 
     def __repr__(self):
         return '{}:{}'.format(
@@ -249,35 +772,46 @@ class TxIn:
         '''Takes a byte stream and parses the tx_input at the start
         return a TxIn object
         '''
-        # s.read(n) will return n bytes
+        r = ByteReader.wrap(s)
         # prev_tx is 32 bytes, little endian
-        prev_tx = s.read(32)[::-1]
+        prev_tx = r.read(32)[::-1]
         # prev_index is 4 bytes, little endian, interpret as int
-        prev_index = little_endian_to_int(s.read(4))
+        prev_index = r.read_u32le()
         # script_sig is a variable field (length followed by the data)
-        # get the length by using read_varint(s)
-        script_sig_length = read_varint(s)
-        script_sig = s.read(script_sig_length)
+        # get the length by using r.read_varint()
+        script_sig_length = r.read_varint()
+        script_sig = r.read(script_sig_length)
         # sequence is 4 bytes, little-endian, interpret as int
-        sequence = little_endian_to_int(s.read(4))
+        sequence = r.read_u32le()
+        r.sync(s)
         # return an instance of the class (cls(...))
         return cls(prev_tx, prev_index, script_sig, sequence)
 
     def serialize(self):
         '''Returns the byte serialization of the transaction input'''
+        result = ByteWriter()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the serialization of the transaction input to buf'''
         # serialize prev_tx, little endian
-        result = self.prev_tx[::-1]
+        buf.write(self.prev_tx[::-1])
         # serialize prev_index, 4 bytes, little endian
-        result += int_to_little_endian(self.prev_index, 4)
+        buf.write_u32le(self.prev_index)
         # get the scriptSig ready (use self.script_sig.serialize())
         raw_script_sig = self.script_sig.serialize()
-        # encode_varint on the length of the scriptSig
-        result += encode_varint(len(raw_script_sig))
+        # varint on the length of the scriptSig
+        buf.write_varint(len(raw_script_sig))
         # add the scriptSig
-        result += raw_script_sig
+        buf.write(raw_script_sig)
         # serialize sequence, 4 bytes, little endian
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        buf.write_u32le(self.sequence)
+
+    def serialized_size(self):
+        '''Returns the length of the serialization without building it'''
+        script_size = self.script_sig.serialized_size()
+        return 40 + varint_size(script_size) + script_size
 
     @classmethod
     def get_url(cls, testnet=False):
@@ -286,35 +820,39 @@ class TxIn:
         else:
             return 'https://btc-bitcore3.trezor.io/api'
 
-    def fetch_tx(self, testnet=False):
-        if self.prev_tx not in self.cache:
-            url = self.get_url(testnet) + '/rawtx/{}'.format(hexlify(self.prev_tx).decode('ascii'))
-            response = requests.get(url)
-            js_response = response.json()
-            if 'rawtx' not in js_response:
-                raise RuntimeError('got from server: {}'.format(js_response))
-            raw = unhexlify(js_response['rawtx'])
-            stream = BytesIO(raw)
-            tx = Tx.parse(stream)
-            self.cache[self.prev_tx] = tx
-        return self.cache[self.prev_tx]
-
-    def value(self, testnet=False):
-        '''Get the outpoint value by looking up the tx hash on libbitcoin server
-        Returns the amount in satoshi
+    @classmethod
+    def default_prevouts(cls):
+        '''Returns the PrevoutProvider used when the Tx doesn't have one'''
+        if cls.prevouts is None:
+            cls.prevouts = HttpPrevoutProvider(cls.get_url(False), cls.get_url(True))
+        return cls.prevouts
+
+    def fetch_tx(self, testnet=False, prevouts=None):
+        tx = self.cache.get(self.prev_tx)
+        if tx is None:
+            provider = prevouts or self.default_prevouts()
+            raw = provider.raw_tx(self.prev_tx, testnet)
+            # parsed here, the cache may not keep a tx larger than its bound
+            tx = self.cache.parse(raw)
+            self.cache[self.prev_tx] = raw
+        return tx
+
+    def value(self, testnet=False, prevouts=None):
+        '''Get the outpoint value by looking up the tx hash with the
+        PrevoutProvider. Returns the amount in satoshi
         '''
         # use self.fetch_tx to get the transaction
-        tx = self.fetch_tx(testnet=testnet)
+        tx = self.fetch_tx(testnet=testnet, prevouts=prevouts)
         # get the output at self.prev_index
         # return the amount property
         return tx.tx_outs[self.prev_index].amount
 
-    def script_pubkey(self, testnet=False):
-        '''Get the scriptPubKey by looking up the tx hash on libbitcoin server
-        Returns the binary scriptpubkey
+    def script_pubkey(self, testnet=False, prevouts=None):
+        '''Get the scriptPubKey by looking up the tx hash with the
+        PrevoutProvider. Returns the binary scriptpubkey
         '''
         # use self.fetch_tx to get the transaction
-        tx = self.fetch_tx(testnet=testnet)
+        tx = self.fetch_tx(testnet=testnet, prevouts=prevouts)
         # get the output at self.prev_index
         # return the script_pubkey property and serialize
         return tx.tx_outs[self.prev_index].script_pubkey
@@ -322,7 +860,16 @@ class TxIn:
     def der_signature(self, index=0):
         '''returns a DER format signature and hash_type if the script_sig
         has a signature'''
-        signature = self.script_sig.der_signature(index=index)
+
+        if self.script_sig.type() == 'blank':
+            if self.script_pubkey().type() == 'p2wpkh':
+                # witness:      <signature> <pubkey>
+                signature = self.script_witness[0]
+            else:
+                raise RuntimeError("Other witness type not yet supported")
+        else:
+            signature = self.script_sig.der_signature(index=index)
+
         # last byte is the hash_type, rest is the signature
         return signature[:-1], signature[-1]
 
@@ -338,41 +885,252 @@ class TxIn:
 class TxOut:
 
     def __init__(self, amount, script_pubkey):
-        self.amount = amount
-        self.script_pubkey = Script.parse(script_pubkey)
+        # filled in directly, a new output has nothing to tell
+        fields = self.__dict__
+        # the TxLists holding this output, set by watch
+        fields['_watchers'] = None
+        fields['amount'] = amount
+        fields['script_pubkey'] = Script.parse(script_pubkey)
+        fields['script_pubkey'].watch(self)
+
+    def __setattr__(self, name, value):
+        if name == 'script_pubkey':
+            value.watch(self)
+        if name in self.__dict__:
+            self.touch()
+        object.__setattr__(self, name, value)
+
+    def watch(self, watcher, signed=True):
+        if self._watchers is None:
+            self.__dict__['_watchers'] = Watchers(watcher, signed)
+        else:
+            self._watchers.add(watcher, signed)
+
+    def touch(self, signed=True):
+        if self._watchers is not None:
+            self._watchers.touch(signed)
 
     def __repr__(self):
-        return '{}:{}'.format(self.amount, self.script_pubkey.address())
+        return '{}:{}:{}'.format(self.amount, self.script_pubkey.type(), self.script_pubkey.address())
 
     @classmethod
     def parse(cls, s):
         '''Takes a byte stream and parses the tx_output at the start
         return a TxOut object
         '''
-        # s.read(n) will return n bytes
+        r = ByteReader.wrap(s)
         # amount is 8 bytes, little endian, interpret as int
-        amount = little_endian_to_int(s.read(8))
+        amount = r.read_u64le()
         # script_pubkey is a variable field (length followed by the data)
-        # get the length by using read_varint(s)
-        script_pubkey_length = read_varint(s)
-        script_pubkey = s.read(script_pubkey_length)
+        # get the length by using r.read_varint()
+        script_pubkey_length = r.read_varint()
+        script_pubkey = r.read(script_pubkey_length)
+        r.sync(s)
         # return an instance of the class (cls(...))
         return cls(amount, script_pubkey)
 
     def serialize(self):
         '''Returns the byte serialization of the transaction output'''
+        result = ByteWriter()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the serialization of the transaction output to buf'''
         # serialize amount, 8 bytes, little endian
-        result = int_to_little_endian(self.amount, 8)
+        buf.write_u64le(self.amount)
         # get the scriptPubkey ready (use self.script_pubkey.serialize())
         raw_script_pubkey = self.script_pubkey.serialize()
-        # encode_varint on the length of the scriptPubkey
-        result += encode_varint(len(raw_script_pubkey))
+        # varint on the length of the scriptPubkey
+        buf.write_varint(len(raw_script_pubkey))
         # add the scriptPubKey
-        result += raw_script_pubkey
-        return result
+        buf.write(raw_script_pubkey)
+
+    def serialized_size(self):
+        '''Returns the length of the serialization without building it'''
+        script_size = self.script_pubkey.serialized_size()
+        return 8 + varint_size(script_size) + script_size
+
+
+# script type codes used by TxColumns, 0 is a script matching no template
+SCRIPT_TYPES = (None, 'blank', 'p2pkh', 'p2sh', 'p2wpkh', 'p2wsh', 'p2pk', 'nulldata', 'multisig')
+SCRIPT_TYPE_CODES = {name: code for code, name in enumerate(SCRIPT_TYPES)}
+
+
+class TxColumns:
+    '''Transactions decoded into flat arrays instead of Tx objects.
+
+    Per transaction (tx_ columns): txids packed as 32 bytes each in
+    display order, version, locktime, offset and length in the source
+    buffer, length without the segwit marker, flag and witnesses (the
+    base size of BIP141), and the index of its first input and first output (with a
+    final entry for the end, so transaction i owns inputs
+    tx_input_start[i] to tx_input_start[i + 1]).
+
+    Per input (in_ columns): previous tx hashes packed as 32 bytes each
+    in display order, prev_index, sequence, and the offset and length of
+    the scriptSig in the source buffer.
+
+    Per output (out_ columns): amount, the offset and length of the
+    scriptPubKey in the source buffer, and its type as an index into
+    SCRIPT_TYPES.'''
 
+    def __init__(self, buf):
+        self.buf = buf
+        self.tx_ids = bytearray()
+        self.tx_version = array('I')
+        self.tx_locktime = array('I')
+        self.tx_offset = array('Q')
+        self.tx_length = array('Q')
+        self.tx_base_length = array('Q')
+        self.tx_input_start = array('Q', [0])
+        self.tx_output_start = array('Q', [0])
+        self.in_prev_tx = bytearray()
+        self.in_prev_index = array('I')
+        self.in_sequence = array('I')
+        self.in_script_offset = array('Q')
+        self.in_script_length = array('I')
+        self.out_amount = array('Q')
+        self.out_script_offset = array('Q')
+        self.out_script_length = array('I')
+        self.out_type = array('B')
 
-class TxTest(TestCase):
+    def __len__(self):
+        return len(self.tx_version)
+
+    def txid(self, i):
+        return bytes(self.tx_ids[32 * i:32 * i + 32])
+
+    def prev_tx(self, i):
+        return bytes(self.in_prev_tx[32 * i:32 * i + 32])
+
+    def script_pubkey(self, i):
+        '''Returns the raw scriptPubKey of output i'''
+        offset = self.out_script_offset[i]
+        return bytes(self.buf[offset:offset + self.out_script_length[i]])
+
+    def script_sig(self, i):
+        '''Returns the raw scriptSig of input i'''
+        offset = self.in_script_offset[i]
+        return bytes(self.buf[offset:offset + self.in_script_length[i]])
+
+    def weights(self):
+        '''Returns the BIP141 weight of every transaction'''
+        return array('Q', [3 * b + n for b, n in zip(self.tx_base_length, self.tx_length)])
+
+    def vsizes(self):
+        '''Returns the virtual size of every transaction'''
+        return array('Q', [(3 * b + n + 3) // 4 for b, n in zip(self.tx_base_length, self.tx_length)])
+
+    def fees(self, input_values):
+        '''Returns the fee of every transaction. input_values has the
+        amount of the output each input spends, in input order.'''
+        fees = array('q')
+        in_start, out_start = self.tx_input_start, self.tx_output_start
+        for i in range(len(self)):
+            spent = sum(input_values[in_start[i]:in_start[i + 1]])
+            fees.append(spent - sum(self.out_amount[out_start[i]:out_start[i + 1]]))
+        return fees
+
+    def fee_rates(self, input_values):
+        '''Returns the fee per virtual byte of every transaction'''
+        return array('d', [fee / vsize for fee, vsize in zip(self.fees(input_values), self.vsizes())])
+
+    def to_numpy(self):
+        '''Returns the columns as a dict of numpy arrays, the packed hashes
+        as (n, 32) uint8 arrays. Needs numpy installed.'''
+        import numpy as np
+        columns = {}
+        for name, value in vars(self).items():
+            if isinstance(value, array):
+                columns[name] = np.frombuffer(value, dtype=value.typecode)
+        columns['tx_ids'] = np.frombuffer(bytes(self.tx_ids), dtype=np.uint8).reshape(-1, 32)
+        columns['in_prev_tx'] = np.frombuffer(bytes(self.in_prev_tx), dtype=np.uint8).reshape(-1, 32)
+        return columns
+
+
+def decode_columns(buf, count=None):
+    '''Decodes count transactions stored back to back in buf, or all of
+    them up to the end if count is None, into a TxColumns'''
+    view = memoryview(buf).cast('B')
+    columns = TxColumns(view)
+    # bind the appends once, this loop runs for every field
+    in_prev_tx = columns.in_prev_tx
+    in_prev_index = columns.in_prev_index.append
+    in_sequence = columns.in_sequence.append
+    in_script_offset = columns.in_script_offset.append
+    in_script_length = columns.in_script_length.append
+    out_amount = columns.out_amount.append
+    out_script_offset = columns.out_script_offset.append
+    out_script_length = columns.out_script_length.append
+    out_type = columns.out_type.append
+    type_codes = SCRIPT_TYPE_CODES
+    unpack_u32 = U32LE.unpack_from
+    unpack_u64 = U64LE.unpack_from
+    end = len(view)
+    offset = 0
+    while offset < end if count is None else len(columns) < count:
+        try:
+            start = offset
+            columns.tx_version.append(unpack_u32(view, offset)[0])
+            offset += 4
+            # segwit marker and flag
+            segwit = view[offset] == 0 and view[offset + 1] == 1
+            if segwit:
+                offset += 2
+            inputs_start = offset
+            num_inputs, offset = decode_varint(view, offset)
+            for _ in range(num_inputs):
+                in_prev_tx += view[offset:offset + 32].tobytes()[::-1]
+                in_prev_index(unpack_u32(view, offset + 32)[0])
+                length, offset = decode_varint(view, offset + 36)
+                in_script_offset(offset)
+                in_script_length(length)
+                offset += length
+                in_sequence(unpack_u32(view, offset)[0])
+                offset += 4
+            num_outputs, offset = decode_varint(view, offset)
+            for _ in range(num_outputs):
+                out_amount(unpack_u64(view, offset)[0])
+                length, offset = decode_varint(view, offset + 8)
+                out_script_offset(offset)
+                out_script_length(length)
+                out_type(type_codes[script_type(view[offset:offset + length])])
+                offset += length
+            witness_start = offset
+            if segwit:
+                for _ in range(num_inputs):
+                    items, offset = decode_varint(view, offset)
+                    for _ in range(items):
+                        length, offset = decode_varint(view, offset)
+                        offset += length
+            columns.tx_locktime.append(unpack_u32(view, offset)[0])
+            offset += 4
+            if offset > end:
+                raise RuntimeError('transaction {} is truncated'.format(len(columns) - 1))
+            h = stripped_hash(view[start:offset], inputs_start - start, witness_start - start)
+            columns.tx_ids += h[::-1]
+            columns.tx_offset.append(start)
+            columns.tx_length.append(offset - start)
+            columns.tx_base_length.append(offset - start - (inputs_start - start - 4)
+                                          - (offset - 4 - witness_start))
+            columns.tx_input_start.append(len(columns.in_prev_index))
+            columns.tx_output_start.append(len(columns.out_amount))
+        except (IndexError, struct.error):
+            raise RuntimeError('transaction at offset {} is truncated'.format(start))
+    return columns
+
+
+class TxInCacheTestCase(TestCase):
+    '''Gives each test an empty TxIn.cache of its own'''
+
+    def setUp(self):
+        patcher = mock.patch.object(TxIn, 'cache', TxCache(TxIn.cache.parse))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TxTest(TxInCacheTestCase):
 
     def test_parse_version(self):
         raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
@@ -412,6 +1170,94 @@ class TxTest(TestCase):
         tx = Tx.parse(stream)
         self.assertEqual(tx.locktime, 410393)
 
+    def test_txid(self):
+        raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        tx = Tx.parse(BytesIO(raw_tx))
+        want = unhexlify('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        with mock.patch.object(Tx, 'serialize', side_effect=AssertionError):
+            self.assertEqual(tx.txid(), want)
+            self.assertEqual(tx.hash(), want)
+        # a new scriptSig changes the txid
+        tx.tx_ins[0].script_sig = Script([])
+        self.assertNotEqual(tx.txid(), want)
+        self.assertEqual(tx.txid(), double_sha256(tx.serialize())[::-1])
+
+    def test_txid_in_place_edits(self):
+        raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        tx = Tx.parse(BytesIO(raw_tx))
+        other = Tx.parse(BytesIO(raw_tx))
+        want = tx.txid()
+        self.assertEqual(tx.size(), 226)
+        # editing another transaction keeps the parsed bytes of this one
+        other.locktime = 5
+        self.assertIsNotNone(tx.raw())
+        self.assertIsNone(other.raw())
+        # so does editing a script in place, in every way it can be done
+        tx.tx_outs[0].script_pubkey.elements = [b'\x00' * 20]
+        self.assertIsNone(tx.raw())
+        self.assertNotEqual(tx.txid(), want)
+        self.assertEqual(tx.txid(), double_sha256(tx.serialize())[::-1])
+        self.assertEqual(tx.size(), len(tx.serialize()))
+        changed = tx.txid()
+        tx.tx_outs[0].script_pubkey.elements.append(0)
+        self.assertNotEqual(tx.txid(), changed)
+        self.assertEqual(tx.hash(), double_sha256(tx.serialize())[::-1])
+        self.assertEqual(tx.size(), len(tx.serialize()))
+        # as do the lists of inputs and outputs and the witnesses
+        changed = tx.hash()
+        tx.tx_outs.pop()
+        self.assertNotEqual(tx.hash(), changed)
+        changed = tx.hash()
+        tx.tx_ins[0].script_witness.append(b'\x01')
+        self.assertNotEqual(tx.hash(), changed)
+        self.assertEqual(tx.hash(), double_sha256(tx.serialize())[::-1])
+        self.assertEqual(tx.size(), len(tx.serialize()))
+
+    def test_decode_columns(self):
+        raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        segwit = Tx(2, [TxIn(b'\x11' * 32, 3, b''), TxIn(b'\x22' * 32, 0, b'\x51', 5)],
+                    [TxOut(1000, b'\x00\x14' + bytes(20)), TxOut(0, b'\x6a\x01\x00')], 99)
+        segwit.tx_ins[0].script_witness = [b'\x01' * 71, b'\x02' * 33]
+        buf = raw_tx + segwit.serialize() + raw_tx
+        columns = decode_columns(buf)
+        txs = Tx.parse_many(BytesIO(buf))
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(list(columns.tx_input_start), [0, 1, 3, 4])
+        self.assertEqual(list(columns.tx_output_start), [0, 2, 4, 6])
+        tx_ins = [tx_in for tx in txs for tx_in in tx.tx_ins]
+        tx_outs = [tx_out for tx in txs for tx_out in tx.tx_outs]
+        for i, tx in enumerate(txs):
+            self.assertEqual(columns.txid(i), tx.txid())
+            self.assertEqual(columns.tx_version[i], tx.version)
+            self.assertEqual(columns.tx_locktime[i], tx.locktime)
+        self.assertEqual(columns.tx_offset[2], len(raw_tx) + len(segwit.serialize()))
+        for i, tx_in in enumerate(tx_ins):
+            self.assertEqual(columns.prev_tx(i), tx_in.prev_tx)
+            self.assertEqual(columns.in_prev_index[i], tx_in.prev_index)
+            self.assertEqual(columns.in_sequence[i], tx_in.sequence)
+            self.assertEqual(columns.script_sig(i), tx_in.script_sig.serialize())
+        for i, tx_out in enumerate(tx_outs):
+            self.assertEqual(columns.out_amount[i], tx_out.amount)
+            self.assertEqual(columns.script_pubkey(i), tx_out.script_pubkey.serialize())
+        self.assertEqual([SCRIPT_TYPES[c] for c in columns.out_type],
+                         ['p2pkh', 'p2pkh', 'p2wpkh', 'nulldata', 'p2pkh', 'p2pkh'])
+        self.assertEqual(list(columns.weights()), [tx.weight() for tx in txs])
+        self.assertEqual(list(columns.vsizes()), [tx.vsize() for tx in txs])
+        input_values = [50000000] + [1000, 2000] + [50000000]
+        fees = [50000000 - 32454049 - 10011545, 3000 - 1000, 50000000 - 32454049 - 10011545]
+        self.assertEqual(list(columns.fees(input_values)), fees)
+        self.assertEqual(columns.fee_rates(input_values)[1], 2000 / segwit.vsize())
+        self.assertEqual(len(decode_columns(buf, 2)), 2)
+        with self.assertRaises(RuntimeError):
+            decode_columns(raw_tx[:-2])
+        try:
+            import numpy
+        except ImportError:
+            return
+        arrays = columns.to_numpy()
+        self.assertEqual(int(arrays['out_amount'].sum()), sum(tx_out.amount for tx_out in tx_outs))
+        self.assertEqual(arrays['tx_ids'].shape, (3, 32))
+
     def test_der_signature(self):
         raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
         stream = BytesIO(raw_tx)
@@ -434,6 +1280,16 @@ class TxTest(TestCase):
         tx = Tx.parse(stream)
         self.assertEqual(tx.serialize(), raw_tx)
 
+    def test_serialize_into(self):
+        raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        tx = Tx.parse(BytesIO(raw_tx))
+        buf = ByteWriter(b'prefix')
+        tx.serialize_into(buf)
+        self.assertEqual(bytes(buf), b'prefix' + raw_tx)
+        self.assertEqual(tx.serialized_size(), len(raw_tx))
+        self.assertEqual(tx.tx_ins[0].serialized_size(), len(tx.tx_ins[0].serialize()))
+        self.assertEqual(tx.tx_outs[0].serialized_size(), 34)
+
     def test_input_value(self):
         tx_hash = 'd1c789a9c60383bf715f3f6ad9d14b91fe55f3deb369fe5d9280cb1a01793f81'
         index = 0
@@ -468,6 +1324,28 @@ class TxTest(TestCase):
         tx = Tx.parse(stream)
         self.assertEqual(tx.fee(), 140500)
 
+    def test_prevouts(self):
+        # previous transactions come from the provider instead of the network
+        provider = DictPrevoutProvider()
+        prev_hashes = []
+        for amount in (5000, 7000):
+            prev_tx = Tx(1, [], [TxOut(amount, p2pkh_script(bytes(20))), TxOut(1, b'')], 0)
+            prev_hash = double_sha256(prev_tx.serialize())[::-1]
+            provider.add(prev_hash, prev_tx.serialize())
+            prev_hashes.append(prev_hash)
+        tx_ins = [TxIn(prev_hashes[0], 0, b''), TxIn(prev_hashes[1], 0, b''), TxIn(prev_hashes[1], 1, b'')]
+        tx = Tx(1, tx_ins, [TxOut(10000, p2pkh_script(bytes(20)))], 0, prevouts=provider)
+        with mock.patch.object(provider, 'raw_txs', wraps=provider.raw_txs) as raw_txs, \
+             mock.patch.object(provider, 'raw_tx', wraps=provider.raw_tx) as raw_tx:
+            tx.prefetch()
+            self.assertEqual(raw_txs.call_count, 1)
+            self.assertEqual(tx.fee(), 2001)
+            self.assertEqual(tx.fee_rate(), 2001 / tx.vsize())
+            self.assertEqual(tx_ins[0].script_pubkey().serialize(), p2pkh_script(bytes(20)))
+            tx.prefetch()
+            self.assertEqual(raw_txs.call_count, 1)
+            self.assertEqual(raw_tx.call_count, 2)
+
     def test_sig_hash(self):
         raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
         stream = BytesIO(raw_tx)
@@ -476,6 +1354,151 @@ class TxTest(TestCase):
         want = int('27e0c5994dec7824e56dec6b2fcb342eb7cdb0d0957c2fce9882f715e85d81a6', 16)
         self.assertEqual(tx.sig_hash(0, hash_type), want)
 
+    def test_sig_hash_script_code(self):
+        # same transaction as test_sig_hash, with the script code given
+        # instead of fetched from the previous transaction
+        raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        tx = Tx.parse(BytesIO(raw_tx))
+        sec = tx.tx_ins[0].sec_pubkey()
+        script_code = p2pkh_script(hash160(sec))
+        want = int('27e0c5994dec7824e56dec6b2fcb342eb7cdb0d0957c2fce9882f715e85d81a6', 16)
+        self.assertEqual(tx.sig_hash(0, SIGHASH_ALL, script_code), want)
+        # stand in for the previous transaction to verify offline
+        prev_tx = tx.tx_ins[0].prev_tx
+        TxIn.cache[prev_tx] = Tx(1, [], [TxOut(0, script_code)], 0)
+        self.assertTrue(tx.verify_input(0))
+
+    def test_fee_prefetches(self):
+        key = PrivateKey(8675309)
+        script_pubkey = p2pkh_script(hash160(key.point.sec()))
+        provider = DictPrevoutProvider()
+        prev_hashes = []
+        for amount in (5000, 7000):
+            prev_tx = Tx(1, [], [TxOut(amount, script_pubkey), TxOut(1, script_pubkey)], 0)
+            provider.add(prev_tx.txid(), prev_tx.serialize())
+            prev_hashes.append(prev_tx.txid())
+        tx_ins = [TxIn(prev_hashes[0], 0, b''), TxIn(prev_hashes[1], 0, b''), TxIn(prev_hashes[1], 1, b'')]
+        tx = Tx(1, tx_ins, [TxOut(10000, p2pkh_script(bytes(20)))], 0, prevouts=provider)
+        with mock.patch.object(provider, 'raw_txs', wraps=provider.raw_txs) as raw_txs, \
+             mock.patch.object(provider, 'raw_tx', wraps=provider.raw_tx) as raw_tx:
+            self.assertEqual(tx.fee(), 2001)
+            # one batch for the three inputs, no lookups one by one
+            self.assertEqual(raw_txs.call_count, 1)
+            self.assertEqual(raw_tx.call_count, 2)
+            for i in range(len(tx_ins)):
+                self.assertTrue(tx.sign_input(i, key, SIGHASH_ALL))
+            TxIn.cache = TxCache(TxIn.cache.parse)
+            raw_txs.reset_mock()
+            raw_tx.reset_mock()
+            self.assertTrue(tx.verify())
+            self.assertEqual(raw_txs.call_count, 1)
+            self.assertEqual(raw_tx.call_count, 2)
+        tx.tx_outs[0].amount = 20000
+        self.assertFalse(tx.verify())
+
+    def test_fetch_tx_cache(self):
+        tx = self.spend(p2pkh_script(bytes(20)))
+        tx_in = tx.tx_ins[0]
+        self.assertEqual(tx_in.value(prevouts=tx.prevouts), 50000)
+        # a cold lookup is one miss, not also a hit
+        self.assertEqual((TxIn.cache.misses, TxIn.cache.hits), (1, 0))
+        self.assertEqual(tx_in.value(prevouts=tx.prevouts), 50000)
+        self.assertEqual((TxIn.cache.misses, TxIn.cache.hits), (1, 1))
+        # a transaction too large for the cache is still returned
+        TxIn.cache = TxCache(TxIn.cache.parse, max_bytes=10)
+        self.assertEqual(tx_in.value(prevouts=tx.prevouts), 50000)
+        self.assertEqual(len(TxIn.cache), 0)
+
+    def spend(self, script_pubkey, amount=50000):
+        '''Returns a transaction spending an output paying script_pubkey'''
+        prev_tx = Tx(1, [], [TxOut(amount, script_pubkey)], 0)
+        provider = DictPrevoutProvider({prev_tx.txid(): prev_tx.serialize()})
+        return Tx(1, [TxIn(prev_tx.txid(), 0, b'')], [TxOut(amount - 1000, p2pkh_script(bytes(20)))], 0,
+                  prevouts=provider)
+
+    def test_verify_p2wsh(self):
+        key = PrivateKey(8675309)
+        # <pubkey> OP_CHECKSIG
+        witness_script = Script([key.point.sec(), 0xac]).serialize()
+        tx = self.spend(b'\x00\x20' + hashlib.sha256(witness_script).digest())
+        z = tx.sig_hash_w0(0, SIGHASH_ALL, script_code=witness_script)
+        tx.tx_ins[0].script_witness = [key.sign(z).der() + b'\x01', witness_script]
+        self.assertEqual(tx.sig_hash(0, SIGHASH_ALL), z)
+        self.assertTrue(tx.verify_input(0))
+        # signed as if it were p2wpkh
+        sig = key.sign(tx.sig_hash_w0(0, SIGHASH_ALL, script_code=p2pkh_script(bytes(20)))).der()
+        tx.tx_ins[0].script_witness = [sig + b'\x01', witness_script]
+        self.assertFalse(tx.verify_input(0))
+        tx.tx_ins[0].script_witness = [b'\x30\x01\x01', witness_script]
+        self.assertFalse(tx.verify_input(0))
+
+    def test_verify_p2sh_p2wpkh(self):
+        key = PrivateKey(8675309)
+        sec = key.point.sec()
+        redeem_script = b'\x00\x14' + hash160(sec)
+        tx = self.spend(Script([0xa9, hash160(redeem_script), 0x87]).serialize())
+        tx.tx_ins[0].script_sig = Script([redeem_script])
+        self.assertEqual(tx.witness_script_code(0), p2pkh_script(hash160(sec)))
+        z = tx.sig_hash(0, SIGHASH_ALL)
+        tx.tx_ins[0].script_witness = [key.sign(z).der() + b'\x01', sec]
+        self.assertTrue(tx.verify_input(0))
+        tx.tx_ins[0].script_witness = [PrivateKey(1).sign(z).der() + b'\x01', sec]
+        self.assertFalse(tx.verify_input(0))
+        # a scriptSig that isn't a redeem script fails instead of raising
+        tx.tx_ins[0].script_sig = Script([b'\x51', b'\x52'])
+        self.assertFalse(tx.verify_input(0))
+
+    def test_sig_hash_types(self):
+        def reference(tx, input_index, hash_type, script_code):
+            # the original client's algorithm, one copy of the tx per input
+            base_type = hash_type & 0x1f
+            if base_type == SIGHASH_SINGLE and input_index >= len(tx.tx_outs):
+                return 1 << 248
+            tx_ins = []
+            for i, tx_in in enumerate(tx.tx_ins):
+                sequence = tx_in.sequence
+                if i != input_index and base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+                    sequence = 0
+                script_sig = script_code if i == input_index else b''
+                tx_ins.append(TxIn(tx_in.prev_tx, tx_in.prev_index, script_sig, sequence))
+            if hash_type & SIGHASH_ANYONECANPAY:
+                tx_ins = tx_ins[input_index:input_index + 1]
+            tx_outs = tx.tx_outs
+            if base_type == SIGHASH_NONE:
+                tx_outs = []
+            elif base_type == SIGHASH_SINGLE:
+                tx_outs = [TxOut(0xffffffffffffffff, b'') for _ in range(input_index)]
+                tx_outs.append(tx.tx_outs[input_index])
+            alt_tx = Tx(tx.version, tx_ins, tx_outs, tx.locktime)
+            s256 = double_sha256(alt_tx.serialize() + int_to_little_endian(hash_type, 4))
+            return int.from_bytes(s256, 'big')
+        rng = random.Random(35)
+        tx_ins = [TxIn(bytes(rng.getrandbits(8) for _ in range(32)), i, b'', rng.getrandbits(32)) for i in range(7)]
+        tx_outs = [TxOut(rng.getrandbits(40), p2pkh_script(bytes(20))) for _ in range(4)]
+        tx = Tx(1, tx_ins, tx_outs, 0)
+        script_code = p2pkh_script(hash160(PrivateKey(1).point.sec()))
+        for hash_type in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE):
+            for hash_type in (hash_type, hash_type | SIGHASH_ANYONECANPAY):
+                for i in range(len(tx_ins)):
+                    self.assertEqual(tx.sig_hash(i, hash_type, script_code), reference(tx, i, hash_type, script_code))
+        # the shared serialization is rebuilt after a change
+        want = tx.sig_hash(2, SIGHASH_ALL, script_code)
+        tx.tx_ins[5].sequence = 0
+        self.assertNotEqual(tx.sig_hash(2, SIGHASH_ALL, script_code), want)
+        self.assertEqual(tx.sig_hash(2, SIGHASH_ALL, script_code), reference(tx, 2, SIGHASH_ALL, script_code))
+        # and after a script is changed in place
+        for edit in (lambda script: setattr(script, 'elements', [0x51]),
+                     lambda script: script.elements.append(0x87)):
+            want = tx.sig_hash(2, SIGHASH_ALL, script_code)
+            edit(tx.tx_outs[1].script_pubkey)
+            self.assertNotEqual(tx.sig_hash(2, SIGHASH_ALL, script_code), want)
+            self.assertEqual(tx.sig_hash(2, SIGHASH_ALL, script_code), reference(tx, 2, SIGHASH_ALL, script_code))
+        # but not after a change to an unsigned field or another transaction
+        hasher = tx.legacy_sig_hasher()
+        tx.tx_ins[0].script_sig = Script([b'\x01'])
+        Tx(1, [TxIn(b'\x00' * 32, 0, b'')], [], 0).tx_ins[0].sequence = 0
+        self.assertIs(tx.legacy_sig_hasher(), hasher)
+
     def test_verify_input1(self):
         raw_tx = unhexlify('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
         stream = BytesIO(raw_tx)
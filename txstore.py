@@ -0,0 +1,296 @@
+from collections import OrderedDict
+from unittest import TestCase, mock
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from prevout import DictPrevoutProvider, PrevoutProvider
+
+
+# index record: tx hash, offset and length of the raw tx in the data file
+INDEX_RECORD = struct.Struct('<32sQI')
+
+
+class TxStore:
+    '''Raw transactions kept on disk, keyed by tx hash.
+
+    The data file only ever has raw transactions appended to it and the
+    index file an INDEX_RECORD for each, written after the data, so a
+    crash of the process at worst loses the last transaction. Writes
+    reach the disk on flush() or close(), which sync the data before the
+    index; until then a power loss can lose them. Data a crash left past
+    the last index record is written over rather than truncated, as
+    readers may have it mapped. Reads go through a read-only mmap of the
+    data file, so processes opening the same store with readonly=True
+    share the pages through the OS page cache. Call refresh() in a reader
+    to see what a writer appended since.
+
+    Parsed transactions are kept in an LRU of max_parsed entries.'''
+
+    def __init__(self, path, readonly=False, max_parsed=1024):
+        self.path = path
+        self.readonly = readonly
+        self.max_parsed = max_parsed
+        self.parsed = OrderedDict()
+        self.offsets = {}
+        self.index_size = 0
+        self.map = None
+        self.map_size = 0
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+            for name in ('txs.dat', 'txs.idx'):
+                open(os.path.join(path, name), 'ab').close()
+        self.refresh()
+        if not readonly:
+            # write over data and a partial record the index doesn't
+            # cover, left by a crash. Truncating the data file would
+            # fault readers that have its pages mapped.
+            data_end = max([o + n for o, n in self.offsets.values()] or [0])
+            self.data = open(os.path.join(path, 'txs.dat'), 'r+b')
+            self.data.seek(data_end)
+            self.index = open(os.path.join(path, 'txs.idx'), 'r+b')
+            self.index.seek(self.index_size)
+
+    def refresh(self):
+        '''Reads index records appended since the last refresh'''
+        try:
+            with open(os.path.join(self.path, 'txs.idx'), 'rb') as f:
+                f.seek(self.index_size)
+                new = f.read()
+        except FileNotFoundError:
+            return
+        # ignore a record that is still being written
+        usable = len(new) - len(new) % INDEX_RECORD.size
+        for tx_hash, offset, length in INDEX_RECORD.iter_unpack(new[:usable]):
+            self.offsets[tx_hash] = (offset, length)
+        self.index_size += usable
+
+    def _view(self, end):
+        '''Returns the mmap of the data file, mapped again if it grew.
+        An empty file can't be mapped, it gives empty bytes.'''
+        if self.map is None or self.map_size < end:
+            with open(os.path.join(self.path, 'txs.dat'), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return b''
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.map_size = size
+        return self.map
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, tx_hash):
+        '''Returns the raw transaction or None'''
+        if tx_hash not in self.offsets:
+            return None
+        offset, length = self.offsets[tx_hash]
+        return self._view(offset + length)[offset:offset + length]
+
+    def put(self, tx_hash, raw):
+        if self.readonly:
+            raise RuntimeError('store is read-only')
+        if tx_hash in self.offsets:
+            return
+        offset = self.data.tell()
+        self.data.write(raw)
+        self.data.flush()
+        self.index.write(INDEX_RECORD.pack(tx_hash, offset, len(raw)))
+        self.index.flush()
+        self.offsets[tx_hash] = (offset, len(raw))
+        self.index_size += INDEX_RECORD.size
+
+    def tx(self, tx_hash, parse):
+        '''Returns parse(raw) for the stored transaction, or None.
+        Parsing only happens on the first lookup since leaving the LRU.'''
+        if tx_hash in self.parsed:
+            self.parsed.move_to_end(tx_hash)
+            return self.parsed[tx_hash]
+        raw = self.get(tx_hash)
+        if raw is None:
+            return None
+        tx = parse(raw)
+        self.parsed[tx_hash] = tx
+        if len(self.parsed) > self.max_parsed:
+            self.parsed.popitem(last=False)
+        return tx
+
+    def flush(self):
+        '''Writes what was put to disk, the data before the index so the
+        index never points past synced data'''
+        if self.readonly:
+            return
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_size = 0
+        if not self.readonly:
+            self.data.close()
+            self.index.close()
+
+
+class StorePrevoutProvider(PrevoutProvider):
+    '''Serves previous transactions from a TxStore. Misses go to source,
+    another PrevoutProvider, and are written to the store unless it is
+    read-only.'''
+
+    def __init__(self, store, source=None):
+        self.store = store
+        self.source = source
+
+    def _missing(self, tx_hash):
+        raise RuntimeError('unknown transaction {}'.format(tx_hash.hex()))
+
+    def raw_tx(self, tx_hash, testnet=False):
+        raw = self.store.get(tx_hash)
+        if raw is not None:
+            return raw
+        if self.source is None:
+            self._missing(tx_hash)
+        raw = self.source.raw_tx(tx_hash, testnet)
+        if not self.store.readonly:
+            self.store.put(tx_hash, raw)
+        return raw
+
+    def raw_txs(self, tx_hashes, testnet=False):
+        result = {}
+        missing = []
+        for tx_hash in tx_hashes:
+            raw = self.store.get(tx_hash)
+            if raw is None:
+                missing.append(tx_hash)
+            else:
+                result[tx_hash] = raw
+        if missing:
+            if self.source is None:
+                self._missing(missing[0])
+            fetched = self.source.raw_txs(missing, testnet)
+            if not self.store.readonly:
+                for tx_hash, raw in fetched.items():
+                    self.store.put(tx_hash, raw)
+            result.update(fetched)
+        return result
+
+
+class TxStoreTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_persist(self):
+        store = TxStore(self.path)
+        store.put(b'\x01' * 32, b'first')
+        store.put(b'\x02' * 32, b'second')
+        self.assertEqual(store.get(b'\x02' * 32), b'second')
+        self.assertIsNone(store.get(b'\x03' * 32))
+        store.close()
+        store = TxStore(self.path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(b'\x01' * 32), b'first')
+        store.close()
+
+    def test_shared_reader(self):
+        writer = TxStore(self.path)
+        writer.put(b'\x01' * 32, b'first')
+        reader = TxStore(self.path, readonly=True)
+        self.assertEqual(reader.get(b'\x01' * 32), b'first')
+        with self.assertRaises(RuntimeError):
+            reader.put(b'\x02' * 32, b'second')
+        writer.put(b'\x02' * 32, b'second')
+        self.assertIsNone(reader.get(b'\x02' * 32))
+        reader.refresh()
+        self.assertEqual(reader.get(b'\x02' * 32), b'second')
+        reader.close()
+        writer.close()
+
+    def test_crash_recovery(self):
+        store = TxStore(self.path)
+        store.put(b'\x01' * 32, b'first')
+        store.close()
+        # data written without its index record, and half an index record
+        with open(os.path.join(self.path, 'txs.dat'), 'ab') as f:
+            f.write(b'lost' * 10)
+        with open(os.path.join(self.path, 'txs.idx'), 'ab') as f:
+            f.write(b'\x00' * 10)
+        reader = TxStore(self.path, readonly=True)
+        self.assertEqual(reader.get(b'\x01' * 32), b'first')
+        store = TxStore(self.path)
+        store.put(b'\x02' * 32, b'second')
+        self.assertEqual(store.get(b'\x01' * 32), b'first')
+        self.assertEqual(store.get(b'\x02' * 32), b'second')
+        # the data file didn't shrink under the reader's mapping
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'txs.dat')), 45)
+        self.assertEqual(reader.map[:11], b'firstsecond')
+        reader.refresh()
+        self.assertEqual(reader.get(b'\x02' * 32), b'second')
+        self.assertEqual(len(TxStore(self.path, readonly=True)), 2)
+        reader.close()
+        store.close()
+
+    def test_empty(self):
+        store = TxStore(self.path)
+        store.put(b'\x01' * 32, b'')
+        self.assertEqual(store.get(b'\x01' * 32), b'')
+        store.close()
+        reader = TxStore(self.path, readonly=True)
+        reader.refresh()
+        self.assertEqual(reader.get(b'\x01' * 32), b'')
+        self.assertIsNone(reader.get(b'\x02' * 32))
+        reader.close()
+
+    def test_flush(self):
+        store = TxStore(self.path)
+        store.put(b'\x01' * 32, b'first')
+        with mock.patch('txstore.os.fsync') as fsync:
+            store.flush()
+            self.assertEqual([c.args[0] for c in fsync.call_args_list],
+                             [store.data.fileno(), store.index.fileno()])
+            store.close()
+            self.assertEqual(fsync.call_count, 4)
+
+    def test_parsed_lru(self):
+        store = TxStore(self.path, max_parsed=2)
+        for i in range(3):
+            store.put(bytes([i]) * 32, bytes([i]))
+        parses = []
+
+        def parse(raw):
+            parses.append(raw)
+            return bytes(raw)
+        for i in (0, 1, 0, 2, 1, 0):
+            self.assertEqual(store.tx(bytes([i]) * 32, parse), bytes([i]))
+        # 1 was evicted by 2, then 0 by 1
+        self.assertEqual(parses, [b'\x00', b'\x01', b'\x02', b'\x01', b'\x00'])
+        store.close()
+
+    def test_provider(self):
+        source = DictPrevoutProvider({b'\x01' * 32: b'first', b'\x02' * 32: b'second'})
+        store = TxStore(self.path)
+        provider = StorePrevoutProvider(store, source)
+        self.assertEqual(provider.raw_tx(b'\x01' * 32), b'first')
+        self.assertEqual(provider.raw_txs([b'\x01' * 32, b'\x02' * 32]),
+                         {b'\x01' * 32: b'first', b'\x02' * 32: b'second'})
+        store.close()
+        # everything is on disk now, the source isn't needed
+        store = TxStore(self.path, readonly=True)
+        provider = StorePrevoutProvider(store)
+        self.assertEqual(provider.raw_tx(b'\x02' * 32), b'second')
+        with self.assertRaises(RuntimeError):
+            provider.raw_tx(b'\x03' * 32)
+        store.close()